@@ -1,5 +1,10 @@
 """
 Create stubs for (all) modules on a MicroPython board
+
+The detection, clean and report phases live in createstubs_*.py modules that are
+imported when needed and removed from memory when done, the module list is read
+from modulelist.txt. Upload these together with createstubs.py
+A precompiled phase module, createstubs_info_mpy.mpy, is imported in place of its .py
 Copyright (c) 2019-2020 Jos Verlinde
 """
 #pylint: disable= invalid-name, missing-function-docstring, import-outside-toplevel, logging-not-lazy
@@ -7,10 +12,12 @@ import sys
 import gc
 import logging
 import uos as os
-from utime import sleep_us
+from utime import sleep_us, ticks_ms, ticks_diff
 from ujson import dumps
 
 ENOENT = 2
+# marks a progress event line in the output, followed by the event as json
+PROGRESS = '@stubber '
 stubber_version = '1.3.9'
 # deal with ESP32 firmware specific implementations.
 try:
@@ -21,7 +28,7 @@ except ImportError:
 
 class Stubber():
     "Generate stubs for modules in firmware"
-    def __init__(self, path: str = None, firmware_id: str = None):
+    def __init__(self, path: str = None, firmware_id: str = None, progress: bool = False):
         try:
             if os.uname().release == '1.13.0' and os.uname().version < 'v1.13-103':
                 raise NotImplementedError("MicroPython 1.13.0 cannot be stubbed")
@@ -30,6 +37,8 @@ class Stubber():
 
         self._log = logging.getLogger('stubber')
         self._report = []
+        self._retired = []
+        self.progress = progress
         self.info = self._info()
         if firmware_id:
             self._fwid = str(firmware_id).lower() 
@@ -46,109 +55,26 @@ class Stubber():
         self.path = "{}/stubs/{}".format(path, self.flat_fwid).replace('//', '/')
         self._log.debug(self.path)
         try:
-            self.ensure_folder(path + "/")
+            self.ensure_folder(self.path + "/")
         except OSError:
-            self._log.error("error creating stub folder {}".format(path))
+            self._log.error("error creating stub folder {}".format(self.path))
         self.problematic = ["upysh", "webrepl_setup", "http_client", "http_client_ssl", "http_server", "http_server_ssl"]
         self.excluded = ["webrepl", "_webrepl", "port_diag", "example_sub_led.py", "example_pub_button.py"]
         # there is no option to discover modules from upython, need to hardcode
-        # below contains combined modules from  Micropython ESP8622, ESP32, Loboris, pycom and ulab
-        # modules to stub : 118
-        self.modules = ['_onewire', '_thread', '_uasyncio', 'ak8963', 'apa102', 'apa106', 'array', 'binascii', 'btree', 'builtins', 
-'cmath', 'collections', 'crypto',
-                        'curl', 'dht', 'display', 'ds18x20', 'errno', 'esp', 'esp32', 'flashbdev', 'framebuf', 'freesans20', 'functools', 'gc', 'gsm', 'hashlib',
-                        'heapq', 'inisetup', 'io', 'json', 'lcd160cr', 'lcd160cr_test', 'logging', 'lwip', 'machine', 'math', 'microWebSocket', 'microWebSrv', 'microWebTemplate',
-                        'micropython', 'mpu6500', 'mpu9250', 'neopixel', 'network', 'ntptime', 'onewire', 'os', 'pyb', 'pycom', 'pye', 'queue', 'random', 're', 'requests',
-                        'select', 'socket', 'ssd1306', 'ssh', 'ssl', 'stm', 'struct', 'sys', 'time', 'tpcalib', 'uarray', 'uasyncio/__init__', 'uasyncio/core', 'uasyncio/event',
-                        'uasyncio/funcs', 'uasyncio/lock', 'uasyncio/stream', 'ubinascii', 'ubluetooth', 'ucollections', 'ucrypto', 
-'ucryptolib', 'uctypes', 'uerrno',
-                        'uhashlib', 'uheapq', 'uio', 'ujson', 'ulab', 'ulab/approx', 'ulab/compare', 'ulab/fft', 'ulab/filter', 'ulab/linalg', 'ulab/numerical',
-                        'ulab/poly', 'ulab/user', 'ulab/vector', 'umachine', 'umqtt/robust', 'umqtt/simple', 'uos', 'upip', 'upip_utarfile', 'uqueue', 'urandom',
-                        'ure', 'urequests', 'urllib/urequest', 'uselect', 'usocket', 'ussl', 'ustruct', 'usys', 'utime', 'utimeq', 'uwebsocket', 'uzlib', 'websocket',
-                        'websocket_helper', 'writer', 'ymodem', 'zlib']
+        # the modules to stub are streamed from modulelist.txt, self.modules holds any added modules
+        self.modulelist = "{}/modulelist.txt".format(script_folder())
+        self.modules = []
         # try to avoid running out of memory with nested mods
         self.include_nested = gc.mem_free() > 3200 # pylint: disable=no-member
 
     @staticmethod
     def _info():
         "collect base information on this runtime"
-        info = {'name': sys.implementation.name,    # - micropython
-                'release': '0.0.0',                 # mpy semver from sys.implementation or os.uname()release
-                'version': '0.0.0',                 # major.minor.0
-                'build': '',                        # parsed from version
-                'sysname': 'unknown',               # esp32
-                'nodename': 'unknown',              # ! not on all builds
-                'machine': 'unknown',               # ! not on all builds
-                'family': sys.implementation.name,  # fw families, micropython , pycopy , lobo , pycomm
-                'platform': sys.platform,               # port: esp32 / win32 / linux
-                'port': sys.platform,               # port: esp32 / win32 / linux
-                'ver': ''                           # short version
-                }
+        createstubs_info = load('createstubs_info')
         try:
-            info['release'] = ".".join([str(i) for i in sys.implementation.version])
-            info['version'] = info['release']
-            info['name'] = sys.implementation.name
-            info['mpy'] = sys.implementation.mpy
-        except AttributeError:
-            pass
-
-        if sys.platform not in ('unix', 'win32'):
-            try:
-                u = os.uname()
-                info['sysname'] = u.sysname
-                info['nodename'] = u.nodename
-                info['release'] = u.release
-                info['machine'] = u.machine
-                # parse micropython build info
-                if ' on ' in u.version:
-                    s = u.version.split('on ')[0]
-                    try:
-                        info['build'] = s.split('-')[1]
-                    except IndexError:
-                        pass
-            except (IndexError, AttributeError, TypeError):
-                pass
-
-        try: # families
-            from pycopy import const
-            info['family'] = 'pycopy'
-            del const
-        except (ImportError, KeyError):
-            pass
-        if info['platform'] == 'esp32_LoBo':
-            info['family'] = 'loboris'
-            info['port'] = 'esp32'
-        elif info['sysname'] == 'ev3':
-            # ev3 pybricks
-            info['family'] = 'ev3-pybricks'
-            info['release'] = "1.0.0"
-            try:
-                # Version 2.0 introduces the EV3Brick() class. 
-                from pybricks.hubs import EV3Brick
-                info['release'] = "2.0.0"
-            except ImportError:
-                pass
-
-        # version info
-        if info['release']:
-            info['ver'] = 'v'+info['release']
-        if info['family'] != 'loboris':
-            if info['release'] and info['release'] >= '1.10.0' and info['release'].endswith('.0'):
-                #drop the .0 for newer releases
-                info['ver'] = info['release'][:-2]
-            else:
-                info['ver'] = info['release']
-            # add the build nr
-            if info['build'] != '':
-                info['ver'] += '-'+info['build']
-        if 'mpy' in info:          # mpy on some v1.11+ builds
-            sys_mpy = info['mpy']
-            arch = [None, 'x86', 'x64', 'armv6', 'armv6m',
-                    'armv7m', 'armv7em', 'armv7emsp', 'armv7emdp',
-                    'xtensa', 'xtensawin'][sys_mpy >> 10]
-            if arch:
-                info['arch'] = arch
-        return info
+            return createstubs_info.info()
+        finally:
+            unload('createstubs_info')
 
     def get_obj_attributes(self, obj: object):
         "extract information of the objects members and attributes"
@@ -175,25 +101,62 @@ class Stubber():
         "Add additional modules to be exported"
         self.modules = sorted(set(self.modules) | set(modules))
 
+    def list_modules(self):
+        "Stream the module names from the modulelist file, followed by the added modules"
+        # start with the (more complex) modules with a / first to reduce memory problems
+        added = [m for m in self.modules if '/' in m] + [m for m in self.modules if '/' not in m]
+        try:
+            with open(self.modulelist) as f:
+                for line in f:
+                    module_name = line.strip()
+                    if not module_name or module_name[0] == '#':
+                        continue
+                    if module_name in added:
+                        added.remove(module_name)
+                    yield module_name
+        except OSError:
+            self._log.error("Failed to read the module list: {}".format(self.modulelist))
+        for module_name in added:
+            yield module_name
+
+    def emit(self, event: str, **values):
+        "Print a progress event as a single line of json, for tools/progress monitors on the host"
+        if not self.progress:
+            return
+        values['ev'] = event
+        values['t'] = ticks_ms()
+        values['mem'] = gc.mem_free() # pylint: disable=no-member
+        print(PROGRESS + dumps(values))
+
     def create_all_stubs(self):
         "Create stubs for all configured modules"
         self._log.info("Start micropython-stubber v{} on {}".format(stubber_version, self._fwid))
-        # start with the (more complex) modules with a / first to reduce memory problems
-        self.modules = [m for m in self.modules if '/' in m] + [m for m in self.modules if '/' not in m]
         gc.collect()
-        for module_name in self.modules:
+        run_start = ticks_ms()
+        total = 0
+        if self.progress:
+            # a quick pass over the list, so the host can estimate the time left
+            for _ in self.list_modules():
+                total += 1
+            self.emit('run', fwid=self._fwid, version=stubber_version, total=total)
+        n = 0
+        for module_name in self.list_modules():
+            n += 1
             #re-evaluate
             if self.include_nested:
                 self.include_nested = gc.mem_free() > 3200 # pylint: disable=no-member
 
             if module_name.startswith("_") and module_name != '_thread':
                 self._log.warning("Skip module: {:<20}        : Internal ".format(module_name))
+                self.emit('skip', n=n, mod=module_name, why='internal')
                 continue
             if module_name in self.problematic:
                 self._log.warning("Skip module: {:<20}        : Known problematic".format(module_name))
+                self.emit('skip', n=n, mod=module_name, why='problematic')
                 continue
             if module_name in self.excluded:
                 self._log.warning("Skip module: {:<20}        : Excluded".format(module_name))
+                self.emit('skip', n=n, mod=module_name, why='excluded')
                 continue
 
             file_name = "{}/{}.py".format(
@@ -203,30 +166,35 @@ class Stubber():
             gc.collect()
             m1 = gc.mem_free() # pylint: disable=no-member
             self._log.info("Stub module: {:<20} to file: {:<55} mem:{:>5}".format(module_name, file_name, m1))
+            self.emit('start', n=n, mod=module_name)
+            start = ticks_ms()
+            stubbed = False
             try:
-                self.create_module_stub(module_name, file_name)
-            except OSError:
-                pass
+                stubbed = self.create_module_stub(module_name, file_name)
+            except OSError as e:
+                self.emit('error', n=n, mod=module_name, err=str(e))
             gc.collect()
             self._log.debug("Memory     : {:>20} {:>6X}".format(m1, m1-gc.mem_free())) # pylint: disable=no-member
+            self.emit('end', n=n, mod=module_name, ok=stubbed, ms=ticks_diff(ticks_ms(), start), used=m1 - gc.mem_free()) # pylint: disable=no-member
+        self.emit('done', stubs=len(self._report), ms=ticks_diff(ticks_ms(), run_start))
         self._log.info('Finally done')
 
-    def create_module_stub(self, module_name: str, file_name: str = None):
-        "Create a Stub of a single python module"
+    def create_module_stub(self, module_name: str, file_name: str = None) -> bool:
+        "Create a Stub of a single python module, returns True when a stub was written"
         if module_name.startswith("_") and module_name != '_thread':
             self._log.warning("SKIPPING internal module:{}".format(module_name))
-            return
+            return False
 
         if module_name in self.problematic:
             self._log.warning("SKIPPING problematic module:{}".format(module_name))
-            return
+            return False
         if '/' in module_name:
             #for nested modules
             self.ensure_folder(file_name)
             module_name = module_name.replace('/', '.')
             if not self.include_nested:
                 self._log.warning("SKIPPING nested module:{}".format(module_name))
-                return
+                return False
 
         if file_name is None:
             file_name = module_name.replace('.', '_') + ".py"
@@ -240,7 +208,7 @@ class Stubber():
             failed = True
             self._log.warning("Skip module: {:<20}        : Failed to import".format(module_name))
             if not '.' in module_name:
-                return
+                return False
 
         #re-try import after importing parents
         if failed and '.' in module_name:
@@ -258,7 +226,7 @@ class Stubber():
                 self._log.debug("OK , imported module: {} ".format(module_name))
             except ImportError: # now bail out
                 self._log.debug("Failed to import module: {}".format(module_name))
-                return
+                return False
 
         # Start a new file
         with open(file_name, "w") as fp:
@@ -280,6 +248,7 @@ class Stubber():
             except KeyError:
                 self._log.debug("could not del modules[{}]".format(module_name))
             gc.collect()
+        return True
 
     def write_object_stub(self, fp, object_expr: object, obj_name: str, indent: str):
         "Write a module/object stub to an open file. Can be called recursive."
@@ -346,57 +315,34 @@ class Stubber():
             s = s.replace(c, "_")
         return s
 
-    def clean(self, path: str = None):
-        "Remove all files from the stub folder"
-        if path is None:
-            path = self.path
-        self._log.info("Clean/remove files in folder: {}".format(path))
+    def clean(self, path: str = None, rename: bool = False):
+        "Remove all files from the stub folder, or with rename: set it aside to purge() after stubbing"
+        createstubs_clean = load('createstubs_clean')
         try:
-            items = os.listdir(path)
-        except (OSError, AttributeError):#lgtm [py/unreachable-statement]
-            # os.listdir fails on unix
+            if rename:
+                createstubs_clean.retire(self, path)
+            else:
+                createstubs_clean.clean(self, path)
+        finally:
+            unload('createstubs_clean')
+
+    def purge(self):
+        "Remove the stub folders that clean(rename=True) has set aside"
+        if not self._retired:
             return
-        for fn in items:
-            try:
-                item = "{}/{}".format(path, fn)
-                os.remove(item)
-            except OSError:
-                try: #folder
-                    self.clean(item)
-                    os.rmdir(item)
-                except OSError:
-                    pass
+        createstubs_clean = load('createstubs_clean')
+        try:
+            createstubs_clean.purge(self)
+        finally:
+            unload('createstubs_clean')
 
     def report(self, filename: str = "modules.json"):
         "create json with list of exported modules"
-        self._log.info("Created stubs for {} modules on board {}\nPath: {}".format(
-            len(self._report),
-            self._fwid,
-            self.path
-            ))
-        f_name = "{}/{}".format(self.path, filename)
-        gc.collect()
+        createstubs_report = load('createstubs_report')
         try:
-            # write json by node to reduce memory requirements
-            with open(f_name, 'w') as f:
-                f.write('{')
-                f.write(dumps({'firmware': self.info})[1:-1])
-                f.write(',')
-                f.write(dumps({'stubber':{'version': stubber_version}})[1:-1])
-                f.write(',')
-                f.write('"modules" :[')
-                start = True
-                for n in self._report:
-                    if start:
-                        start = False
-                    else:
-                        f.write(',')
-                    f.write(dumps(n))
-                f.write(']}')
-            used = self._start_free - gc.mem_free() # pylint: disable=no-member
-            self._log.info("Memory used: {0} Kb".format( used//1024))
-        except OSError:
-            self._log.error("Failed to create the report.")
+            createstubs_report.report(self, stubber_version, filename)
+        finally:
+            unload('createstubs_report')
 
     def ensure_folder(self, path: str):
         "Create nested folders if needed"
@@ -443,20 +389,44 @@ class Stubber():
                 r = '/'
         return r
 
+def load(module_name: str):
+    "Import a phase module, its precompiled version first: import picks a .py over a .mpy with the same name"
+    try:
+        return __import__(module_name + '_mpy')
+    except ImportError:
+        return __import__(module_name)
+
+def unload(module_name: str):
+    "Remove a phase module from memory once it is done"
+    sys.modules.pop(module_name, None)
+    sys.modules.pop(module_name + '_mpy', None)
+    gc.collect()
+
+def script_folder() -> str:
+    "the folder createstubs.py was loaded from, where the phase modules and data files live"
+    try:
+        if '/' in __file__:
+            return __file__.rsplit('/', 1)[0]
+    except NameError:
+        pass
+    return '.'
+
 def show_help():
     print("-p, --path   path to store the stubs in, defaults to '.'")
+    print("--progress   print progress events for src/progress_monitor.py")
     sys.exit(1)
 
 def read_path()->str:
     "get --path from cmdline. [unix/win]"
     path = None
-    if len(sys.argv) == 3:
-        cmd = (sys.argv[1]).lower()
+    argv = [a for a in sys.argv if a != '--progress']
+    if len(argv) == 3:
+        cmd = (argv[1]).lower()
         if cmd in ('--path', '-p'):
-            path  = sys.argv[2]
+            path  = argv[2]
         else:
             show_help()
-    elif len(sys.argv) >= 2:
+    elif len(argv) >= 2:
         show_help()
     return path
 
@@ -479,14 +449,19 @@ def main():
         logging.basicConfig(level=logging.INFO)
     except NameError:
         pass
-    stubber = Stubber(path=read_path())
+    stubber = Stubber(path=read_path(), progress='--progress' in sys.argv)
     # Option: Specify a firmware name & version
     # stubber = Stubber(firmware_id='HoverBot v1.2.1')
+    # Option: print progress events on a board, this costs about 2 KB of heap
+    # stubber = Stubber(progress=True)
     stubber.clean()
+    # Option: set the previous stubs aside and remove them after stubbing, to start right away
+    # stubber.clean(rename=True)
     # # Option: Add your own modules
     # # stubber.add_modules(['bluetooth','GPS'])
     stubber.create_all_stubs()
     stubber.report()
+    stubber.purge()
 
 if __name__ == "__main__" or isMicroPython():
     main()
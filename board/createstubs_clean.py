@@ -0,0 +1,111 @@
+"""
+Clean phase of createstubs.py: remove the files from a previous run
+Copyright (c) 2019-2020 Jos Verlinde
+"""
+#pylint: disable= invalid-name, protected-access, logging-not-lazy
+import uos as os
+
+S_IFDIR = 0x4000
+# max number of file names held in memory at once
+BATCH = 20
+
+def exists(path: str) -> bool:
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+def is_folder(path: str) -> bool:
+    return os.stat(path)[0] & S_IFDIR == S_IFDIR
+
+def list_batch(folder: str, skip=None):
+    "Up to BATCH files in a folder, or the first sub folder that is found, leaving out the paths in skip"
+    files = []
+    try:
+        entries = os.ilistdir(folder)
+        for entry in entries:
+            if entry[0] in ('.', '..'):
+                # unix port
+                continue
+            if skip and "{}/{}".format(folder, entry[0]) in skip:
+                continue
+            if entry[1] & S_IFDIR:
+                return None, entry[0]
+            files.append(entry[0])
+            if len(files) == BATCH:
+                break
+    except AttributeError:
+        # no ilistdir, need a stat per entry
+        for fn in os.listdir(folder):
+            if skip and "{}/{}".format(folder, fn) in skip:
+                continue
+            if is_folder("{}/{}".format(folder, fn)):
+                return None, fn
+            files.append(fn)
+            if len(files) == BATCH:
+                break
+    return files, None
+
+def remove_tree(stubber, path: str, keep_root: bool = True):
+    "Remove all files and folders below path, without recursion, skipping those that cannot be removed"
+    if not exists(path):
+        return
+    stack = [path]
+    # the paths that could not be removed, left out of the next batches
+    failed = set()
+    while stack:
+        folder = target = stack[-1]
+        try:
+            files, sub = list_batch(folder, failed)
+            if sub:
+                # descend first, the folder is gone when we come back
+                stack.append("{}/{}".format(folder, sub))
+            elif files:
+                for fn in files:
+                    target = "{}/{}".format(folder, fn)
+                    os.remove(target)
+            else:
+                stack.pop()
+                if stack or not keep_root:
+                    os.rmdir(folder)
+        except OSError as e:
+            stubber._log.error("Failed to remove: {} {}".format(target, e))
+            failed.add(target)
+            if stack and stack[-1] == target:
+                # a folder that cannot be listed
+                stack.pop()
+
+def clean(stubber, path: str = None):
+    "Remove all files from the stub folder"
+    if path is None:
+        path = stubber.path
+    stubber._log.info("Clean/remove files in folder: {}".format(path))
+    remove_tree(stubber, path)
+
+def retire(stubber, path: str = None):
+    "Rename the stub folder out of the way, purge() removes it after stubbing"
+    if path is None:
+        path = stubber.path
+    if not exists(path):
+        return
+    n = 0
+    old = path + '_old'
+    while exists(old):
+        n += 1
+        old = "{}_old{}".format(path, n)
+    stubber._log.info("Rename folder: {} to {}".format(path, old))
+    try:
+        os.rename(path, old)
+    except OSError:
+        clean(stubber, path)
+        return
+    stubber._retired.append(old)
+    stubber.ensure_folder(path + "/")
+
+def purge(stubber):
+    "Remove the folders set aside by retire()"
+    while stubber._retired:
+        old = stubber._retired.pop()
+        stubber._log.info("Remove old folder: {}".format(old))
+        remove_tree(stubber, old, keep_root=False)
@@ -0,0 +1,87 @@
+"""
+Detection phase of createstubs.py: collect base information on this runtime
+Copyright (c) 2019-2020 Jos Verlinde
+"""
+#pylint: disable= invalid-name, import-outside-toplevel
+import sys
+import uos as os
+
+def info():
+    "collect base information on this runtime"
+    info = {'name': sys.implementation.name,    # - micropython
+            'release': '0.0.0',                 # mpy semver from sys.implementation or os.uname()release
+            'version': '0.0.0',                 # major.minor.0
+            'build': '',                        # parsed from version
+            'sysname': 'unknown',               # esp32
+            'nodename': 'unknown',              # ! not on all builds
+            'machine': 'unknown',               # ! not on all builds
+            'family': sys.implementation.name,  # fw families, micropython , pycopy , lobo , pycomm
+            'platform': sys.platform,               # port: esp32 / win32 / linux
+            'port': sys.platform,               # port: esp32 / win32 / linux
+            'ver': ''                           # short version
+            }
+    try:
+        info['release'] = ".".join([str(i) for i in sys.implementation.version])
+        info['version'] = info['release']
+        info['name'] = sys.implementation.name
+        info['mpy'] = sys.implementation.mpy
+    except AttributeError:
+        pass
+
+    if sys.platform not in ('unix', 'win32'):
+        try:
+            u = os.uname()
+            info['sysname'] = u.sysname
+            info['nodename'] = u.nodename
+            info['release'] = u.release
+            info['machine'] = u.machine
+            # parse micropython build info
+            if ' on ' in u.version:
+                s = u.version.split('on ')[0]
+                try:
+                    info['build'] = s.split('-')[1]
+                except IndexError:
+                    pass
+        except (IndexError, AttributeError, TypeError):
+            pass
+
+    try: # families
+        from pycopy import const
+        info['family'] = 'pycopy'
+        del const
+    except (ImportError, KeyError):
+        pass
+    if info['platform'] == 'esp32_LoBo':
+        info['family'] = 'loboris'
+        info['port'] = 'esp32'
+    elif info['sysname'] == 'ev3':
+        # ev3 pybricks
+        info['family'] = 'ev3-pybricks'
+        info['release'] = "1.0.0"
+        try:
+            # Version 2.0 introduces the EV3Brick() class. 
+            from pybricks.hubs import EV3Brick
+            info['release'] = "2.0.0"
+        except ImportError:
+            pass
+
+    # version info
+    if info['release']:
+        info['ver'] = 'v'+info['release']
+    if info['family'] != 'loboris':
+        if info['release'] and info['release'] >= '1.10.0' and info['release'].endswith('.0'):
+            #drop the .0 for newer releases
+            info['ver'] = info['release'][:-2]
+        else:
+            info['ver'] = info['release']
+        # add the build nr
+        if info['build'] != '':
+            info['ver'] += '-'+info['build']
+    if 'mpy' in info:          # mpy on some v1.11+ builds
+        sys_mpy = info['mpy']
+        arch = [None, 'x86', 'x64', 'armv6', 'armv6m',
+                'armv7m', 'armv7em', 'armv7emsp', 'armv7emdp',
+                'xtensa', 'xtensawin'][sys_mpy >> 10]
+        if arch:
+            info['arch'] = arch
+    return info
@@ -0,0 +1,38 @@
+"""
+Report phase of createstubs.py: write the module manifest
+Copyright (c) 2019-2020 Jos Verlinde
+"""
+#pylint: disable= invalid-name, protected-access, logging-not-lazy
+import gc
+from ujson import dumps
+
+def report(stubber, version: str, filename: str = "modules.json"):
+    "create json with list of exported modules"
+    stubber._log.info("Created stubs for {} modules on board {}\nPath: {}".format(
+        len(stubber._report),
+        stubber._fwid,
+        stubber.path
+        ))
+    f_name = "{}/{}".format(stubber.path, filename)
+    gc.collect()
+    try:
+        # write json by node to reduce memory requirements
+        with open(f_name, 'w') as f:
+            f.write('{')
+            f.write(dumps({'firmware': stubber.info})[1:-1])
+            f.write(',')
+            f.write(dumps({'stubber':{'version': version}})[1:-1])
+            f.write(',')
+            f.write('"modules" :[')
+            start = True
+            for n in stubber._report:
+                if start:
+                    start = False
+                else:
+                    f.write(',')
+                f.write(dumps(n))
+            f.write(']}')
+        used = stubber._start_free - gc.mem_free() # pylint: disable=no-member
+        stubber._log.info("Memory used: {0} Kb".format( used//1024))
+    except OSError:
+        stubber._log.error("Failed to create the report.")
@@ -7,7 +7,14 @@ def countdown():
     for i in range(5, 0, -1):
         print('start stubbing in {}...'.format(i))
         time.sleep(1)
-    import createstubs
+    try:
+        # prefer the precompiled version, it does not need to be compiled on the board
+        # import picks createstubs.py over createstubs.mpy, hence the different name
+        os.stat('createstubs_mpy.mpy')
+    except OSError:
+        import createstubs
+    else:
+        import createstubs_mpy
 
 try: 
     # only run import if no stubs yet
@@ -1,13 +1,18 @@
 """
 Create stubs for (all) modules on a MicroPython board
+The detection, clean and report phases live in createstubs_*.py modules that are
+imported when needed and removed from memory when done, the module list is read
+from modulelist.txt. Upload these together with createstubs.py
+A precompiled phase module, createstubs_info_mpy.mpy, is imported in place of its .py
 Copyright (c) 2019-2020 Jos Verlinde
 """
 import sys
 import gc
 import uos as os
-from utime import sleep_us
+from utime import sleep_us,ticks_ms,ticks_diff
 from ujson import dumps
 ENOENT=2
+PROGRESS='@stubber '
 stubber_version='1.3.9'
 try:
  from machine import resetWDT 
@@ -15,13 +20,15 @@ except ImportError:
  def resetWDT():
   pass
 class Stubber():
- def __init__(self,path:str=None,firmware_id:str=None):
+ def __init__(self,path:str=None,firmware_id:str=None,progress:bool=False):
   try:
    if os.uname().release=='1.13.0' and os.uname().version<'v1.13-103':
     raise NotImplementedError("MicroPython 1.13.0 cannot be stubbed")
   except AttributeError:
    pass
   self._report=[]
+  self._retired=[]
+  self.progress=progress
   self.info=self._info()
   if firmware_id:
    self._fwid=str(firmware_id).lower()
@@ -35,70 +42,21 @@ class Stubber():
    path=self.get_root()
   self.path="{}/stubs/{}".format(path,self.flat_fwid).replace('//','/')
   try:
-   self.ensure_folder(path+"/")
+   self.ensure_folder(self.path+"/")
   except OSError:
    pass
   self.problematic=["upysh","webrepl_setup","http_client","http_client_ssl","http_server","http_server_ssl"]
   self.excluded=["webrepl","_webrepl","port_diag","example_sub_led.py","example_pub_button.py"]
-  self.modules=['_onewire','_thread','_uasyncio','ak8963','apa102','apa106','array','binascii','btree','builtins','cmath','collections','crypto','curl','dht','display','ds18x20','errno','esp','esp32','flashbdev','framebuf','freesans20','functools','gc','gsm','hashlib','heapq','inisetup','io','json','lcd160cr','lcd160cr_test','logging','lwip','machine','math','microWebSocket','microWebSrv','microWebTemplate','micropython','mpu6500','mpu9250','neopixel','network','ntptime','onewire','os','pyb','pycom','pye','queue','random','re','requests','select','socket','ssd1306','ssh','ssl','stm','struct','sys','time','tpcalib','uarray','uasyncio/__init__','uasyncio/core','uasyncio/event','uasyncio/funcs','uasyncio/lock','uasyncio/stream','ubinascii','ubluetooth','ucollections','ucrypto','ucryptolib','uctypes','uerrno','uhashlib','uheapq','uio','ujson','ulab','ulab/approx','ulab/compare','ulab/fft','ulab/filter','ulab/linalg','ulab/numerical','ulab/poly','ulab/user','ulab/vector','umachine','umqtt/robust','umqtt/simple','uos','upip','upip_utarfile','uqueue','urandom','ure','urequests','urllib/urequest','uselect','usocket','ussl','ustruct','usys','utime','utimeq','uwebsocket','uzlib','websocket','websocket_helper','writer','ymodem','zlib']
+  self.modulelist="{}/modulelist.txt".format(script_folder())
+  self.modules=[]
   self.include_nested=gc.mem_free()>3200 
  @staticmethod
  def _info():
-  info={'name':sys.implementation.name,'release':'0.0.0','version':'0.0.0','build':'','sysname':'unknown','nodename':'unknown','machine':'unknown','family':sys.implementation.name,'platform':sys.platform,'port':sys.platform,'ver':''}
+  createstubs_info=load('createstubs_info')
   try:
-   info['release']=".".join([str(i)for i in sys.implementation.version])
-   info['version']=info['release']
-   info['name']=sys.implementation.name
-   info['mpy']=sys.implementation.mpy
-  except AttributeError:
-   pass
-  if sys.platform not in('unix','win32'):
-   try:
-    u=os.uname()
-    info['sysname']=u.sysname
-    info['nodename']=u.nodename
-    info['release']=u.release
-    info['machine']=u.machine
-    if ' on ' in u.version:
-     s=u.version.split('on ')[0]
-     try:
-      info['build']=s.split('-')[1]
-     except IndexError:
-      pass
-   except(IndexError,AttributeError,TypeError):
-    pass
-  try:
-   from pycopy import const
-   info['family']='pycopy'
-   del const
-  except(ImportError,KeyError):
-   pass
-  if info['platform']=='esp32_LoBo':
-   info['family']='loboris'
-   info['port']='esp32'
-  elif info['sysname']=='ev3':
-   info['family']='ev3-pybricks'
-   info['release']="1.0.0"
-   try:
-    from pybricks.hubs import EV3Brick
-    info['release']="2.0.0"
-   except ImportError:
-    pass
-  if info['release']:
-   info['ver']='v'+info['release']
-  if info['family']!='loboris':
-   if info['release']and info['release']>='1.10.0' and info['release'].endswith('.0'):
-    info['ver']=info['release'][:-2]
-   else:
-    info['ver']=info['release']
-   if info['build']!='':
-    info['ver']+='-'+info['build']
-  if 'mpy' in info: 
-   sys_mpy=info['mpy']
-   arch=[None,'x86','x64','armv6','armv6m','armv7m','armv7em','armv7emsp','armv7emdp','xtensa','xtensawin'][sys_mpy>>10]
-   if arch:
-    info['arch']=arch
-  return info
+   return createstubs_info.info()
+  finally:
+   unload('createstubs_info')
  def get_obj_attributes(self,obj:object):
   result=[]
   errors=[]
@@ -116,37 +74,74 @@ class Stubber():
   return result,errors
  def add_modules(self,modules:list):
   self.modules=sorted(set(self.modules)|set(modules))
+ def list_modules(self):
+  added=[m for m in self.modules if '/' in m]+[m for m in self.modules if '/' not in m]
+  try:
+   with open(self.modulelist)as f:
+    for line in f:
+     module_name=line.strip()
+     if not module_name or module_name[0]=='#':
+      continue
+     if module_name in added:
+      added.remove(module_name)
+     yield module_name
+  except OSError:
+   pass
+  for module_name in added:
+   yield module_name
+ def emit(self,event:str,**values):
+  if not self.progress:
+   return
+  values['ev']=event
+  values['t']=ticks_ms()
+  values['mem']=gc.mem_free()
+  print(PROGRESS+dumps(values))
  def create_all_stubs(self):
-  self.modules=[m for m in self.modules if '/' in m]+[m for m in self.modules if '/' not in m]
   gc.collect()
-  for module_name in self.modules:
+  run_start=ticks_ms()
+  total=0
+  if self.progress:
+   for _ in self.list_modules():
+    total+=1
+   self.emit('run',fwid=self._fwid,version=stubber_version,total=total)
+  n=0
+  for module_name in self.list_modules():
+   n+=1
    if self.include_nested:
     self.include_nested=gc.mem_free()>3200 
    if module_name.startswith("_")and module_name!='_thread':
+    self.emit('skip',n=n,mod=module_name,why='internal')
     continue
    if module_name in self.problematic:
+    self.emit('skip',n=n,mod=module_name,why='problematic')
     continue
    if module_name in self.excluded:
+    self.emit('skip',n=n,mod=module_name,why='excluded')
     continue
    file_name="{}/{}.py".format(self.path,module_name.replace(".","/"))
    gc.collect()
    m1=gc.mem_free()
    print("Stub module: {:<20} to file: {:<55} mem:{:>5}".format(module_name,file_name,m1))
+   self.emit('start',n=n,mod=module_name)
+   start=ticks_ms()
+   stubbed=False
    try:
-    self.create_module_stub(module_name,file_name)
-   except OSError:
-    pass
+    stubbed=self.create_module_stub(module_name,file_name)
+   except OSError as e:
+    self.emit('error',n=n,mod=module_name,err=str(e))
    gc.collect()
- def create_module_stub(self,module_name:str,file_name:str=None):
+   self.emit('end',n=n,mod=module_name,ok=stubbed,ms=ticks_diff(ticks_ms(),start),used=m1-gc.mem_free())
+  self.emit('done',stubs=len(self._report),ms=ticks_diff(ticks_ms(),run_start))
+ def create_module_stub(self,module_name:str,file_name:str=None)->bool:
   if module_name.startswith("_")and module_name!='_thread':
-   return
+   return False
   if module_name in self.problematic:
-   return
+   return False
   if '/' in module_name:
    self.ensure_folder(file_name)
    module_name=module_name.replace('/','.')
    if not self.include_nested:
-    return
+    return False
   if file_name is None:
    file_name=module_name.replace('.','_')+".py"
   failed=False
@@ -156,7 +151,7 @@ class Stubber():
   except ImportError:
    failed=True
    if not '.' in module_name:
-    return
+    return False
   if failed and '.' in module_name:
    levels=module_name.split('.')
    for n in range(1,len(levels)):
@@ -169,7 +164,7 @@ class Stubber():
    try:
     new_module=__import__(module_name,None,None,('*'))
    except ImportError:
-    return
+    return False
   with open(file_name,"w")as fp:
    s="\"\"\"\nModule: '{0}' on {1}\n\"\"\"\n# MCU: {2}\n# Stubber: {3}\n".format(module_name,self._fwid,self.info,stubber_version)
    fp.write(s)
@@ -185,6 +180,7 @@ class Stubber():
    except KeyError:
     pass
    gc.collect()
+  return True
  def write_object_stub(self,fp,object_expr:object,obj_name:str,indent:str):
   if object_expr in self.problematic:
    return
@@ -221,46 +217,29 @@ class Stubber():
   for c in chars:
    s=s.replace(c,"_")
   return s
- def clean(self,path:str=None):
-  if path is None:
-   path=self.path
-  print("Clean/remove files in folder: {}".format(path))
+ def clean(self,path:str=None,rename:bool=False):
+  createstubs_clean=load('createstubs_clean')
   try:
-   items=os.listdir(path)
-  except(OSError,AttributeError):
+   if rename:
+    createstubs_clean.retire(self,path)
+   else:
+    createstubs_clean.clean(self,path)
+  finally:
+   unload('createstubs_clean')
+ def purge(self):
+  if not self._retired:
    return
-  for fn in items:
-   try:
-    item="{}/{}".format(path,fn)
-    os.remove(item)
-   except OSError:
-    try:
-     self.clean(item)
-     os.rmdir(item)
-    except OSError:
-     pass
+  createstubs_clean=load('createstubs_clean')
+  try:
+   createstubs_clean.purge(self)
+  finally:
+   unload('createstubs_clean')
  def report(self,filename:str="modules.json"):
-  f_name="{}/{}".format(self.path,filename)
-  gc.collect()
+  createstubs_report=load('createstubs_report')
   try:
-   with open(f_name,'w')as f:
-    f.write('{')
-    f.write(dumps({'firmware':self.info})[1:-1])
-    f.write(',')
-    f.write(dumps({'stubber':{'version':stubber_version}})[1:-1])
-    f.write(',')
-    f.write('"modules" :[')
-    start=True
-    for n in self._report:
-     if start:
-      start=False
-     else:
-      f.write(',')
-     f.write(dumps(n))
-    f.write(']}')
-   used=self._start_free-gc.mem_free()
-  except OSError:
-   pass
+   createstubs_report.report(self,stubber_version,filename)
+  finally:
+   unload('createstubs_report')
  def ensure_folder(self,path:str):
   i=start=0
   while i!=-1:
@@ -295,17 +274,34 @@ class Stubber():
    else:
     r='/'
   return r
+def load(module_name:str):
+ try:
+  return __import__(module_name+'_mpy')
+ except ImportError:
+  return __import__(module_name)
+def unload(module_name:str):
+ sys.modules.pop(module_name,None)
+ sys.modules.pop(module_name+'_mpy',None)
+ gc.collect()
+def script_folder()->str:
+ try:
+  if '/' in __file__:
+   return __file__.rsplit('/',1)[0]
+ except NameError:
+  pass
+ return '.'
 def show_help():
  sys.exit(1)
 def read_path()->str:
  path=None
- if len(sys.argv)==3:
-  cmd=(sys.argv[1]).lower()
+ argv=[a for a in sys.argv if a!='--progress']
+ if len(argv)==3:
+  cmd=(argv[1]).lower()
   if cmd in('--path','-p'):
-   path =sys.argv[2]
+   path =argv[2]
   else:
    show_help()
- elif len(sys.argv)>=2:
+ elif len(argv)>=2:
   show_help()
  return path
 def isMicroPython()->bool:
@@ -320,9 +316,10 @@ def main():
   logging.basicConfig(level=logging.INFO)
  except NameError:
   pass
- stubber=Stubber(path=read_path())
+ stubber=Stubber(path=read_path(),progress='--progress' in sys.argv)
  stubber.clean()
  stubber.create_all_stubs()
  stubber.report()
+ stubber.purge()
 if __name__=="__main__" or isMicroPython():
  main()
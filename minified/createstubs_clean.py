@@ -0,0 +1,88 @@
+"""
+Clean phase of createstubs.py: remove the files from a previous run
+Copyright (c) 2019-2020 Jos Verlinde
+"""
+import uos as os
+S_IFDIR=0x4000
+BATCH=20
+def exists(path:str)->bool:
+ try:
+  os.stat(path)
+  return True
+ except OSError:
+  return False
+def is_folder(path:str)->bool:
+ return os.stat(path)[0]&S_IFDIR==S_IFDIR
+def list_batch(folder:str,skip=None):
+ files=[]
+ try:
+  entries=os.ilistdir(folder)
+  for entry in entries:
+   if entry[0]in('.','..'):
+    continue
+   if skip and "{}/{}".format(folder,entry[0])in skip:
+    continue
+   if entry[1]&S_IFDIR:
+    return None,entry[0]
+   files.append(entry[0])
+   if len(files)==BATCH:
+    break
+ except AttributeError:
+  for fn in os.listdir(folder):
+   if skip and "{}/{}".format(folder,fn)in skip:
+    continue
+   if is_folder("{}/{}".format(folder,fn)):
+    return None,fn
+   files.append(fn)
+   if len(files)==BATCH:
+    break
+ return files,None
+def remove_tree(stubber,path:str,keep_root:bool=True):
+ if not exists(path):
+  return
+ stack=[path]
+ failed=set()
+ while stack:
+  folder=target=stack[-1]
+  try:
+   files,sub=list_batch(folder,failed)
+   if sub:
+    stack.append("{}/{}".format(folder,sub))
+   elif files:
+    for fn in files:
+     target="{}/{}".format(folder,fn)
+     os.remove(target)
+   else:
+    stack.pop()
+    if stack or not keep_root:
+     os.rmdir(folder)
+  except OSError as e:
+   failed.add(target)
+   if stack and stack[-1]==target:
+    stack.pop()
+def clean(stubber,path:str=None):
+ if path is None:
+  path=stubber.path
+ print("Clean/remove files in folder: {}".format(path))
+ remove_tree(stubber,path)
+def retire(stubber,path:str=None):
+ if path is None:
+  path=stubber.path
+ if not exists(path):
+  return
+ n=0
+ old=path+'_old'
+ while exists(old):
+  n+=1
+  old="{}_old{}".format(path,n)
+ try:
+  os.rename(path,old)
+ except OSError:
+  clean(stubber,path)
+  return
+ stubber._retired.append(old)
+ stubber.ensure_folder(path+"/")
+def purge(stubber):
+ while stubber._retired:
+  old=stubber._retired.pop()
+  remove_tree(stubber,old,keep_root=False)
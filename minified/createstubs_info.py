@@ -0,0 +1,62 @@
+"""
+Detection phase of createstubs.py: collect base information on this runtime
+Copyright (c) 2019-2020 Jos Verlinde
+"""
+import sys
+import uos as os
+def info():
+ info={'name':sys.implementation.name,'release':'0.0.0','version':'0.0.0','build':'','sysname':'unknown','nodename':'unknown','machine':'unknown','family':sys.implementation.name,'platform':sys.platform,'port':sys.platform,'ver':''}
+ try:
+  info['release']=".".join([str(i)for i in sys.implementation.version])
+  info['version']=info['release']
+  info['name']=sys.implementation.name
+  info['mpy']=sys.implementation.mpy
+ except AttributeError:
+  pass
+ if sys.platform not in('unix','win32'):
+  try:
+   u=os.uname()
+   info['sysname']=u.sysname
+   info['nodename']=u.nodename
+   info['release']=u.release
+   info['machine']=u.machine
+   if ' on ' in u.version:
+    s=u.version.split('on ')[0]
+    try:
+     info['build']=s.split('-')[1]
+    except IndexError:
+     pass
+  except(IndexError,AttributeError,TypeError):
+   pass
+ try:
+  from pycopy import const
+  info['family']='pycopy'
+  del const
+ except(ImportError,KeyError):
+  pass
+ if info['platform']=='esp32_LoBo':
+  info['family']='loboris'
+  info['port']='esp32'
+ elif info['sysname']=='ev3':
+  info['family']='ev3-pybricks'
+  info['release']="1.0.0"
+  try:
+   from pybricks.hubs import EV3Brick
+   info['release']="2.0.0"
+  except ImportError:
+   pass
+ if info['release']:
+  info['ver']='v'+info['release']
+ if info['family']!='loboris':
+  if info['release']and info['release']>='1.10.0' and info['release'].endswith('.0'):
+   info['ver']=info['release'][:-2]
+  else:
+   info['ver']=info['release']
+  if info['build']!='':
+   info['ver']+='-'+info['build']
+ if 'mpy' in info: 
+  sys_mpy=info['mpy']
+  arch=[None,'x86','x64','armv6','armv6m','armv7m','armv7em','armv7emsp','armv7emdp','xtensa','xtensawin'][sys_mpy>>10]
+  if arch:
+   info['arch']=arch
+ return info
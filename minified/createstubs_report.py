@@ -0,0 +1,28 @@
+"""
+Report phase of createstubs.py: write the module manifest
+Copyright (c) 2019-2020 Jos Verlinde
+"""
+import gc
+from ujson import dumps
+def report(stubber,version:str,filename:str="modules.json"):
+ f_name="{}/{}".format(stubber.path,filename)
+ gc.collect()
+ try:
+  with open(f_name,'w')as f:
+   f.write('{')
+   f.write(dumps({'firmware':stubber.info})[1:-1])
+   f.write(',')
+   f.write(dumps({'stubber':{'version':version}})[1:-1])
+   f.write(',')
+   f.write('"modules" :[')
+   start=True
+   for n in stubber._report:
+    if start:
+     start=False
+    else:
+     f.write(',')
+    f.write(dumps(n))
+   f.write(']}')
+  used=stubber._start_free-gc.mem_free()
+ except OSError:
+  pass
@@ -4,8 +4,12 @@
 """Pre/Post Processing for createstubs.py"""
 import argparse
 import itertools
+import os
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
 from optparse import Values
 from pathlib import Path
 
@@ -20,7 +24,18 @@ except ImportError:
 ROOT = Path(__file__).parent
 SCRIPT = ROOT / 'board' / 'createstubs.py'
 DEST = ROOT / 'minified' / 'createstubs.py'
+# phase modules and data files used by createstubs.py, kept next to it
+PHASES = ['createstubs_info.py', 'createstubs_clean.py', 'createstubs_report.py']
+DATA = ['modulelist.txt']
 PATCHES = ROOT / 'patches'
+MPY_CROSS = 'mpy-cross'
+MICROPYTHON = ROOT / 'tools' / 'micropython'
+
+# Same table as Stubber._info() in createstubs.py,
+# indexed by sys.implementation.mpy >> 10
+MPY_ARCHS = [None, 'x86', 'x64', 'armv6', 'armv6m',
+             'armv7m', 'armv7em', 'armv7emsp', 'armv7emdp',
+             'xtensa', 'xtensawin']
 
 
 def apply_patch(s, patch, revert=False):
@@ -76,6 +91,7 @@ def edit_lines(content, edits, show_diff=False):
                 comment - comment text out (removed on minify)
                 rprint - replace text with print
                 rpass - replace text with pass
+                keep - keep the line as it is, the edits after it are not tried
             The second string is the matching text to replace
         show_diff (bool, optional): Prints diff of each edit.
             Defaults to False.
@@ -99,7 +115,9 @@ def edit_lines(content, edits, show_diff=False):
         """Get whitespace count of lines surrounding index"""
         def count_ws(line):
             return sum(1 for _ in itertools.takewhile(str.isspace, line))
-        lines = content[index - 1:index+2]
+        # the first or last line has no neighbour on that side
+        lines = [content[i] if 0 <= i < len(content) else ''
+                 for i in range(index - 1, index + 2)]
         context = (count_ws(l) for l in lines)
         return context
 
@@ -167,6 +185,8 @@ def edit_lines(content, edits, show_diff=False):
         _line = line
         for edit, text in edits:
             if text in line:
+                if edit == "keep":
+                    break
                 if edit == "comment":
                     l_index = content.index(line)
                     # Check if edit spans multiple lines
@@ -194,7 +214,7 @@ def edit_lines(content, edits, show_diff=False):
     return stripped
 
 
-def minify_script(patches=None, keep_report=True, show_diff=False):
+def minify_script(patches=None, keep_report=True, show_diff=False, script=SCRIPT):
     """minifies createstubs.py
 
     Args:
@@ -203,12 +223,16 @@ def minify_script(patches=None, keep_report=True, show_diff=False):
         keep_report (bool, optional): Keeps single report line in createstubs
             Defautls to True.
         show_diff (bool, optional): Print diff from edits. Defaults to False.
+        script (PathLike, optional): createstubs.py or one of its phase modules.
+            Defaults to SCRIPT.
 
     Returns:
         str: minified source text
     """
     patches = patches or []
     edits = [
+        # the progress events are the output of --progress
+        ("keep", "print(PROGRESS"),
         ("comment", "print"),
         ("comment", "import logging"),
         ("comment", "self._log ="),
@@ -216,17 +240,22 @@ def minify_script(patches=None, keep_report=True, show_diff=False):
         ("comment", "self._log.warning"),
         ("comment", "self._log.info"),
         ("comment", "self._log.error"),
+        # phase modules log through the stubber
+        ("comment", "stubber._log.debug"),
+        ("comment", "stubber._log.warning"),
+        ("comment", "stubber._log.info"),
+        ("comment", "stubber._log.error"),
     ]
     if keep_report:
         report = ('rprint', ('self._log.info("Stub module: {:<20} to file:'
                              ' {:<55} mem:{:>5}".'
                              'format(module_name, file_name, m1))'))
-        clean = ('rprint', 'self._log.info("Clean/remove files in folder: {}".format(path))')
-        edits.insert(0, report)
-        edits.insert(1, clean)
+        clean = ('rprint', 'stubber._log.info("Clean/remove files in folder: {}".format(path))')
+        edits.insert(1, report)
+        edits.insert(2, clean)
 
     minopts = Values({'tabs': False})
-    with SCRIPT.open('r') as f:
+    with Path(script).open('r') as f:
         content = f.read()
         for path in patches:
             path = Path(path)
@@ -260,6 +289,182 @@ def resolve_patches(patch_names):
     return paths
 
 
+def mpy_arch(sys_mpy):
+    """Get the mpy-cross architecture for a sys.implementation.mpy value
+
+    Args:
+        sys_mpy (int): sys.implementation.mpy as reported by the board,
+            also stored as firmware.mpy in modules.json
+
+    Returns:
+        str: architecture name, or None if the board has no native arch
+    """
+    try:
+        return MPY_ARCHS[int(sys_mpy) >> 10]
+    except IndexError:
+        return None
+
+
+def mpy_path(script):
+    """Path of the .mpy compiled from script
+
+    MicroPython imports a .py before a .mpy with the same name,
+    so the compiled version gets its own module name.
+    """
+    script = Path(script)
+    return script.with_name(script.stem + '_mpy.mpy')
+
+
+def phase_modules(script):
+    """Phase modules found next to createstubs.py"""
+    folder = Path(script).parent
+    return [folder / p for p in PHASES if (folder / p).exists()]
+
+
+def find_mpy_cross(mpy_cross=None):
+    """Locate the mpy-cross binary
+
+    Args:
+        mpy_cross (PathLike, optional): explicit path or name of mpy-cross.
+            Defaults to $MPY_CROSS or mpy-cross on the PATH.
+
+    Returns:
+        str: full path to mpy-cross, or None if not found
+    """
+    mpy_cross = mpy_cross or os.environ.get('MPY_CROSS', MPY_CROSS)
+    return shutil.which(str(mpy_cross))
+
+
+def mpy_cross_version(mpy_cross):
+    """Get the major .mpy version emitted by mpy-cross (or None)"""
+    result = subprocess.run([mpy_cross, '--version'],
+                            capture_output=True, text=True, check=False)
+    m = re.search(r"emitting mpy v(\d+)", result.stdout + result.stderr)
+    return int(m.group(1)) if m else None
+
+
+def compile_mpy(script, dest=None, arch=None, mpy_cross=None):
+    """Compile a script to .mpy bytecode using mpy-cross
+
+    Args:
+        script (PathLike): source to compile
+        dest (PathLike, optional): .mpy to write.
+            Defaults to mpy_path(script).
+        arch (str, optional): target architecture, one of MPY_ARCHS.
+        mpy_cross (PathLike, optional): mpy-cross to use.
+
+    Returns:
+        Path: the written .mpy file
+    """
+    script = Path(script)
+    dest = Path(dest) if dest else mpy_path(script)
+    cmd = [mpy_cross, '-s', script.name, '-o', str(dest)]
+    if arch:
+        cmd.append(f"-march={arch}")
+    cmd.append(str(script))
+    subprocess.run(cmd, check=True)
+    return dest
+
+
+def heap_used(script, micropython=MICROPYTHON):
+    """Heap allocated while loading script on the unix port
+
+    The garbage collector is disabled while loading, so the result
+    includes everything needed to compile a .py or load a .mpy.
+    createstubs is started with --help, which stops it before stubbing.
+    """
+    script = Path(script).resolve()
+    probe = "\n".join([
+        "import sys, gc",
+        "sys.argv[:] = ['createstubs.py', '--help']",
+        "gc.collect()",
+        "gc.disable()",
+        "m = gc.mem_alloc()",
+        "try:",
+        f"    __import__('{script.stem}')",
+        "except SystemExit:",
+        "    pass",
+        "print('heap_used', gc.mem_alloc() - m)",
+    ])
+    env = dict(os.environ, MICROPYPATH=os.pathsep.join(
+        [str(script.parent), str(ROOT / 'board')]))
+    with tempfile.TemporaryDirectory() as tmp:
+        result = subprocess.run([str(Path(micropython).resolve()), "-c", probe], cwd=tmp, env=env,
+                                capture_output=True, text=True, check=False)
+    m = re.search(r"heap_used (\d+)", result.stdout)
+    return int(m.group(1)) if m else None
+
+
+def resolve_arch(arch=None, sys_mpy=None):
+    """Select the target architecture from --arch or --mpy, exits if they differ"""
+    if sys_mpy is not None:
+        mpy = mpy_arch(sys_mpy)
+        if arch and arch != mpy:
+            print(f"--arch {arch} conflicts with --mpy {sys_mpy}, which selects arch: {mpy}")
+            print("Specify only one of them")
+            sys.exit(1)
+        arch = mpy
+        print(f"sys.implementation.mpy {sys_mpy} selects arch: {arch}")
+    return arch
+
+
+def resolve_mpy_cross(mpy_cross=None, sys_mpy=None):
+    """Validates/Provides help for mpy-cross"""
+    path = find_mpy_cross(mpy_cross)
+    if not path:
+        print("mpy-cross is required to compile createstubs.py\n")
+        print("Please install via:\n  pip install mpy-cross")
+        print("or specify its location using --mpy-cross or $MPY_CROSS")
+        sys.exit(1)
+    version = mpy_cross_version(path)
+    if sys_mpy is not None and version and version != int(sys_mpy) & 0xFF:
+        print(f"Warning: {path} emits mpy v{version},"
+              f" the board expects mpy v{int(sys_mpy) & 0xFF}")
+    return path
+
+
+def cli_compile(**kwargs):
+    """compile cli handler"""
+    print("\nCompiling createstubs.py to .mpy...")
+    sys_mpy = kwargs.pop('mpy')
+    arch = resolve_arch(kwargs.pop('arch'), sys_mpy)
+    mpy_cross = resolve_mpy_cross(kwargs.pop('mpy_cross'), sys_mpy)
+    variants = kwargs.pop('variants') or [SCRIPT, DEST]
+    for script in variants:
+        if not Path(script).exists():
+            print(f"Skipping {script}, not found")
+            continue
+        dest = compile_mpy(script, arch=arch, mpy_cross=mpy_cross)
+        print("Compiled file written to:", dest)
+        for phase in phase_modules(script):
+            dest = compile_mpy(phase, arch=arch, mpy_cross=mpy_cross)
+            print("Compiled file written to:", dest)
+    print("\nDone!")
+
+
+def cli_measure(**kwargs):
+    """measure cli handler"""
+    micropython = kwargs.pop('micropython')
+    variants = kwargs.pop('variants') or [SCRIPT, DEST]
+    print(f"\n{'file':<40} {'size':>8} {'heap':>8}")
+    for script in variants:
+        script = Path(script)
+        compiled = mpy_path(script)
+        used = {}
+        for f in (script, compiled):
+            if not f.exists():
+                continue
+            used[f] = heap_used(f, micropython)
+            heap = used[f] if used[f] is not None else '?'
+            print(f"{os.path.relpath(f, ROOT):<40} {f.stat().st_size:>8} {heap:>8}")
+        if used.get(script) and used.get(compiled):
+            saved = used[script] - used[compiled]
+            print(f"{'compile RAM saved by .mpy':<40} {'':>8} {saved:>8}"
+                  f" ({saved * 100 // used[script]}%)")
+    print("\nheap: bytes allocated to load the script on the unix port")
+    print("?   : failed to load, check that mpy-cross matches the firmware")
+
+
 def cli_patch(**kwargs):
     """apply patch cli handler"""
     print("Patching createstubs.py...")
@@ -286,17 +491,31 @@ def cli_minify(**kwargs):
         print("Please install via:\n  pip install pyminifier")
         sys.exit(1)
     patch_paths = resolve_patches(patches)
+    report = kwargs.pop('no_report')
+    diff = kwargs.pop('diff')
     with out.open('w+') as f:
-        report = kwargs.pop('no_report')
-        diff = kwargs.pop('diff')
         source = minify_script(
             patches=patch_paths,
             keep_report=report,
             show_diff=diff
         )
         f.write(source)
+    for phase in phase_modules(SCRIPT):
+        with (out.parent / phase.name).open('w+') as f:
+            f.write(minify_script(keep_report=report, show_diff=diff, script=phase))
+    for name in DATA:
+        shutil.copy2(SCRIPT.parent / name, out.parent / name)
     print("\nDone!")
     print("Minified file written to:", out)
+    if kwargs.pop('compile'):
+        sys_mpy = kwargs.pop('mpy')
+        arch = resolve_arch(kwargs.pop('arch'), sys_mpy)
+        mpy_cross = resolve_mpy_cross(kwargs.pop('mpy_cross'), sys_mpy)
+        dest = compile_mpy(out, arch=arch, mpy_cross=mpy_cross)
+        print("Compiled file written to:", dest)
+        for phase in phase_modules(out):
+            dest = compile_mpy(phase, arch=arch, mpy_cross=mpy_cross)
+            print("Compiled file written to:", dest)
 
 
 if __name__ == "__main__":
@@ -311,9 +530,30 @@ if __name__ == "__main__":
     )
     subparsers = parser.add_subparsers(help="Command to execute")
 
+    mpy_options = argparse.ArgumentParser(add_help=False)
+    mpy_options.add_argument(
+        "-a", "--arch",
+        help="Target architecture for mpy-cross",
+        choices=[a for a in MPY_ARCHS if a],
+        default=None
+    )
+    mpy_options.add_argument(
+        "--mpy",
+        help=("Select the architecture from sys.implementation.mpy"
+              " (as reported in modules.json)"),
+        type=int,
+        default=None
+    )
+    mpy_options.add_argument(
+        "--mpy-cross",
+        help="Path to mpy-cross. Defaults to $MPY_CROSS or mpy-cross on the PATH",
+        default=None
+    )
+
     minify_parser = subparsers.add_parser("minify",
                                           help=("Create minified version of"
-                                                " createstubs.py")
+                                                " createstubs.py"),
+                                          parents=[mpy_options]
                                           )
     minify_parser.add_argument(
         '-p', '--patch',
@@ -332,8 +572,44 @@ if __name__ == "__main__":
               " Use if your having memory related issues."),
         action="store_false"
     )
+    minify_parser.add_argument(
+        "-c", "--compile",
+        help="Also compile the minified version to .mpy using mpy-cross",
+        action='store_true'
+    )
     minify_parser.set_defaults(func=cli_minify)
 
+    compile_parser = subparsers.add_parser(
+        "compile",
+        help=("Compile createstubs.py variants and their phase modules to .mpy using mpy-cross."
+              " Each file is compiled to <name>_mpy.mpy, as import picks a .py over a .mpy with the same name;"
+              " createstubs loads the phase modules' _mpy versions first"),
+        parents=[mpy_options])
+    compile_parser.add_argument(
+        "variants",
+        help="Scripts to compile. Defaults to board and minified createstubs.py",
+        type=Path,
+        nargs='*',
+    )
+    compile_parser.set_defaults(func=cli_compile)
+
+    measure_parser = subparsers.add_parser(
+        "measure",
+        help="Measure the RAM needed to load the .py and .mpy variants")
+    measure_parser.add_argument(
+        "variants",
+        help="Scripts to measure. Defaults to board and minified createstubs.py",
+        type=Path,
+        nargs='*',
+    )
+    measure_parser.add_argument(
+        "-m", "--micropython",
+        help="MicroPython unix port to measure with. Defaults to ./tools/micropython",
+        type=Path,
+        default=MICROPYTHON
+    )
+    measure_parser.set_defaults(func=cli_measure)
+
     patch_parser = subparsers.add_parser(
         "patch",
         help=("Apply a patch to createstubs.py"))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Compact the all_stubs folder: move the stub files into a content-addressed store
+and replace the copies with hardlinks, or symlinks where hardlinks are not possible.
+"""
+# Copyright (c) 2020 Jos Verlinde
+# MIT license
+import argparse
+import logging
+import sys
+import utils
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the identical stub files of a stub folder through a content-addressed store")
+    parser.add_argument('folder', nargs='?', default=utils.STUB_FOLDER, help="the stub folder, default {}".format(utils.STUB_FOLDER))
+    parser.add_argument('-s', '--store', help="the object folder, default <folder>/{}".format(utils.OBJECT_FOLDER))
+    parser.add_argument('--no-gc', dest='gc', action='store_false', help="keep the objects that no file of the folder links to, for a store shared with other folders")
+    args = parser.parse_args()
+    result = utils.compact_folder(args.folder, args.store, gc=args.gc)
+    print("{files} files, {unique} unique, {removed} unused objects removed, {saved} bytes saved".format(**result))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)-8s:%(message)s', level=logging.INFO)
+    sys.exit(main())
@@ -18,8 +18,8 @@ import logging
 
 import basicgit as git
 
-import utils
 from utils import clean_version, stubfolder, flat_version
+from make_stub_files import make_stub_tree
 
 import get_cpython
 import get_mpy
@@ -54,7 +54,7 @@ def get_all():
 
     # now generate typeshed files for all scripts
     log.info("Generate type hint files (pyi) in folder: {}".format(STUB_FOLDER))
-    utils.make_stub_files(STUB_FOLDER, levels=7)
+    make_stub_tree(STUB_FOLDER, jobs=0)
 
 
 if __name__ == "__main__":
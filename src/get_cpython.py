@@ -40,6 +40,7 @@ def get_core(requirements, stub_path=None):
             f_name, f_ext = os.path.splitext(os.path.basename(filename)) #pylint: disable=unused-variable
             mod_manifest['modules'].append({"file": os.path.basename(filename), "module":f_name})
             try:
+                utils.unshare(os.path.join(stub_path, os.path.basename(filename)))
                 shutil.copy2(filename, stub_path)
             except OSError as err:
                 log.exception(err)
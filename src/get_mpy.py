@@ -125,6 +125,7 @@ def freezedry(path, script):
         os.makedirs(dest_path, exist_ok=True)
         # copy file
         try:
+            utils.unshare(os.path.join(dest_path, os.path.basename(script)))
             shutil.copy2(script_path, dest_path)
         except OSError as e:
             log.exception(e)
@@ -221,6 +222,7 @@ def get_frozen_folders(stub_path: str, mpy_path: str, lib_path: str, version:str
         # ensure folder, including possible path prefix for script todo:
         os.makedirs(dest_path, exist_ok=True)
         # copy file
+        utils.unshare(os.path.join(dest_path, os.path.basename(script)))
         shutil.copy2(script, dest_path)
         if not dest_path in targets:
             targets.append(dest_path)
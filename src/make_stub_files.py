@@ -18,10 +18,16 @@ from collections import OrderedDict
     # the configparser will give random order for patterns.
 
 import configparser # Python 3
+import contextlib
+import functools
 import glob
+import hashlib
+import json
+import keyword
 #Todo: Depricated , replace with argparse  https://docs.python.org/3/library/argparse.html
 import optparse 
 import os
+import pickle
 import re
 import subprocess
 import sys
@@ -31,6 +37,7 @@ import io # Python 3
 
 isPython3 = sys.version_info >= (3, 0, 0)
 debug_flag = False
+def_node_types = (ast.FunctionDef, ast.AsyncFunctionDef)
 
 def is_known_type(s):
     '''
@@ -59,7 +66,25 @@ def reduce_types(aList, name=None, trace=False):
     The --trace-reduce command-line option sets trace=True.
     If present, name is the function name or class_name.method_name.
     '''
-    return ReduceTypes(aList, name, trace).reduce_types()
+    reducer = ReduceTypes(aList, name, trace)
+    s, reducer.optional = reduce_types_cache(tuple(aList))
+    return reducer.show(s)
+
+@functools.lru_cache(maxsize=4096)
+def reduce_types_cache(key):
+    '''
+    Return (s, optional) for ReduceTypes.reduce of the types in tuple key.
+    The same lists of types repeat for many functions.
+    '''
+    reducer = ReduceTypes(list(key))
+    s = reducer.reduce()
+    return s, reducer.optional
+
+def reduce_types_cache_info(hits, misses):
+    '''Return a line with the hit rate of reduce_types_cache.'''
+    calls = hits + misses
+    rate = 100.0 * hits / calls if calls else 0.0
+    return 'reduce_types cache: %s calls, %s hits, %4.1f%% hit rate' % (calls, hits, rate)
 
 
 # Top-level functions
@@ -98,6 +123,218 @@ def main():
     if not controller.silent:
         print('done')
 
+def file_hash(fn):
+    '''Return the sha256 of the contents of file fn.'''
+    with open(fn, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def unshare(fn):
+    '''
+    Remove file fn if it is linked to the store of utils.py,
+    so that writing it does not change the other copies.
+    '''
+    if os.path.islink(fn) or (os.path.isfile(fn) and os.stat(fn).st_nlink > 1):
+        os.remove(fn)
+
+# The controller of a process pool worker, see StandAloneMakeStubFile.run_jobs.
+job_controller = None
+
+def init_job(controller):
+    '''Process pool initializer: keep the controller for make_stub_job.'''
+    global job_controller
+    job_controller = controller
+
+def make_stub_job(fn):
+    '''
+    Process pool worker: make the stubs for fn.
+    Return (fn, s, error, elapsed, output, hits, misses),
+    output is what was printed, hits and misses are those of reduce_types_cache.
+    '''
+    t1 = time.perf_counter()
+    info = reduce_types_cache.cache_info()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        s, error = job_controller.make_stub_text(fn)
+    info2 = reduce_types_cache.cache_info()
+    return (fn, s, error, time.perf_counter() - t1, output.getvalue(),
+        info2.hits - info.hits, info2.misses - info.misses)
+
+def find_source_files(path, levels=None):
+    '''
+    Return the .py files in path and its sub folders, in sorted order.
+    Like glob, names starting with '.' are skipped.
+    levels limits the folder depth, 1 is path itself; None is any depth.
+    '''
+    result = []
+    todo = [(path, 1)]
+    while todo:
+        folder, level = todo.pop()
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        subfolders = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                if levels is None or level < levels:
+                    subfolders.append((entry.path, level + 1))
+            elif entry.name.endswith('.py') and entry.is_file():
+                result.append(entry.path)
+        # depth first, in name order
+        todo.extend(reversed(subfolders))
+    return result
+
+# The cache file that make_stub_tree keeps in the root of the tree.
+CACHE_FN = '.make_stub_files.json'
+
+def make_stub_tree(path, config_fn=None, levels=None, update=True, overwrite=False, silent=True, jobs=1, cache=True, dedup=True, stats=None):
+    '''
+    Make stub files for all .py files in the tree below path, in-process.
+    The controller and its pattern tables are created once and used for every file.
+    With cache, files that did not change since the last run are skipped.
+    With dedup, the stubs are made once for files with the same content.
+    If stats is a dict, it is updated with the numbers of regenerated, skipped and failed files.
+    Return the number of source files.
+    '''
+    controller = StandAloneMakeStubFile()
+    controller.config_fn = config_fn or os.path.join(os.path.dirname(__file__), 'make_stub_files.cfg')
+    controller.update_flag = update
+    controller.overwrite = overwrite
+    controller.silent = silent
+    controller.jobs = jobs
+    controller.dedup = dedup
+    if cache:
+        controller.cache_fn = os.path.join(controller.finalize(path), CACHE_FN)
+    controller.scan_options()
+    controller.files = [controller.finalize(z) for z in find_source_files(path, levels)]
+    controller.run()
+    if stats is not None:
+        stats.update(controller.stats)
+    return len(controller.files)
+
+def compile_config(s=''):
+    '''
+    Return a StandAloneMakeStubFile holding the prefix lines and patterns of
+    s, the text of a configuration file, for make_stub_string.
+    '''
+    controller = StandAloneMakeStubFile()
+    controller.scan_config_string(s)
+    return controller
+
+def compile_config_file(fn=None):
+    '''compile_config for the file fn, by default the make_stub_files.cfg next to this file.'''
+    fn = fn or os.path.join(os.path.dirname(__file__), 'make_stub_files.cfg')
+    with open(fn, 'r') as f:
+        return compile_config(f.read())
+
+def make_stub_string(source, config=None, pyi=None, fn='<string>'):
+    '''
+    Return the text of the stub file for source, the text of a .py file.
+    config is the result of compile_config, pyi is None or the text of an
+    existing stub file to update. fn is only used in syntax errors.
+    Reads and writes no files, and changes only config.match_cache:
+    the matches of the patterns are cached there, and shared by all the
+    calls with the same config.
+    '''
+    if config is None:
+        config = compile_config()
+    if pyi is None:
+        s = make_board_stub_string(source, config)
+        if s is not None:
+            return s
+    node = ast.parse(source, filename=fn, mode='exec')
+    return StubTraverser(controller=config).make_stub_text(node, pyi)
+
+# A line of the .py files that createstubs.py writes on the board.
+board_stub_line = re.compile(r"""(\ *)(?:
+    class\ (?P<class>[^\W\d]\w*):
+    | def\ (?P<def>[^\W\d]\w*)\((?P<self>self)?\):
+    | (?P<pass>pass)
+    | (?P<doc>''|"")
+    | (?P<assign>[^\W\d]\w*)\ =\ (?:None|-?(?:0|[1-9]\d*)(?:\.\d*)?(?:e[-+]?\d+)?|-?inf|nan|'[^'\\]*'|"[^"\\]*")
+    )$""", re.VERBOSE)
+
+def make_board_stub_string(source, config):
+    '''
+    Return the text of the stub file for source, a .py file written by
+    createstubs.py, or None if source does not follow its template:
+    top-level classes, defs without arguments or with only self, whose
+    body is pass, and assignments, which are not stubbed.
+    This is the text that make_stub_string makes for such files,
+    without parsing them: the defs have no return statements.
+    '''
+    if config.trace_matches or config.trace_reduce or config.trace_visitors:
+        return None
+    if '\r' in source:
+        # A newline for Python, but not for split.
+        return None
+    lines = source.split('\n')
+    i = 0
+    # The module docstring.
+    if lines[0] == '"""':
+        i = next((j for j, z in enumerate(lines) if j and '"""' in z), None)
+        if i is None or lines[i] != '"""' or any('\\' in z for z in lines[1:i]):
+            return None
+        i += 1
+    result = [z.rstrip() for z in config.prefix_lines or []]
+    names = set()
+    class_i = class_name = None
+    # The (kind, level) of the lines expected next: the body of a class or def.
+    expect = None
+    for line in lines[i:]:
+        stripped = line.lstrip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        m = board_stub_line.match(line)
+        if not m:
+            return None
+        level, r = divmod(len(m.group(1)), 4)
+        kind = m.lastgroup if m.lastgroup != 'self' else 'def'
+        if r or level > 2:
+            return None
+        if level == 0:
+            class_i = class_name = None
+        if expect:
+            if (kind, level) not in expect:
+                return None
+        elif kind in ('pass', 'def', 'assign', 'doc') and level > (1 if class_i is not None else 0):
+            return None
+        elif kind in ('pass', 'class') and level > 0:
+            return None
+        expect = None
+        if kind == 'class':
+            name = m.group('class')
+            if not is_name(name) or name.startswith('_') or name in names:
+                return None
+            names.add(name)
+            class_i, class_name = len(result), name
+            result.append('class %s: ...' % name)
+            expect = (('doc', 1), ('def', 1))
+        elif kind == 'def':
+            name = m.group('def')
+            key = '%s.%s' % (class_name, name) if level else name
+            # make_stub_string reports duplicates.
+            if not is_name(name) or key in names:
+                return None
+            names.add(key)
+            if level:
+                result[class_i] = 'class %s:' % class_name
+            result.append('%sdef %s(%s) -> None: ...' % (
+                '    ' * level, name, m.group('self') or ''))
+            expect = (('doc', level + 1), ('pass', level + 1))
+        elif kind == 'doc' and (level == 2 or class_i is None):
+            # The docstring of a def.
+            expect = (('pass', level),)
+        elif kind == 'assign' and not is_name(m.group('assign')):
+            return None
+    if expect:
+        return None
+    return ''.join(z + '\n' for z in result)
+
+def is_name(s):
+    '''Return True if s can be the name of a class, def or variable.'''
+    return s.isidentifier() and not keyword.iskeyword(s)
+
 
 # def pdb(self):
 #     pass
@@ -114,15 +351,76 @@ def truncate(s, n):
     '''Return s truncated to n characters.'''
     return s if len(s) <= n else s[:n-3] + '...'
 
+class TraceLog(object):
+    '''
+    Write trace events to a file, one json object per line.
+    The file is opened on the first event, in append mode, so that
+    the processes of a --jobs run can share it.
+    '''
+
+    def __init__ (self, fn):
+        '''Ctor for the TraceLog class.'''
+        self.fn = fn
+        self.f = None
+
+    def __getstate__(self):
+        '''Open files can not be sent to another process.'''
+        return {'fn': self.fn, 'f': None}
+
+    def clear(self):
+        '''Empty the file.'''
+        self.close()
+        open(self.fn, 'w').close()
+
+    def close(self):
+        '''Close the file.'''
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def event(self, ev, **values):
+        '''Write an event with the given values.'''
+        if not self.f:
+            self.f = open(self.fn, 'a')
+        values['ev'] = ev
+        self.f.write(json.dumps(values) + '\n')
+        self.f.flush()
+
 
 class AstFormatter:
     '''
     A class to recreate source code from an AST.
     
     This does not have to be perfect, but it should be close.
+
+    visit dispatches with a table built once per class: keys are ast node
+    classes, values are the do_ methods of the class. The do_ methods must
+    be defined in the class body; methods patched on an instance are not seen.
     '''
     # pylint: disable=consider-using-enumerate
     level = 0
+    dispatch = {}
+        # Set by make_dispatch for AstFormatter and each subclass.
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.dispatch = cls.make_dispatch()
+
+    @classmethod
+    def make_dispatch(cls):
+        '''
+        Return a dict whose keys are ast node classes and whose values are
+        the do_ methods of cls for those classes.
+        '''
+        d = {}
+        todo = [ast.AST]
+        while todo:
+            node_class = todo.pop()
+            todo.extend(node_class.__subclasses__())
+            method = getattr(cls, 'do_' + node_class.__name__, None)
+            if method:
+                d [node_class] = method
+        return d
 
     # Entries...
 
@@ -135,30 +433,23 @@ class AstFormatter:
 
     def visit(self, node):
         '''Return the formatted version of an Ast node, or list of Ast nodes.'''
-        if isinstance(node, (list, tuple)):
+        method = self.dispatch.get(node.__class__)
+        if method:
+            s = method(self, node)
+            assert isinstance(s, str), type(s)
+            return s
+        elif isinstance(node, (list, tuple)):
             return ','.join([self.visit(z) for z in node])
         elif node is None:
             return 'None'
         else:
             assert isinstance(node, ast.AST), node.__class__.__name__
-            method_name = 'do_' + node.__class__.__name__
-            try:
-                method = getattr(self, method_name)
-            except AttributeError:
-                return ''
-                
-            s = method(node)
-            # assert type(s) == type('abc'), (node, type(s))
-            assert g.isString(s), type(s)
-            return s
+            return ''
 
     # Contexts...
 
-    # 2: ClassDef(identifier name, expr* bases,
-    #             stmt* body, expr* decorator_list)
-    # 3: ClassDef(identifier name, expr* bases,
-    #             keyword* keywords, expr? starargs, expr? kwargs
-    #             stmt* body, expr* decorator_list)
+    # ClassDef(identifier name, expr* bases, keyword* keywords,
+    #          stmt* body, expr* decorator_list)
     #
     # keyword arguments supplied to call (NULL identifier for **kwargs)
     # keyword = (identifier? arg, expr value)
@@ -166,17 +457,12 @@ class AstFormatter:
     def do_ClassDef(self, node):
         result = []
         name = node.name # Only a plain string is valid.
-        bases = [self.visit(z) for z in node.bases] if node.bases else []
-        if getattr(node, 'keywords', None): # Python 3
-            for keyword in node.keywords:
-                bases.append('%s=%s' % (keyword.arg, self.visit(keyword.value)))
-        if getattr(node, 'starargs', None): # Python 3
-            bases.append('*%s', self.visit(node.starargs))
-        if getattr(node, 'kwargs', None): # Python 3
-            bases.append('*%s', self.visit(node.kwargs))
+        bases = [self.visit(z) for z in node.bases]
+        for keyword in node.keywords:
+            bases.append(self.visit(keyword))
         #
         # Fix issue #2: look ahead to see if there are any functions in this class.
-        empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
+        empty = not any(isinstance(z, def_node_types) for z in node.body)
         tail = ' ...' if empty else ''
         if bases:
             result.append(self.indent('class %s(%s):%s\n' % (name, ','.join(bases), tail)))
@@ -190,23 +476,22 @@ class AstFormatter:
         return ''.join(result)
 
 
-    # 2: FunctionDef(identifier name, arguments args, stmt* body, expr* decorator_list)
-    # 3: FunctionDef(identifier name, arguments args, stmt* body, expr* decorator_list,
-    #                expr? returns)
+    # FunctionDef(identifier name, arguments args, stmt* body, expr* decorator_list,
+    #             expr? returns)
+    # AsyncFunctionDef: the same fields.
 
-    def do_FunctionDef(self, node):
-        '''Format a FunctionDef node.'''
+    def do_FunctionDef(self, node, keyword='def'):
+        '''Format a FunctionDef or AsyncFunctionDef node.'''
         result = []
-        if node.decorator_list:
-            for z in node.decorator_list:
-                result.append('@%s\n' % self.visit(z))
+        for z in node.decorator_list:
+            result.append(self.indent('@%s\n' % self.visit(z)))
         name = node.name # Only a plain string is valid.
         args = self.visit(node.args) if node.args else ''
-        if getattr(node, 'returns', None): # Python 3.
+        if node.returns:
             returns = self.visit(node.returns)
-            result.append(self.indent('def %s(%s): -> %s\n' % (name, args, returns)))
+            result.append(self.indent('%s %s(%s) -> %s:\n' % (keyword, name, args, returns)))
         else:
-            result.append(self.indent('def %s(%s):\n' % (name, args)))
+            result.append(self.indent('%s %s(%s):\n' % (keyword, name, args)))
         for z in node.body:
             self.level += 1
             result.append(self.visit(z))
@@ -214,9 +499,12 @@ class AstFormatter:
         return ''.join(result)
 
 
+    def do_AsyncFunctionDef(self, node):
+        return self.do_FunctionDef(node, 'async def')
+
+
     def do_Interactive(self, node):
-        for z in node.body:
-            self.visit(z)
+        return ''.join([self.visit(z) for z in node.body])
 
 
     def do_Module(self, node):
@@ -259,25 +547,21 @@ class AstFormatter:
     def do_Load(self, node):
         return 'Load'
 
-    def do_Param(self, node):
-        return 'Param'
-
     def do_Store(self, node):
         return 'Store'
 
     # Operands...
 
 
-    # 2: arguments = (expr* args, identifier? vararg, identifier? kwarg, expr* defaults)
-    # 3: arguments = (arg*  args, arg? vararg,
-    #                arg* kwonlyargs, expr* kw_defaults,
-    #                arg? kwarg, expr* defaults)
+    # arguments = (arg* posonlyargs, arg* args, arg? vararg, arg* kwonlyargs,
+    #              expr* kw_defaults, arg? kwarg, expr* defaults)
 
     def do_arguments(self, node):
         '''Format the arguments node.'''
         kind = self.kind(node)
         assert kind == 'arguments', kind
-        args = [self.visit(z) for z in node.args]
+        posonlyargs = getattr(node, 'posonlyargs', []) # Python 3.8
+        args = [self.visit(z) for z in posonlyargs + node.args]
         defaults = [self.visit(z) for z in node.defaults]
         # Assign default values to the last args.
         args2 = []
@@ -287,29 +571,24 @@ class AstFormatter:
                 args2.append(args[i])
             else:
                 args2.append('%s=%s' % (args[i], defaults[i - n_plain]))
-        if isPython3:
-            args  = [self.visit(z) for z in node.kwonlyargs]
-            defaults = [self.visit(z) for z in node.kw_defaults]
-            n_plain = len(args) - len(defaults)
-            for i in range(len(args)):
-                if i < n_plain:
-                    args2.append(args[i])
-                else:
-                    args2.append('%s=%s' % (args[i], defaults[i - n_plain]))
-            # Add the vararg and kwarg expressions.
-            vararg = getattr(node, 'vararg', None)
-            if vararg: args2.append('*' + self.visit(vararg))
-            kwarg = getattr(node, 'kwarg', None)
-            if kwarg: args2.append('**' + self.visit(kwarg))
-        else: # OLD PYTHON 2.x code 
-            # Add the vararg and kwarg names.
-            name = getattr(node, 'vararg', None)
-            if name: args2.append('*' + name)
-            name = getattr(node, 'kwarg', None)
-            if name: args2.append('**' + name)
+            if i + 1 == len(posonlyargs):
+                args2.append('/')
+        # Add the vararg, or a bare * before keyword only args.
+        if node.vararg:
+            args2.append('*' + self.visit(node.vararg))
+        elif node.kwonlyargs:
+            args2.append('*')
+        # kw_defaults holds None for keyword only args without a default.
+        for arg, default in zip(node.kwonlyargs, node.kw_defaults):
+            if default is None:
+                args2.append(self.visit(arg))
+            else:
+                args2.append('%s=%s' % (self.visit(arg), self.visit(default)))
+        if node.kwarg:
+            args2.append('**' + self.visit(node.kwarg))
         return ','.join(args2)
 
-    # 3: arg = (identifier arg, expr? annotation)
+    # arg = (identifier arg, expr? annotation)
 
     def do_arg(self, node):
         if getattr(node, 'annotation', None):
@@ -325,11 +604,13 @@ class AstFormatter:
             node.attr) # Don't visit node.attr: it is always a string.
 
 
-    def do_Bytes(self, node): # Python 3.x only.
-        return str(node.s)
+    # Await(expr value)
+
+    def do_Await(self, node):
+        return 'await %s' % self.visit(node.value)
 
 
-    # Call(expr func, expr* args, keyword* keywords, expr? starargs, expr? kwargs)
+    # Call(expr func, expr* args, keyword* keywords)
 
     def do_Call(self, node):
         func = self.visit(node.func)
@@ -337,19 +618,17 @@ class AstFormatter:
         for z in node.keywords:
             # Calls f.do_keyword.
             args.append(self.visit(z))
-        if getattr(node, 'starargs', None):
-            args.append('*%s' % (self.visit(node.starargs)))
-        if getattr(node, 'kwargs', None):
-            args.append('**%s' % (self.visit(node.kwargs)))
         args = [z for z in args if z] # Kludge: Defensive coding.
         return '%s(%s)' % (func, ','.join(args))
 
 
-    # keyword = (identifier arg, expr value)
+    # keyword = (identifier? arg, expr value)
 
     def do_keyword(self, node):
-        # node.arg is a string.
+        # node.arg is a string, or None for **kwargs.
         value = self.visit(node.value)
+        if node.arg is None:
+            return '**%s' % value
         # This is a keyword *arg*, not a Python keyword!
         return '%s=%s' % (node.arg, value)
 
@@ -365,6 +644,15 @@ class AstFormatter:
         return ''.join(result)
 
 
+    # Constant(constant value, string? kind)
+
+    def do_Constant(self, node):
+        '''A number, string, bytes, bool, None or Ellipsis.'''
+        if node.value is Ellipsis:
+            return '...'
+        return repr(node.value)
+
+
     def do_Dict(self, node):
         result = []
         keys = [self.visit(z) for z in node.keys]
@@ -385,18 +673,51 @@ class AstFormatter:
         return ''.join(result)
 
 
-    def do_Ellipsis(self, node):
-        return '...'
+    def do_DictComp(self, node):
+        key = self.visit(node.key)
+        value = self.visit(node.value)
+        gens = [self.visit(z) for z in node.generators]
+        return '{%s:%s for %s}' % (key, value, ''.join(gens))
+
 
+    # Python 3.8 only.
 
     def do_ExtSlice(self, node):
         return ':'.join([self.visit(z) for z in node.dims])
 
 
+    # FormattedValue(expr value, int conversion, expr? format_spec)
+
+    def do_FormattedValue(self, node):
+        conversion = '!' + chr(node.conversion) if node.conversion != -1 else ''
+        spec = ':' + self.f_string_text(node.format_spec) if node.format_spec else ''
+        return '{%s%s%s}' % (self.visit(node.value), conversion, spec)
+
+
+    # Python 3.8 only.
+
     def do_Index(self, node):
         return self.visit(node.value)
 
 
+    # JoinedStr(expr* values)
+
+    def do_JoinedStr(self, node):
+        '''An f-string.'''
+        return 'f' + repr(self.f_string_text(node))
+
+
+    def f_string_text(self, node):
+        '''Return the text of a JoinedStr node, without the quotes.'''
+        result = []
+        for z in node.values:
+            if isinstance(z, ast.Constant):
+                result.append(z.value.replace('{', '{{').replace('}', '}}'))
+            else:
+                result.append(self.visit(z))
+        return ''.join(result)
+
+
     def do_List(self, node):
         # Not used: list context.
         # self.visit(node.ctx)
@@ -415,19 +736,21 @@ class AstFormatter:
     def do_Name(self, node):
         return node.id
 
-    def do_NameConstant(self, node): # Python 3 only.
-        s = repr(node.value)
-        return 'bool' if s in ('True', 'False') else s
 
+    # NamedExpr(expr target, expr value)
 
-    def do_Num(self, node):
-        return repr(node.n)
+    def do_NamedExpr(self, node):
+        return '(%s := %s)' % (self.visit(node.target), self.visit(node.value))
 
 
-    # Python 2.x only
+    def do_Set(self, node):
+        return '{%s}' % ','.join([self.visit(z) for z in node.elts])
 
-    def do_Repr(self, node):
-        return 'repr(%s)' % self.visit(node.value)
+
+    def do_SetComp(self, node):
+        elt = self.visit(node.elt)
+        gens = [self.visit(z) for z in node.generators]
+        return '{%s for %s}' % (elt, ''.join(gens))
 
 
     def do_Slice(self, node):
@@ -444,11 +767,6 @@ class AstFormatter:
             return '%s:%s' % (lower, upper)
 
 
-    def do_Str(self, node):
-        '''This represents a string constant.'''
-        return repr(node.s)
-
-
     # Subscript(expr value, slice slice, expr_context ctx)
 
     def do_Subscript(self, node):
@@ -506,6 +824,15 @@ class AstFormatter:
     # Statements...
 
 
+    # AnnAssign(expr target, expr annotation, expr? value, int simple)
+
+    def do_AnnAssign(self, node):
+        s = '%s: %s' % (self.visit(node.target), self.visit(node.annotation))
+        if node.value:
+            s = '%s=%s' % (s, self.visit(node.value))
+        return self.indent(s + '\n')
+
+
     def do_Assert(self, node):
         test = self.visit(node.test)
         if getattr(node, 'msg', None):
@@ -541,16 +868,15 @@ class AstFormatter:
         return self.indent('del %s\n' % ','.join(targets))
 
 
-    def do_ExceptHandler(self, node):
+    # ExceptHandler(expr? type, identifier? name, stmt* body)
+
+    def do_ExceptHandler(self, node, keyword='except'):
         result = []
-        result.append(self.indent('except'))
+        result.append(self.indent(keyword))
         if getattr(node, 'type', None):
             result.append(' %s' % self.visit(node.type))
         if getattr(node, 'name', None):
-            if isinstance(node.name, ast.AST):
-                result.append(' as %s' % self.visit(node.name))
-            else:
-                result.append(' as %s' % node.name) # Python 3.x.
+            result.append(' as %s' % node.name)
         result.append(':\n')
         for z in node.body:
             self.level += 1
@@ -559,25 +885,13 @@ class AstFormatter:
         return ''.join(result)
 
 
-    # Python 2.x only
-
-    def do_Exec(self, node):
-        body = self.visit(node.body)
-        args = [] # Globals before locals.
-        if getattr(node, 'globals', None):
-            args.append(self.visit(node.globals))
-        if getattr(node, 'locals', None):
-            args.append(self.visit(node.locals))
-        if args:
-            return self.indent('exec %s in %s\n' % (
-                body, ','.join(args)))
-        else:
-            return self.indent('exec %s\n' % (body))
-
+    # For(expr target, expr iter, stmt* body, stmt* orelse)
+    # AsyncFor: the same fields.
 
-    def do_For(self, node):
+    def do_For(self, node, keyword='for'):
         result = []
-        result.append(self.indent('for %s in %s:\n' % (
+        result.append(self.indent('%s %s in %s:\n' % (
+            keyword,
             self.visit(node.target),
             self.visit(node.iter))))
         for z in node.body:
@@ -593,6 +907,10 @@ class AstFormatter:
         return ''.join(result)
 
 
+    def do_AsyncFor(self, node):
+        return self.do_For(node, 'async for')
+
+
     def do_Global(self, node):
         return self.indent('global %s\n' % (
             ','.join(node.names)))
@@ -645,10 +963,68 @@ class AstFormatter:
                 names.append('%s as %s' % (fn, asname))
             else:
                 names.append(fn)
-        return self.indent('from %s import %s\n' % (
-            node.module,
+        return self.indent('from %s%s import %s\n' % (
+            '.' * node.level,
+            node.module or '',
             ','.join(names)))
 
+
+    # Match(expr subject, match_case* cases): Python 3.10
+    # match_case = (pattern pattern, expr? guard, stmt* body)
+
+    def do_Match(self, node):
+        result = [self.indent('match %s:\n' % self.visit(node.subject))]
+        for z in node.cases:
+            self.level += 1
+            result.append(self.visit(z))
+            self.level -= 1
+        return ''.join(result)
+
+
+    def do_match_case(self, node):
+        guard = ' if %s' % self.visit(node.guard) if node.guard else ''
+        result = [self.indent('case %s%s:\n' % (self.visit(node.pattern), guard))]
+        for z in node.body:
+            self.level += 1
+            result.append(self.visit(z))
+            self.level -= 1
+        return ''.join(result)
+
+    # The patterns of match_case.
+
+    def do_MatchAs(self, node):
+        if node.pattern is None:
+            return node.name or '_'
+        return '%s as %s' % (self.visit(node.pattern), node.name)
+
+    def do_MatchClass(self, node):
+        args = [self.visit(z) for z in node.patterns]
+        for name, pattern in zip(node.kwd_attrs, node.kwd_patterns):
+            args.append('%s=%s' % (name, self.visit(pattern)))
+        return '%s(%s)' % (self.visit(node.cls), ', '.join(args))
+
+    def do_MatchMapping(self, node):
+        items = ['%s: %s' % (self.visit(key), self.visit(pattern))
+            for key, pattern in zip(node.keys, node.patterns)]
+        if node.rest:
+            items.append('**' + node.rest)
+        return '{%s}' % ', '.join(items)
+
+    def do_MatchOr(self, node):
+        return ' | '.join([self.visit(z) for z in node.patterns])
+
+    def do_MatchSequence(self, node):
+        return '[%s]' % ', '.join([self.visit(z) for z in node.patterns])
+
+    def do_MatchSingleton(self, node):
+        return repr(node.value)
+
+    def do_MatchStar(self, node):
+        return '*' + (node.name or '_')
+
+    def do_MatchValue(self, node):
+        return self.visit(node.value)
+
     # Nonlocal(identifier* names)
 
     def do_Nonlocal(self, node):
@@ -659,30 +1035,17 @@ class AstFormatter:
         return self.indent('pass\n')
 
 
-    # Python 2.x only
-
-    def do_Print(self, node):
-        vals = []
-        for z in node.values:
-            vals.append(self.visit(z))
-        if getattr(node, 'dest', None):
-            vals.append('dest=%s' % self.visit(node.dest))
-        if getattr(node, 'nl', None):
-            vals.append('nl=%s' % node.nl)
-        return self.indent('print(%s)\n' % (
-            ','.join(vals)))
-
+    # Raise(expr? exc, expr? cause)
 
     def do_Raise(self, node):
-        args = []
-        for attr in ('type', 'inst', 'tback'):
-            if getattr(node, attr, None) is not None:
-                args.append(self.visit(getattr(node, attr)))
-        if args:
-            return self.indent('raise %s\n' % (
-                ','.join(args)))
-        else:
+        if node.exc is None:
             return self.indent('raise\n')
+        elif node.cause is None:
+            return self.indent('raise %s\n' % self.visit(node.exc))
+        else:
+            return self.indent('raise %s from %s\n' % (
+                self.visit(node.exc),
+                self.visit(node.cause)))
 
 
     def do_Return(self, node):
@@ -700,8 +1063,9 @@ class AstFormatter:
         return '*' + self.visit(node.value)
 
     # Try(stmt* body, excepthandler* handlers, stmt* orelse, stmt* finalbody)
+    # TryStar: the same fields, Python 3.11.
 
-    def do_Try(self, node): # Python 3
+    def do_Try(self, node, keyword='except'):
 
         result = []
         result.append(self.indent('try:\n'))
@@ -711,7 +1075,7 @@ class AstFormatter:
             self.level -= 1
         if node.handlers:
             for z in node.handlers:
-                result.append(self.visit(z))
+                result.append(self.do_ExceptHandler(z, keyword))
         if node.orelse:
             result.append(self.indent('else:\n'))
             for z in node.orelse:
@@ -726,38 +1090,9 @@ class AstFormatter:
                 self.level -= 1
         return ''.join(result)
 
-    def do_TryExcept(self, node):
-        result = []
-        result.append(self.indent('try:\n'))
-        for z in node.body:
-            self.level += 1
-            result.append(self.visit(z))
-            self.level -= 1
-        if node.handlers:
-            for z in node.handlers:
-                result.append(self.visit(z))
-        if node.orelse:
-            result.append('else:\n')
-            for z in node.orelse:
-                self.level += 1
-                result.append(self.visit(z))
-                self.level -= 1
-        return ''.join(result)
 
-
-    def do_TryFinally(self, node):
-        result = []
-        result.append(self.indent('try:\n'))
-        for z in node.body:
-            self.level += 1
-            result.append(self.visit(z))
-            self.level -= 1
-        result.append(self.indent('finally:\n'))
-        for z in node.finalbody:
-            self.level += 1
-            result.append(self.visit(z))
-            self.level -= 1
-        return ''.join(result)
+    def do_TryStar(self, node):
+        return self.do_Try(node, 'except*')
 
 
     def do_While(self, node):
@@ -769,7 +1104,7 @@ class AstFormatter:
             result.append(self.visit(z))
             self.level -= 1
         if node.orelse:
-            result.append('else:\n')
+            result.append(self.indent('else:\n'))
             for z in node.orelse:
                 self.level += 1
                 result.append(self.visit(z))
@@ -777,42 +1112,28 @@ class AstFormatter:
         return ''.join(result)
 
 
-    # 2:  With(expr context_expr, expr? optional_vars, 
-    #          stmt* body)
-    # 3:  With(withitem* items,
-    #          stmt* body)
+    # With(withitem* items, stmt* body)
+    # AsyncWith: the same fields.
     # withitem = (expr context_expr, expr? optional_vars)
 
-    def do_With(self, node):
-        result = []
-        result.append(self.indent('with '))
-        vars_list = []
-        if getattr(node, 'context_expression', None):
-            result.append(self.visit(node.context_expresssion))
-        if getattr(node, 'optional_vars', None):
-            try:
-                for z in node.optional_vars:
-                    vars_list.append(self.visit(z))
-            except TypeError: # Not iterable.
-                vars_list.append(self.visit(node.optional_vars))
-        if getattr(node, 'items', None): # Python 3.
-            for item in node.items:
-                result.append(self.visit(item.context_expr))
-                if getattr(item, 'optional_vars', None):
-                    try:
-                        for z in item.optional_vars:
-                            vars_list.append(self.visit(z))
-                    except TypeError: # Not iterable.
-                        vars_list.append(self.visit(item.optional_vars))
-        result.append(','.join(vars_list))
-        result.append(':\n')
+    def do_With(self, node, keyword='with'):
+        items = []
+        for item in node.items:
+            s = self.visit(item.context_expr)
+            if item.optional_vars:
+                s = '%s as %s' % (s, self.visit(item.optional_vars))
+            items.append(s)
+        result = [self.indent('%s %s:\n' % (keyword, ','.join(items)))]
         for z in node.body:
             self.level += 1
             result.append(self.visit(z))
             self.level -= 1
-        result.append('\n')
         return ''.join(result)
 
+
+    def do_AsyncWith(self, node):
+        return self.do_With(node, 'async with')
+
     def do_Yield(self, node):
         if getattr(node, 'value', None):
             return self.indent('yield %s\n' % (
@@ -838,54 +1159,59 @@ class AstFormatter:
         return '%s%s' % (' ' * 4 * self.level, s)
 
 
+    op_names = {
+        # Binary operators. 
+        'Add':       '+',
+        'BitAnd':    '&',
+        'BitOr':     '|',
+        'BitXor':    '^',
+        'Div':       '/',
+        'FloorDiv':  '//',
+        'LShift':    '<<',
+        'MatMult':   '@',
+        'Mod':       '%',
+        'Mult':      '*',
+        'Pow':       '**',
+        'RShift':    '>>',
+        'Sub':       '-',
+        # Boolean operators.
+        'And':   ' and ',
+        'Or':    ' or ',
+        # Comparison operators
+        'Eq':    '==',
+        'Gt':    '>',
+        'GtE':   '>=',
+        'In':    ' in ',
+        'Is':    ' is ',
+        'IsNot': ' is not ',
+        'Lt':    '<',
+        'LtE':   '<=',
+        'NotEq': '!=',
+        'NotIn': ' not in ',
+        # Context operators.
+        'AugLoad':  '<AugLoad>',
+        'AugStore': '<AugStore>',
+        'Del':      '<Del>',
+        'Load':     '<Load>',
+        'Param':    '<Param>',
+        'Store':    '<Store>',
+        # Unary operators.
+        'Invert':   '~',
+        'Not':      ' not ',
+        'UAdd':     '+',
+        'USub':     '-',
+    }
+
     def op_name (self,node,strict=True):
         '''Return the print name of an operator node.'''
-        d = {
-            # Binary operators. 
-            'Add':       '+',
-            'BitAnd':    '&',
-            'BitOr':     '|',
-            'BitXor':    '^',
-            'Div':       '/',
-            'FloorDiv':  '//',
-            'LShift':    '<<',
-            'Mod':       '%',
-            'Mult':      '*',
-            'Pow':       '**',
-            'RShift':    '>>',
-            'Sub':       '-',
-            # Boolean operators.
-            'And':   ' and ',
-            'Or':    ' or ',
-            # Comparison operators
-            'Eq':    '==',
-            'Gt':    '>',
-            'GtE':   '>=',
-            'In':    ' in ',
-            'Is':    ' is ',
-            'IsNot': ' is not ',
-            'Lt':    '<',
-            'LtE':   '<=',
-            'NotEq': '!=',
-            'NotIn': ' not in ',
-            # Context operators.
-            'AugLoad':  '<AugLoad>',
-            'AugStore': '<AugStore>',
-            'Del':      '<Del>',
-            'Load':     '<Load>',
-            'Param':    '<Param>',
-            'Store':    '<Store>',
-            # Unary operators.
-            'Invert':   '~',
-            'Not':      ' not ',
-            'UAdd':     '+',
-            'USub':     '-',
-        }
-        name = d.get(self.kind(node),'<%s>' % node.__class__.__name__)
+        name = self.op_names.get(self.kind(node),'<%s>' % node.__class__.__name__)
         if strict: assert name,self.kind(node)
         return name
 
 
+AstFormatter.dispatch = AstFormatter.make_dispatch()
+
+
 class AstArgFormatter (AstFormatter):
     '''
     Just like the AstFormatter class, except it prints the class
@@ -894,22 +1220,31 @@ class AstArgFormatter (AstFormatter):
 
     # Return generic markers to allow better pattern matches.
 
-    def do_BoolOp(self, node): # Python 2.x only.
+    def do_BoolOp(self, node):
         return 'bool'
 
-    def do_Bytes(self, node): # Python 3.x only.
-        return 'bytes' # return str(node.s)
+    def do_Constant(self, node):
+        '''Return the marker of the type of the constant.'''
+        value = node.value
+        if value is None:
+            return 'None'
+        elif value is Ellipsis:
+            return '...'
+        elif isinstance(value, bool):
+            return 'bool'
+        elif isinstance(value, (int, float, complex)):
+            return 'number'
+        elif isinstance(value, bytes):
+            return 'bytes'
+        else:
+            return 'str'
+
+    def do_JoinedStr(self, node):
+        return 'str'
 
     def do_Name(self, node):
         return 'bool' if node.id in ('True', 'False') else node.id
 
-    def do_Num(self, node):
-        return 'number' # return repr(node.n)
-
-    def do_Str(self, node):
-        '''This represents a string constant.'''
-        return 'str' # return repr(node.s)
-
 
 class LeoGlobals:
     '''A class supporting g.pdb and g.trace for compatibility with Leo.'''
@@ -1147,10 +1482,15 @@ class Pattern(object):
         '''Ctor for the Pattern class.'''
         self.find_s = find_s
         self.repl_s = repl_s
+        self.regex = self.compile_regex()
+
+    def compile_regex(self):
+        '''Return the regex for self.find_s, None for balanced patterns.'''
+        find_s = self.find_s
         if self.is_regex():
-            self.regex = re.compile(find_s)
+            return re.compile(find_s)
         elif self.is_balanced():
-            self.regex = None
+            return None
         else:
             # Escape all dangerous characters.
             result = []
@@ -1159,7 +1499,20 @@ class Pattern(object):
                     result.append(ch)
                 else:
                     result.append('\\'+ch)
-            self.regex = re.compile(''.join(result))
+            return re.compile(''.join(result))
+
+    def __getstate__(self):
+        '''Pickle without the regex: most patterns never use it.'''
+        d = self.__dict__.copy()
+        d.pop('regex', None)
+        return d
+
+    def __getattr__(self, name):
+        '''Compile the regex of an unpickled pattern when it is first used.'''
+        if name == 'regex' and 'find_s' in self.__dict__:
+            self.regex = self.compile_regex()
+            return self.regex
+        raise AttributeError(name)
 
     def __eq__(self, obj):
         """Return True if two Patterns are equivalent."""
@@ -1279,10 +1632,7 @@ class Pattern(object):
         Perform the match on the entire string if possible.
         Return (found, new s)
         '''
-        trace = False or trace
-        caller = g.callers(2).split(',')[0].strip()
-            # The caller of match_all.
-        s1 = truncate(s,40)
+        s1 = s
         if self.is_balanced():
             j = self.full_balanced_match(s, 0)
             if j is None:
@@ -1291,14 +1641,17 @@ class Pattern(object):
                 start, end = 0, len(s)
                 s = self.replace_balanced(s, start, end)
                 if trace:
-                    g.trace('%-16s %30s %40s ==> %s' % (caller, self, s1, s))
+                    caller = g.callers(2).split(',')[0].strip()
+                        # The caller of match_all.
+                    g.trace('%-16s %30s %40s ==> %s' % (caller, self, truncate(s1, 40), s))
                 return True, s
         else:
             m = self.regex.match(s)
             if m and m.group(0) == s:
                 s = self.replace_regex(m, s)
                 if trace:
-                    g.trace('%-16s %30s %30s ==> %s' % (caller, self, s1, s))
+                    caller = g.callers(2).split(',')[0].strip()
+                    g.trace('%-16s %30s %30s ==> %s' % (caller, self, truncate(s1, 40), s))
                 return True, s
             else:
                 return False, s
@@ -1361,6 +1714,185 @@ class Pattern(object):
 
 
 
+class PatternIndex(object):
+    '''
+    An index of a list of patterns, for matching entire strings.
+    find(s) returns the same pattern as the linear search:
+
+        for pattern in patterns:
+            if pattern.match_entire_string(s):
+                return pattern
+
+    With entire=False, balanced patterns need only match the start of s,
+    as in Pattern.match, and find(s) returns the same pattern as:
+
+        for pattern in patterns:
+            found, s2 = pattern.match(s)
+            if found:
+                return pattern
+    '''
+
+    word_regex = re.compile(r'\w*')
+
+    def __init__ (self, patterns, entire=True):
+        '''Ctor for the PatternIndex class.'''
+        self.entire = entire
+        self.exact = {}
+            # Keys are find_s of plain patterns, values are (n, pattern).
+            # A plain pattern matches only the string find_s.
+        self.regex_patterns = [] # [(n, pattern)]
+        self.balanced_words = {}
+            # Keys are the leading word of the pattern, values are [(n, prefix, pattern)].
+            # These patterns only match strings with the same leading word.
+        self.balanced_patterns = {}
+            # Keys are the first character of the pattern, values are [(n, prefix, pattern)].
+            # For patterns whose leading word may continue, like 'x*'.
+            # The key '' holds patterns that start with '*'.
+        for n, pattern in enumerate(patterns):
+            if pattern.is_regex():
+                self.regex_patterns.append((n, pattern),)
+            elif pattern.is_balanced():
+                # full_balanced_match compares characters up to the first '*'.
+                prefix = pattern.find_s.split('*')[0]
+                word = self.word_regex.match(prefix).group(0)
+                if len(word) < len(prefix):
+                    aList = self.balanced_words.setdefault(word, [])
+                else:
+                    aList = self.balanced_patterns.setdefault(prefix[:1], [])
+                aList.append((n, prefix, pattern),)
+            elif pattern.find_s not in self.exact:
+                self.exact[pattern.find_s] = n, pattern
+        self.regex = self.make_regex()
+
+    def make_regex(self):
+        '''
+        Return a regex matching the start of every string that any regex
+        pattern can match, or None. It only rejects strings quickly: the
+        patterns themselves decide which one matches the entire string.
+        '''
+        aList = [pattern.find_s for n, pattern in self.regex_patterns]
+        for s in aList:
+            if re.search(r'\\[1-9]|\(\?P=', s):
+                return None # Back references would refer to the wrong group.
+        try:
+            return re.compile('|'.join(['(?:%s)' % z for z in aList]))
+        except re.error:
+            return None
+
+    def find(self, s):
+        '''Return the first pattern matching the entire string s, or None.'''
+        best, result = self.exact.get(s, (None, None))
+        # Patterns before best take precedence.
+        if self.regex_patterns and (not self.regex or self.regex.match(s)):
+            for n, pattern in self.regex_patterns:
+                if best is not None and n > best:
+                    break
+                if pattern.match_entire_string(s):
+                    best, result = n, pattern
+                    break
+        word = self.word_regex.match(s).group(0)
+        candidates = [self.balanced_words.get(word, [])]
+        for key in (s[:1], '') if s else ('',):
+            candidates.append(self.balanced_patterns.get(key, []))
+        for aList in candidates:
+            for n, prefix, pattern in aList:
+                if best is not None and n > best:
+                    break
+                if s.startswith(prefix) and self.match_balanced(pattern, s):
+                    best, result = n, pattern
+                    break
+        return result
+
+    def match_balanced(self, pattern, s):
+        '''Return True if the balanced pattern matches s.'''
+        if self.entire:
+            return pattern.match_entire_string(s)
+        else:
+            return pattern.full_balanced_match(s, 0) is not None
+
+
+
+# The known types of ReduceTypes.is_known_type.
+# Besides the name itself, name(*) is known for these...
+known_call_types = frozenset((
+    '', 'None', # Tricky.
+    'complex', 'float', 'int', 'long', 'number',
+    'dict', 'list', 'tuple',
+    'bool', 'bytes', 'str', 'unicode',
+))
+# ...and name[*] for these.
+known_subscript_types = frozenset((
+    # Pep 484: https://www.python.org/dev/peps/pep-0484/
+    # typing module: https://docs.python.org/3/library/typing.html
+    'Any', 'Dict', 'List', 'Optional', 'Tuple', 'Union',
+    # Not generated by this program, but could arise from patterns.
+    'AbstractSet', 'AnyMeta', 'AnyStr',
+    'BinaryIO', 'ByteString',
+    'Callable', 'CallableMeta', 'Container',
+    'Final', 'Generic', 'GenericMeta', 'Hashable',
+    'IO', 'ItemsView', 'Iterable', 'Iterator',
+    'KT', 'KeysView',
+    'Mapping', 'MappingView', 'Match',
+    'MutableMapping', 'MutableSequence', 'MutableSet',
+    'NamedTuple', 'OptionalMeta',
+    # 'POSIX', 'PY2', 'PY3',
+    'Pattern', 'Reversible',
+    'Sequence', 'Set', 'Sized',
+    'SupportsAbs', 'SupportsFloat', 'SupportsInt', 'SupportsRound',
+    'T', 'TextIO', 'TupleMeta', 'TypeVar', 'TypingMeta',
+    'Undefined', 'UnionMeta',
+    'VT', 'ValuesView', 'VarBinding',
+))
+# Match any of the names, followed by the opening bracket.
+# The names are identifiers, so at most one of them can match.
+known_call_regex = re.compile(r'(?:%s)\(' % '|'.join(re.escape(z) for z in sorted(known_call_types)))
+known_subscript_regex = re.compile(r'(?:%s)\[' % '|'.join(re.escape(z) for z in sorted(known_subscript_types)))
+
+@functools.lru_cache(maxsize=4096)
+def known_type_cache(s):
+    '''
+    Return ReduceTypes.is_known_type for a stripped s.
+    The same types repeat for many functions.
+    '''
+    if s in known_call_types or balanced_match(known_call_regex, s):
+        return True
+    if s.startswith('[') and s.endswith(']'):
+        inner = s[1:-1]
+        return known_type_cache(inner.strip()) if inner else True
+    elif s.startswith('(') and s.endswith(')'):
+        inner = s[1:-1]
+        return known_type_cache(inner.strip()) if inner else True
+    elif s.startswith('{') and s.endswith('}'):
+        return True
+        # inner = s[1:-1]
+        # return known_type_cache(inner.strip()) if inner else True
+    # Don't look inside brackets.
+    return s in known_subscript_types or balanced_match(known_subscript_regex, s)
+
+
+def balanced_match(regex, s):
+    '''
+    Return True if regex matches the start of s, up to an opening bracket,
+    and the brackets that start there are balanced at the very end of s.
+    The same as Pattern('name(*)').match_entire_string(s), but for all names at once.
+    '''
+    m = regex.match(s)
+    if not m:
+        return False
+    i = m.end() - 1
+    delim = s[i]
+    delim2 = ')' if delim == '(' else ']'
+    level = 0
+    for j in range(i, len(s)):
+        ch = s[j]
+        if ch == delim:
+            level += 1
+        elif ch == delim2:
+            level -= 1
+            if level == 0:
+                return j == len(s) - 1
+    return False
+
 
 class ReduceTypes:
     '''
@@ -1385,60 +1917,7 @@ class ReduceTypes:
         brackets. This prevents unwanted Any types.
         '''
         # s1 = s
-        s = s.strip()
-        table = (
-            '', 'None', # Tricky.
-            'complex', 'float', 'int', 'long', 'number',
-            'dict', 'list', 'tuple',
-            'bool', 'bytes', 'str', 'unicode',
-        )
-        for s2 in table:
-            if s2 == s:
-                return True
-            elif Pattern(s2+'(*)', s).match_entire_string(s):
-                return True
-        if s.startswith('[') and s.endswith(']'):
-            inner = s[1:-1]
-            return self.is_known_type(inner) if inner else True
-        elif s.startswith('(') and s.endswith(')'):
-            inner = s[1:-1]
-            return self.is_known_type(inner) if inner else True
-        elif s.startswith('{') and s.endswith('}'):
-            return True
-            # inner = s[1:-1]
-            # return self.is_known_type(inner) if inner else True
-        table = (
-            # Pep 484: https://www.python.org/dev/peps/pep-0484/
-            # typing module: https://docs.python.org/3/library/typing.html
-            # Test the most common types first.
-            'Any', 'Dict', 'List', 'Optional', 'Tuple', 'Union', 
-            # Not generated by this program, but could arise from patterns.
-            'AbstractSet', 'AnyMeta', 'AnyStr',
-            'BinaryIO', 'ByteString',
-            'Callable', 'CallableMeta', 'Container',
-            'Final', 'Generic', 'GenericMeta', 'Hashable',
-            'IO', 'ItemsView', 'Iterable', 'Iterator',
-            'KT', 'KeysView',
-            'Mapping', 'MappingView', 'Match',
-            'MutableMapping', 'MutableSequence', 'MutableSet',
-            'NamedTuple', 'OptionalMeta',
-            # 'POSIX', 'PY2', 'PY3',
-            'Pattern', 'Reversible',
-            'Sequence', 'Set', 'Sized',
-            'SupportsAbs', 'SupportsFloat', 'SupportsInt', 'SupportsRound',
-            'T', 'TextIO', 'TupleMeta', 'TypeVar', 'TypingMeta',
-            'Undefined', 'UnionMeta',
-            'VT', 'ValuesView', 'VarBinding',
-        )
-        for s2 in table:
-            if s2 == s:
-                return True
-            else:
-                # Don't look inside bracketss.
-                pattern = Pattern(s2+'[*]', s)
-                if pattern.match_entire_string(s):
-                    return True
-        return False
+        return known_type_cache(s.strip())
 
     def reduce_collection(self, aList, kind):
         '''
@@ -1504,6 +1983,13 @@ class ReduceTypes:
         Returning a string means that all traversers always return strings,
         never lists.
         '''
+        return self.show(self.reduce())
+
+    def reduce(self):
+        '''
+        Return the reduction of self.aList, before self.show.
+        Sets self.optional. The result depends on self.aList only.
+        '''
         r = [('None' if z in ('', None) else z) for z in self.aList]
         assert None not in r
         self.optional = 'None' in r
@@ -1511,7 +1997,7 @@ class ReduceTypes:
         r = [z for z in r if z != 'None']
         if not r:
             self.optional = False
-            return self.show('None')
+            return 'None'
         r = sorted(set(r))
         assert r
         assert None not in r
@@ -1524,9 +2010,9 @@ class ReduceTypes:
         assert r
         assert 'None' not in r
         if len(r) == 1:
-            return self.show(r[0])
+            return r[0]
         else:
-            return self.show('Union[%s]' % (', '.join(sorted(r))))
+            return 'Union[%s]' % (', '.join(sorted(r)))
 
     def reduce_unknowns(self, aList):
         '''Replace all unknown types in aList with Any.'''
@@ -1586,7 +2072,17 @@ class StandAloneMakeStubFile:
         self.config_fn = None
             # self.finalize('~/stubs/make_stub_files.cfg')
         self.enable_unit_tests = False
+        self.errors = [] # (fn, message) for files that could not be stubbed.
         self.files = [] # May also be set in the config file.
+        self.jobs = 1 # Number of processes, 0: one per cpu.
+        self.cache_fn = None # Skip files that did not change since this cache was written.
+        self.cache = None
+        self.config_cache_fn = None # Load the pattern tables from this snapshot of the compiled config.
+        self.dedup = False # Make the stubs once for files with the same content.
+        self.written = 0 # Number of stub files written.
+        self.stats = {} # Numbers of regenerated, skipped and failed files of the last run.
+        self.reduce_hits = 0 # reduce_types_cache statistics.
+        self.reduce_misses = 0
         # Ivars set in the config file...
         self.output_fn = None
         self.output_directory = self.finalize('.')
@@ -1598,6 +2094,8 @@ class StandAloneMakeStubFile:
         self.trace_patterns = False
         self.trace_reduce = False
         self.trace_visitors = False
+        self.trace_fn = None # Write trace events to this file instead of printing them.
+        self.trace_log = None
         self.update_flag = False
         self.verbose = False # Trace config arguments.
         self.warn = False
@@ -1606,10 +2104,14 @@ class StandAloneMakeStubFile:
             'Global', 'Def Name Patterns', 'General Patterns')
         self.def_patterns = [] # [Def Name Patterns]
         self.general_patterns = [] # [General Patterns]
+        self.arg_index = PatternIndex([]) # Index of general_patterns, for munge_arg.
         self.names_dict = {}
         self.op_name_dict = self.make_op_name_dict()
         self.patterns_dict = {}
         self.regex_patterns = []
+        self.matchers = {None: PatternIndex([], entire=False)}
+            # Keys are ast.Node names, values are PatternIndex's for match_all.
+        self.match_cache = {} # Keys are (ast.Node name, s), values are the result of match_all.
 
     def finalize(self, fn):
         '''Finalize and regularize a filename.'''
@@ -1623,23 +2125,216 @@ class StandAloneMakeStubFile:
         Make a stub file in ~/stubs for all source files mentioned in the
         [Source Files] section of ~/stubs/make_stub_files.cfg
         '''
+        t1 = time.perf_counter()
+        info = reduce_types_cache.cache_info()
+        s, error = self.make_stub_text(fn, stream=True)
+        self.write_stub_file(fn, s, error, time.perf_counter() - t1)
+        info2 = reduce_types_cache.cache_info()
+        self.reduce_hits += info2.hits - info.hits
+        self.reduce_misses += info2.misses - info.misses
+
+    def make_stub_text(self, fn, stream=False):
+        '''
+        Return (s, error) for the source file fn.
+        s is the text of the stub file, or None if there is nothing to write.
+        With stream, when there is no stub file to update, s can also be a
+        function that writes the stubs to an open file, so that the text of
+        the stub file is never held in memory.
+        error is None, or a message if the file could not be stubbed.
+        '''
         if not fn.endswith('.py'):
             print('not a python file', fn)
-            return
+            return None, None
         if not os.path.exists(fn):
             print('not found', fn)
-            return
+            return None, None
         # base_fn = os.path.basename(fn)
         # out_fn = os.path.join(self.output_directory, base_fn)
         # out_fn = out_fn[:-3] + '.pyi'
         out_fn = fn + 'i'
         self.output_fn = os.path.normpath(out_fn)
+        if os.path.exists(self.output_fn) and not self.overwrite:
+            # Don't parse fn for nothing.
+            print('file exists: %s' % self.output_fn)
+            return None, None
         try:
-            s = open(fn).read()
-            node = ast.parse(s,filename=fn,mode='exec')
-            StubTraverser(controller=self).run(node)
-        except:
-            print('Unexpected error occurred whilst parsing file %s:' % fn, sys.exc_info()[0])
+            with open(fn) as f:
+                s = f.read()
+            pyi = self.get_stub_file(self.output_fn) if self.update_flag else None
+            if stream and pyi is None:
+                text = make_board_stub_string(s, self)
+                if text is not None:
+                    return text, None
+                node = ast.parse(s, filename=fn, mode='exec')
+                return functools.partial(StubTraverser(controller=self).write_stubs, node), None
+            return make_stub_string(s, self, pyi, fn), None
+        except Exception as e:
+            return None, '%s: %s' % (e.__class__.__name__, e)
+
+    def get_stub_file(self, fn):
+        '''Return the text of the stub file fn, or None.'''
+        if os.path.exists(fn):
+            try:
+                with open(fn, 'r') as f:
+                    return f.read()
+            except Exception:
+                print('--update: error reading %s' % fn)
+                return None
+        else:
+            if not self.silent:
+                print('--update: not found: %s' % fn)
+            return None
+
+    def write_stub_file(self, fn, s, error, elapsed):
+        '''Write the result of make_stub_text for fn, or record the error.'''
+        if error:
+            self.errors.append((fn, error))
+        elif s is not None:
+            out_fn = os.path.normpath(fn + 'i')
+            if callable(s):
+                # Stream the stubs to a new file, that replaces the stub file once complete.
+                # Replacing also unshares a stub file of the store of utils.py.
+                t1 = time.perf_counter()
+                tmp_fn = out_fn + '.tmp'
+                try:
+                    with open(tmp_fn, 'w') as f:
+                        s(f)
+                except Exception as e:
+                    os.remove(tmp_fn)
+                    self.errors.append((fn, '%s: %s' % (e.__class__.__name__, e)))
+                    return
+                os.replace(tmp_fn, out_fn)
+                elapsed += time.perf_counter() - t1
+            else:
+                unshare(out_fn)
+                with open(out_fn, 'w') as f:
+                    f.write(s)
+            self.written += 1
+            if self.cache is not None:
+                self.cache['files'][self.cache_key(fn)] = {
+                    'py': file_hash(fn), 'pyi': file_hash(out_fn)}
+            if not self.silent:
+                print('wrote: %s in %4.2f sec' % (out_fn, elapsed))
+
+    def run_jobs(self, files):
+        '''
+        Make the stub files for files in a pool of processes.
+        The workers get this controller, with its compiled patterns, once:
+        inherited by fork, or pickled where processes are spawned.
+        The stub files are written here, in the order of files.
+        '''
+        import multiprocessing
+        jobs = self.jobs or os.cpu_count() or 1
+        chunksize = max(1, len(files) // (jobs * 8))
+        with multiprocessing.Pool(jobs, initializer=init_job, initargs=(self,)) as pool:
+            for fn, s, error, elapsed, output, hits, misses in pool.imap(make_stub_job, files, chunksize):
+                if output:
+                    sys.stdout.write(output)
+                self.reduce_hits += hits
+                self.reduce_misses += misses
+                self.write_stub_file(fn, s, error, elapsed)
+
+    def find_duplicates(self, files):
+        '''
+        Group files by the content of the source, and of the stub file when updating.
+        Return (unique, duplicates): the files to make stubs for, and a list
+        of (fn, fn2) for the other files, whose stubs are the same as those of fn2.
+        '''
+        unique, duplicates, seen = [], [], {}
+        for fn in files:
+            key = None
+            out_fn = os.path.normpath(fn + 'i')
+            if fn.endswith('.py') and os.path.exists(fn):
+                if not os.path.exists(out_fn):
+                    key = file_hash(fn)
+                elif self.overwrite:
+                    key = file_hash(fn) + (file_hash(out_fn) if self.update_flag else '')
+                # Otherwise make_stub_text reports that the stub file exists.
+            if key and key in seen:
+                duplicates.append((fn, seen[key]),)
+            else:
+                if key:
+                    seen[key] = fn
+                unique.append(fn)
+        return unique, duplicates
+
+    def write_duplicates(self, duplicates):
+        '''Copy the stub files of the unique files to their duplicates.'''
+        failed = set(fn for fn, error in self.errors)
+        for fn, fn2 in duplicates:
+            out_fn2 = os.path.normpath(fn2 + 'i')
+            if fn2 in failed or not os.path.exists(out_fn2):
+                # Report the error for this file too.
+                self.make_stub_file(fn)
+            else:
+                t1 = time.perf_counter()
+                with open(out_fn2, 'r') as f:
+                    s = f.read()
+                self.write_stub_file(fn, s, None, time.perf_counter() - t1)
+
+    def cache_state(self):
+        '''Return the hashes of everything besides the source that the stubs depend on.'''
+        config = self.get_config_string() if self.config_fn else ''
+        options = repr((self.update_flag, self.overwrite, self.verbose))
+        return {
+            'generator': file_hash(__file__),
+            'config': hashlib.sha256((config + options).encode('utf-8')).hexdigest(),
+        }
+
+    def cache_key(self, fn):
+        '''The key for fn in the cache: its path relative to the cache file.'''
+        return os.path.relpath(fn, os.path.dirname(self.cache_fn)).replace(os.sep, '/')
+
+    def load_cache(self):
+        '''
+        Read self.cache_fn, {generator, config, files: {key: {py, pyi}}}.
+        Start with an empty cache if it is missing, or made by another generator or config.
+        '''
+        state = self.cache_state()
+        self.cache = None
+        if os.path.exists(self.cache_fn):
+            try:
+                with open(self.cache_fn) as f:
+                    cache = json.load(f)
+                if all(cache.get(key) == value for key, value in state.items()):
+                    self.cache = cache
+            except (OSError, ValueError):
+                print('ignoring invalid cache file: %s' % self.cache_fn)
+        if self.cache is None:
+            self.cache = dict(state, files={})
+
+    def save_cache(self):
+        '''
+        Write self.cache to self.cache_fn.
+        Drop the entries of sources that are not in self.files, such as deleted files.
+        '''
+        keys = set(self.cache_key(fn) for fn in self.files)
+        self.cache['files'] = dict((k, v) for k, v in self.cache['files'].items() if k in keys)
+        with open(self.cache_fn, 'w') as f:
+            json.dump(self.cache, f, indent=0, sort_keys=True)
+
+    def is_unchanged(self, fn):
+        '''True if fn and its stub file are as they were when the stub file was written.'''
+        entry = self.cache['files'].get(self.cache_key(fn))
+        if not entry:
+            return False
+        out_fn = os.path.normpath(fn + 'i')
+        if not os.path.exists(out_fn) or not os.path.exists(fn):
+            return False
+        return entry.get('py') == file_hash(fn) and entry.get('pyi') == file_hash(out_fn)
+
+    def report_errors(self):
+        '''
+        Print a summary of the files that could not be stubbed.
+        With a cache, it ends with the numbers of regenerated, skipped and failed files,
+        also when silent.
+        '''
+        if self.errors:
+            print('%s of %s files could not be stubbed:' % (len(self.errors), len(self.files)))
+            for fn, error in self.errors:
+                print('  %s: %s' % (fn, error))
+        if self.cache_fn and (self.errors or not self.silent):
+            print('%(regenerated)s regenerated, %(skipped)s skipped (unchanged), %(errors)s errors' % self.stats)
 
 
     def run(self):
@@ -1653,8 +2348,35 @@ class StandAloneMakeStubFile:
             dir_ = self.output_directory
             if dir_:
                 if os.path.exists(dir_):
-                    for fn in self.files:
-                        self.make_stub_file(fn)
+                    files = self.files
+                    skipped = 0
+                    if self.trace_fn:
+                        self.trace_log = TraceLog(self.trace_fn)
+                        self.trace_log.clear()
+                    if self.cache_fn:
+                        self.load_cache()
+                        files = [fn for fn in files if not self.is_unchanged(fn)]
+                        skipped = len(self.files) - len(files)
+                    duplicates = []
+                    if self.dedup:
+                        files, duplicates = self.find_duplicates(files)
+                    if self.jobs != 1 and len(files) > 1:
+                        self.run_jobs(files)
+                    else:
+                        for fn in files:
+                            self.make_stub_file(fn)
+                    if self.dedup:
+                        self.write_duplicates(duplicates)
+                        if not self.silent:
+                            print('%s unique of %s files' % (len(files), len(files) + len(duplicates)))
+                    self.stats = {'regenerated': self.written, 'skipped': skipped, 'errors': len(self.errors)}
+                    self.report_errors()
+                    if self.trace_log:
+                        self.trace_log.close()
+                    if self.trace_reduce:
+                        print(reduce_types_cache_info(self.reduce_hits, self.reduce_misses))
+                    if self.cache_fn:
+                        self.save_cache()
                 else:
                     print('output directory not found: %s' % dir_)
             else:
@@ -1681,6 +2403,12 @@ class StandAloneMakeStubFile:
             help='full path to configuration file')
         add('-d', '--dir', dest='dir',
             help='full path to the output directory')
+        add('-j', '--jobs', type='int', default=1,
+            help='number of processes to use, 0: one per cpu')
+        add('--cache', dest='cache',
+            help='cache file with the hashes of the sources, skip those that did not change')
+        add('--config-cache', dest='config_cache',
+            help='cache file with the compiled patterns of the configuration file')
         add('-o', '--overwrite', action='store_true', default=False,
             help='overwrite existing stub (.pyi) files')
         add('-s', '--silent', action='store_true', default=False,
@@ -1695,6 +2423,8 @@ class StandAloneMakeStubFile:
             help='trace st.reduce_types')
         add('--trace-visitors', action='store_true', default=False,
             help='trace visitor methods')
+        add('--trace-file', dest='trace_fn',
+            help='write the --trace-matches and --trace-visitors events to this json lines file')
         add('-u', '--update', action='store_true', default=False,
             help='update stubs in existing stub file')
         add('-v', '--verbose', action='store_true', default=False,
@@ -1705,12 +2435,19 @@ class StandAloneMakeStubFile:
         options, args = parser.parse_args()
         # Handle the options...
         self.enable_unit_tests=options.test
+        self.jobs = options.jobs
+        if options.cache:
+            self.cache_fn = self.finalize(options.cache)
+        if options.config_cache:
+            self.config_cache_fn = self.finalize(options.config_cache)
         self.overwrite = options.overwrite
         self.silent = options.silent
         self.trace_matches = options.trace_matches
         self.trace_patterns = options.trace_patterns
         self.trace_reduce = options.trace_reduce
         self.trace_visitors = options.trace_visitors
+        if options.trace_fn:
+            self.trace_fn = self.finalize(options.trace_fn)
         self.update_flag = options.update
         self.verbose = options.verbose
         self.warn = options.warn
@@ -1739,8 +2476,16 @@ class StandAloneMakeStubFile:
         if not self.config_fn:
             return
         self.parser = parser = self.create_parser()
-        s = self.get_config_string()
-        self.init_parser(s)
+        config = self.get_config_string()
+        key = snapshot = None
+        if self.config_cache_fn and not self.trace_patterns:
+            key = self.config_cache_key(config)
+            snapshot = self.load_config_cache(key)
+        if snapshot:
+            # Only the [Global] section is needed below.
+            parser.read_dict(snapshot['sections'])
+        else:
+            self.init_parser(config)
         if self.files:
             files_source = 'command-line'
             files = self.files
@@ -1769,7 +2514,73 @@ class StandAloneMakeStubFile:
             else:
                 print('output directory not found: %s\n' % output_dir)
                 self.output_directory = None # inhibit run().
-        if 'prefix_lines' in parser.options('Global'):
+        if snapshot:
+            for ivar in self.config_ivars:
+                setattr(self, ivar, snapshot[ivar])
+            self.match_cache = {}
+        else:
+            self.scan_config()
+            if key:
+                self.save_config_cache(key)
+
+    def scan_config_string(self, s):
+        '''
+        Set the prefix lines and patterns from s, the text of a configuration file.
+        Reads no files: the [Global] files and output_directory are not used.
+        '''
+        self.parser = self.create_parser()
+        self.init_parser(s)
+        self.scan_config()
+
+    # The ivars set by scan_config, in the snapshot of --config-cache.
+    config_ivars = (
+        'prefix_lines', 'def_patterns', 'general_patterns', 'arg_index',
+        'names_dict', 'patterns_dict', 'regex_patterns', 'matchers',
+    )
+
+    def config_cache_key(self, s):
+        '''
+        The key of the snapshot of the configuration s: the hashes of s and this file.
+        The snapshot refers to the classes of this module, by the name it was imported as.
+        '''
+        return '%s %s %s' % (__name__, file_hash(__file__), hashlib.sha256(s.encode('utf-8')).hexdigest())
+
+    def load_config_cache(self, key):
+        '''Return the snapshot in self.config_cache_fn if it is for key, or None.'''
+        fn = self.config_cache_fn
+        if not os.path.exists(fn):
+            return None
+        try:
+            with open(fn, 'rb') as f:
+                # The key comes first, so that other snapshots are not loaded.
+                if pickle.load(f) != key:
+                    return None
+                return pickle.load(f)
+        except Exception:
+            print('ignoring invalid config cache: %s' % fn)
+            return None
+
+    def save_config_cache(self, key):
+        '''Write the snapshot of the pattern tables to self.config_cache_fn.'''
+        snapshot = dict((ivar, getattr(self, ivar)) for ivar in self.config_ivars)
+        parser = self.parser
+        snapshot['sections'] = dict((name, dict((z, parser.get(name, z)) for z in parser.options(name)))
+            for name in ('Global',) if parser.has_section(name))
+        tmp_fn = '%s.%s' % (self.config_cache_fn, os.getpid())
+        try:
+            with open(tmp_fn, 'wb') as f:
+                pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            # Concurrent runs never see a partial file.
+            os.replace(tmp_fn, self.config_cache_fn)
+        except OSError as e:
+            print('can not write config cache: %s: %s' % (self.config_cache_fn, e))
+
+    def scan_config(self):
+        '''Set the prefix lines and patterns from self.parser.'''
+        trace = False
+        parser = self.parser
+        if parser.has_section('Global') and 'prefix_lines' in parser.options('Global'):
             prefix = parser.get('Global', 'prefix_lines')
             self.prefix_lines = prefix.split('\n')
                 # The parser does not preserve leading whitespace.
@@ -1780,6 +2591,7 @@ class StandAloneMakeStubFile:
                 print('')
         self.def_patterns = self.scan_patterns('Def Name Patterns')
         self.general_patterns = self.scan_patterns('General Patterns')
+        self.arg_index = PatternIndex(self.general_patterns)
         self.make_patterns_dict()
 
     def make_op_name_dict(self):
@@ -1917,6 +2729,7 @@ class StandAloneMakeStubFile:
                     g.trace('duplicate pattern', pattern)
                 else:
                     self.names_dict [name] = pattern.repl_s
+        self.make_matchers()
         if debug_flag:
             g.trace('names_dict...')
             for z in sorted(self.names_dict):
@@ -1930,6 +2743,16 @@ class StandAloneMakeStubFile:
                     print('  '+repr(pattern))
         # Note: retain self.general_patterns for use in argument lists.
 
+    def make_matchers(self):
+        '''
+        Make one matcher for each ast.Node name in self.patterns_dict.
+        The key None holds the matcher for all other nodes.
+        '''
+        self.matchers = {None: PatternIndex(self.regex_patterns, entire=False)}
+        for name, aList in self.patterns_dict.items():
+            self.matchers[name] = PatternIndex(aList + self.regex_patterns, entire=False)
+        self.match_cache = {}
+
     def scan_patterns(self, section_name):
         '''Parse the config section into a list of patterns, preserving order.'''
         trace = False or self.trace_patterns
@@ -1997,7 +2820,7 @@ class Stub(object):
 
     def __hash__(self):
         '''Stub.__hash__. Equality depends *only* on full_name and kind.'''
-        return len(self.kind) + sum([ord(z) for z in self.full_name])
+        return hash((self.full_name, self.kind))
 
     def __repr__(self):
         '''Stub.__repr__.'''
@@ -2015,6 +2838,66 @@ class Stub(object):
         return self.full_name.split('.')[:-1]
 
 
+class StubIndex(object):
+    '''
+    An index of the stubs in root's tree, for StubTraverser.merge_stubs.
+    find(stub) returns the first stub equal to stub in a preorder walk of the tree,
+    also after attach and detach have changed the tree.
+    '''
+
+    def __init__(self, root):
+        '''Ctor for the StubIndex class.'''
+        self.root = root
+        self.d = {}
+            # Keys are stubs, values are the stubs equal to the key that were ever in the tree.
+        self.counts = {}
+            # Keys are id(stub), values are the number of times the stub is in the tree.
+        self.count(root, 1)
+
+    def count(self, stub, n):
+        '''Add n to the counts of stub and all its descendants.'''
+        stack = [stub]
+        while stack:
+            z = stack.pop()
+            key = id(z)
+            if key not in self.counts:
+                self.counts[key] = 0
+                self.d.setdefault(z, []).append(z)
+            self.counts[key] += n
+            stack.extend(z.children)
+
+    def attach(self, parent, stub):
+        '''Append stub to parent.children.'''
+        parent.children.append(stub)
+        self.count(stub, 1)
+
+    def detach(self, parent, stub):
+        '''Remove the first child of parent that is equal to stub.'''
+        i = parent.children.index(stub)
+        self.count(parent.children.pop(i), -1)
+
+    def find(self, stub):
+        '''Return the stub in the tree that is equal to stub, or None.'''
+        aList = [z for z in self.d.get(stub, []) if self.counts[id(z)] > 0]
+        if not aList:
+            return None
+        elif len(aList) == 1:
+            return aList[0]
+        else:
+            # Duplicates: find the first one.
+            stack = [self.root]
+            while stack:
+                z = stack.pop()
+                if z == stub:
+                    return z
+                stack.extend(reversed(z.children))
+            return None
+
+    def find_parent(self, stub):
+        '''Return stub's parent in the tree.'''
+        return self.find(stub.parent) if stub.parent else None
+
+
 class StubFormatter (AstFormatter):
     '''
     Formats an ast.Node and its descendants,
@@ -2032,43 +2915,64 @@ class StubFormatter (AstFormatter):
         self.patterns_dict = x.patterns_dict
         self.raw_format = AstFormatter().format
         self.regex_patterns = x.regex_patterns
+        self.matchers = x.matchers
+        self.match_cache = x.match_cache
         self.trace_matches = x.trace_matches
         self.trace_patterns = x.trace_patterns
         self.trace_reduce = x.trace_reduce
         self.trace_visitors = x.trace_visitors
+        self.trace_log = x.trace_log
         self.verbose = x.verbose
         
         # mypy workarounds
         self.seen_names = []
 
     matched_d = {}
+    match_cache_size = 4096
+        # The most entries of the shared match_cache, which is cleared when full.
 
     def match_all(self, node, s, trace=False):
         '''Match all the patterns for the given node.'''
-        trace = False or trace or self.trace_matches
-        # verbose = True
-        d = self.matched_d
         name = node.__class__.__name__
-        s1 = truncate(s, 40)
-        caller = g.callers(2).split(',')[1].strip()
+        if trace or self.trace_matches:
+            patterns = self.patterns_dict.get(name, []) + self.regex_patterns
+            return self.trace_match_all(name, s, patterns)
+        key = name, s
+        result = self.match_cache.get(key)
+        if result is None:
+            matcher = self.matchers.get(name) or self.matchers[None]
+            pattern = matcher.find(s)
+            result = pattern.match(s)[1] if pattern else s
+            if len(self.match_cache) >= self.match_cache_size:
+                self.match_cache.clear()
+            self.match_cache[key] = result
+        return result
+
+    def trace_match_all(self, name, s, patterns):
+        '''match_all, with --trace-matches.'''
+        d = self.matched_d
+        caller = g.callers(3).split(',')[1].strip()
             # The direct caller of match_all.
-        patterns = self.patterns_dict.get(name, []) + self.regex_patterns
+        s1 = s
+        t1 = time.perf_counter()
         for pattern in patterns:
-            found, s = pattern.match(s,trace=False)
+            found, s = pattern.match(s)
             if found:
-                if trace:
-                    aList = d.get(name, [])
-                    if pattern not in aList:
-                        aList.append(pattern)
-                        d [name] = aList
-                        print('match_all:    %-12s %26s %40s ==> %s' % (caller, pattern, s1, s))
                 break
-        return s
-
-    def visit(self, node):
-        '''StubFormatter.visit: supports --verbose tracing.'''
-        s = AstFormatter.visit(self, node)
-        # g.trace('%12s %s' % (node.__class__.__name__,s))
+        else:
+            pattern = None
+        elapsed = time.perf_counter() - t1
+        if self.trace_log:
+            self.trace_log.event('match', caller=caller, node=name,
+                pattern=pattern and pattern.find_s, input=s1, result=s,
+                tried=len(patterns), us=round(elapsed * 1e6, 1))
+        elif pattern:
+            aList = d.get(name, [])
+            if pattern not in aList:
+                aList.append(pattern)
+                d [name] = aList
+                print('match_all:    %-12s %26s %40s ==> %s' % (
+                    caller, pattern, truncate(s1, 40), s))
         return s
 
     def trace_visitor(self, node, op, s):
@@ -2076,7 +2980,11 @@ class StubFormatter (AstFormatter):
         if self.trace_visitors:
             caller = g.callers(2).split(',')[1]
             s1 = AstFormatter().format(node).strip()
-            print('%12s op %-6s: %s ==> %s' % (caller, op.strip(), s1, s))
+            if self.trace_log:
+                self.trace_log.event('visitor', caller=caller.strip(),
+                    op=op.strip(), input=s1, result=s)
+            else:
+                print('%12s op %-6s: %s ==> %s' % (caller, op.strip(), s1, s))
 
     # StubFormatter visitors for operands...
 
@@ -2097,18 +3005,16 @@ class StubFormatter (AstFormatter):
         return s2 or s
 
     # Return generic markers to allow better pattern matches.
+    # make_patterns_dict treats 'number' as a special case.
 
-    def do_Bytes(self, node): # Python 3.x only.
-        return 'bytes' # return str(node.s)
+    do_Constant = AstArgFormatter.do_Constant
+    do_JoinedStr = AstArgFormatter.do_JoinedStr
 
-    def do_Num(self, node):
-        # make_patterns_dict treats 'number' as a special case.
-        # return self.names_dict.get('number', 'number')
-        return 'number' # return repr(node.n)
+    # NamedExpr(expr target, expr value)
 
-    def do_Str(self, node):
-        '''This represents a string constant.'''
-        return 'str' # return repr(node.s)
+    def do_NamedExpr(self, node):
+        '''StubFormatter.NamedExpr: the type of the value.'''
+        return self.visit(node.value)
 
     def do_Dict(self, node):
         result = []
@@ -2206,7 +3112,7 @@ class StubFormatter (AstFormatter):
 
     # BoolOp(boolop op, expr* values)
 
-    def do_BoolOp(self, node): # Python 2.x only.
+    def do_BoolOp(self, node):
         '''StubFormatter.BoolOp visitor for 'and' and 'or'.'''
         trace = False or self.trace_reduce
         op = self.op_name(node.op)
@@ -2216,7 +3122,7 @@ class StubFormatter (AstFormatter):
         self.trace_visitor(node, op, s)
         return s
 
-    # Call(expr func, expr* args, keyword* keywords, expr? starargs, expr? kwargs)
+    # Call(expr func, expr* args, keyword* keywords)
 
     def do_Call(self, node):
         '''StubFormatter.Call visitor.'''
@@ -2226,10 +3132,6 @@ class StubFormatter (AstFormatter):
         for z in node.keywords:
             # Calls f.do_keyword.
             args.append(self.visit(z))
-        if getattr(node, 'starargs', None):
-            args.append('*%s' % (self.visit(node.starargs)))
-        if getattr(node, 'kwargs', None):
-            args.append('**%s' % (self.visit(node.kwargs)))
         args = [z for z in args if z] # Kludge: Defensive coding.
         # Explicit pattern:
         if func in ('dict', 'list', 'set', 'tuple',):
@@ -2243,14 +3145,6 @@ class StubFormatter (AstFormatter):
         self.trace_visitor(node, 'call', s)
         return s
 
-    # keyword = (identifier arg, expr value)
-
-    def do_keyword(self, node):
-        # node.arg is a string.
-        value = self.visit(node.value)
-        # This is a keyword *arg*, not a Python keyword!
-        return '%s=%s' % (node.arg, value)
-
     # Compare(expr left, cmpop* ops, expr* comparators)
 
     def do_Compare(self, node):
@@ -2356,6 +3250,7 @@ class StubTraverser (ast.NodeVisitor):
         self.def_patterns = x.def_patterns
         self.names_dict = x.names_dict
         self.general_patterns = x.general_patterns
+        self.arg_index = x.arg_index
         self.patterns_dict = x.patterns_dict
         
 
@@ -2386,39 +3281,89 @@ class StubTraverser (ast.NodeVisitor):
         if self.parent_stub:
             self.parent_stub.out_list.append(s)
         elif self.output_file:
-            self.output_file.write(s+'\n')
+            # Streaming: the same line as output_stubs.
+            self.output_file.write(s.rstrip()+'\n')
         else:
             print(s)
-    # pylint: disable=using-constant-test
-    def run(self, node):
-        '''StubTraverser.run: write the stubs in node's tree to self.output_fn.'''
+    def make_stubs(self, node):
+        '''
+        Return the stubs in node's tree as the text for self.output_fn,
+        or None if self.output_fn should not be written.
+        '''
         fn = self.output_fn
+        if not self.can_write(fn):
+            return None
+        if not self.update_flag:
+            return self.make_stub_text(node)
+        root = self.make_root(node)
+        root = self.update(fn, new_root=root)
+        return self.format_stubs(root)
+
+    def can_write(self, fn):
+        '''Return True if the stub file fn may be written.'''
         dir_ = os.path.dirname(fn)
         if os.path.exists(fn) and not self.overwrite:
             print('file exists: %s' % fn)
         elif not dir_ or os.path.exists(dir_):
-            #time.clock has been deprecated in Python 3.3 and will be removed from Python 3.8: use time.perf_counter or time.process_time instead
-            t1 = time.perf_counter()
-            # Delayed output allows sorting.
-            self.parent_stub = Stub(kind='root', name='<new-stubs>')
-            for z in self.prefix_lines or []:
-                self.parent_stub.out_list.append(z)
-            self.visit(node)
-                # Creates parent_stub.out_list.
-            if self.update_flag:
-                self.parent_stub = self.update(fn, new_root=self.parent_stub)
-            if 1:
-                self.output_file = open(fn, 'w')
-                self.output_stubs(self.parent_stub)
-                self.output_file.close()
-                self.output_file = None
-                self.parent_stub = None
-            t2 = time.perf_counter()
-            #do some stuff
-            if not self.silent:
-                print('wrote: %s in %4.2f sec' % (fn, t2 - t1))
+            return True
         else:
             print('output directory not not found: %s' % dir_)
+        return False
+
+    def make_stub_text(self, node, pyi=None):
+        '''
+        Return the text of the stub file for node's tree.
+        pyi is None, or the text of an existing stub file to update.
+        Reads and writes no files.
+        '''
+        if pyi is None:
+            f = io.StringIO()
+            self.write_stubs(node, f)
+            return f.getvalue()
+        root = self.make_root(node)
+        root = self.update_text(pyi, new_root=root)
+        return self.format_stubs(root)
+
+    def write_stubs(self, node, f):
+        '''
+        Write the stubs in node's tree to the open file f during the traversal.
+        Only a merge needs the tree of stubs that make_root creates.
+        '''
+        for z in self.prefix_lines or []:
+            f.write(z.rstrip()+'\n')
+        self.parent_stub, self.output_file = None, f
+        try:
+            self.visit(node)
+        finally:
+            self.output_file = None
+
+    def make_stub(self, kind, name):
+        '''Return a new Stub for a class or def, in the tree if there is one.'''
+        if self.parent_stub:
+            return Stub(kind, name, self.parent_stub, self.context_stack)
+        # Streaming: the stub only names the class or def, for add_stub.
+        stub = Stub(kind, name)
+        stub.full_name = '.'.join(self.context_stack + [name])
+        return stub
+
+    def make_root(self, node):
+        '''Return the root of the tree of stubs for node's tree.'''
+        # Delayed output allows sorting.
+        self.parent_stub = Stub(kind='root', name='<new-stubs>')
+        for z in self.prefix_lines or []:
+            self.parent_stub.out_list.append(z)
+        self.visit(node)
+            # Creates parent_stub.out_list.
+        root, self.parent_stub = self.parent_stub, None
+        return root
+
+    def format_stubs(self, root):
+        '''Return the text of all the stubs in root's tree.'''
+        self.output_file = io.StringIO()
+        self.output_stubs(root)
+        s = self.output_file.getvalue()
+        self.output_file = None
+        return s
 
     def output_stubs(self, stub):
         '''Output this stub and all its descendants.'''
@@ -2447,6 +3392,15 @@ class StubTraverser (ast.NodeVisitor):
         Return old_root, or new_root if there are any errors.
         '''
         s = self.get_stub_file(fn)
+        return self.update_text(s, new_root, fn)
+
+    def update_text(self, s, new_root, fn=None):
+        '''
+        Merge the new_root tree with the old_root tree in s, the text of a .pyi file.
+        fn is the name of the .pyi file, for messages.
+
+        Return old_root, or new_root if there are any errors.
+        '''
         if not s or not s.strip():
             return new_root
         if '\t' in s:
@@ -2460,7 +3414,8 @@ class StubTraverser (ast.NodeVisitor):
             if debug_flag:
                 print(self.trace_stubs(old_root, header='old_root'))
                 print(self.trace_stubs(new_root, header='new_root'))
-            print('***** updating stubs from %s *****' % fn)
+            if fn:
+                print('***** updating stubs from %s *****' % fn)
             self.merge_stubs(self.stubs_dict.values(), old_root, new_root)
             if debug_flag:
                 print(self.trace_stubs(old_root, header='updated_root'))
@@ -2470,16 +3425,7 @@ class StubTraverser (ast.NodeVisitor):
 
     def get_stub_file(self, fn):
         '''Read the stub file into s.'''
-        if os.path.exists(fn):
-            try:
-                s = open(fn, 'r').read()
-            except Exception:
-                print('--update: error reading %s' % fn)
-                s = None
-            return s
-        else:
-            print('--update: not found: %s' % fn)
-            return None
+        return self.controller.get_stub_file(fn)
 
     def parse_stub_file(self, s, root_name):
         '''
@@ -2494,7 +3440,7 @@ class StubTraverser (ast.NodeVisitor):
         indent_stack = [-1] # To prevent the root from being popped.
         stub_stack = [root]
         lines = []
-        pat = re.compile(r'^([ ]*)(def|class)\s+([a-zA-Z_]+)(.*)')
+        pat = re.compile(r'^([ ]*)(?:async\s+)?(def|class)\s+([a-zA-Z_]+)(.*)')
         for line in g.splitLines(s):
             m = pat.match(line)
             if m:
@@ -2551,6 +3497,7 @@ class StubTraverser (ast.NodeVisitor):
         - new_root is the root of the stubs from the .py file.
         '''
         trace = False or trace ; verbose = False
+        index = StubIndex(old_root)
         # Part 1: Delete old stubs do *not* exist in the *new* tree.
         aList = self.check_delete(new_stubs,
                                   old_root,
@@ -2563,24 +3510,26 @@ class StubTraverser (ast.NodeVisitor):
             dump_list('ordered delete list', aList)
         for stub in aList:
             if trace: g.trace('deleting  %s' % stub)
-            parent = self.find_parent_stub(stub, old_root) or old_root
-            parent.children.remove(stub)
-            assert not self.find_stub(stub, old_root), stub
+            parent = index.find_parent(stub) or old_root
+            index.detach(parent, stub)
+            assert not index.find(stub), stub
         # Part 2: Insert new stubs that *not* exist in the *old* tree.
-        aList = [z for z in new_stubs if not self.find_stub(z, old_root)]
+        aList = [z for z in new_stubs if not index.find(z)]
         aList = self.sort_stubs_by_hierarchy(aList)
             # Sort new stubs so that parents are created before children.
         for stub in aList:
             if trace: g.trace('inserting %s' % stub)
-            parent = self.find_parent_stub(stub, old_root) or old_root
-            parent.children.append(stub)
-            assert self.find_stub(stub, old_root), stub
+            parent = index.find_parent(stub) or old_root
+            index.attach(parent, stub)
+            assert index.find(stub), stub
 
     def check_delete(self, new_stubs, old_root, new_root, trace):
         '''Return a list of nodes that can be deleted.'''
         old_stubs = self.flatten_stubs(old_root)
         old_stubs.remove(old_root)
-        aList = [z for z in old_stubs if z not in new_stubs]
+        new_set = set(new_stubs)
+        aList = [z for z in old_stubs if z not in new_set]
+        delete_set = set(aList)
         if trace:
             dump_list('old_stubs', old_stubs)
             dump_list('new_stubs', new_stubs)
@@ -2598,7 +3547,7 @@ class StubTraverser (ast.NodeVisitor):
                     # if trace: g.trace('can delete', z1)
                     delete_list.append(z1)
                     break
-                elif z not in aList:
+                elif z not in delete_set:
                     g.trace("can not delete %s because of %s" % (z1, z))
                     break
             else:
@@ -2620,36 +3569,12 @@ class StubTraverser (ast.NodeVisitor):
         for child in root.children:
             self.flatten_stubs_helper(child, aList)
 
-    def find_parent_stub(self, stub, root):
-        '''Return stub's parent **in root's tree**.'''
-        return self.find_stub(stub.parent, root) if stub.parent else None
-
-    def find_stub(self, stub, root):
-        '''Return the stub **in root's tree** that matches stub.'''
-        if stub == root: # Must use Stub.__eq__!
-            return root # not stub!
-        for child in root.children:
-            stub2 = self.find_stub(stub, child)
-            if stub2: return stub2
-        return None
-
     def sort_stubs_by_hierarchy(self, stubs1):
         '''
         Sort the list of Stubs so that parents appear before all their
-        descendants.
-        '''
-        stubs, result = stubs1[:], []
-        for i in range(50):
-            if stubs:
-                # Add all stubs with i parents to the results.
-                found = [z for z in stubs if z.level() == i]
-                result.extend(found)
-                for z in found:
-                    stubs.remove(z)
-            else:
-                return result
-        g.trace('can not happen: unbounded stub levels.')
-        return [] # Abort the merge.
+        descendants, keeping the order of the stubs of each level.
+        '''
+        return sorted(stubs1, key=Stub.level)
 
     def trace_stubs(self, stub, aList=None, header=None, level=-1):
         '''Return a trace of the given stub and all its descendants.'''
@@ -2677,8 +3602,10 @@ class StubTraverser (ast.NodeVisitor):
         # Create the stub in the old context.
         old_stub = self.parent_stub
         self.class_defs_count = 0
-        self.parent_stub = Stub('class', node.name,old_stub, self.context_stack)
-        self.add_stub(self.stubs_dict, self.parent_stub)
+        stub = self.make_stub('class', node.name)
+        self.add_stub(self.stubs_dict, stub)
+        if old_stub:
+            self.parent_stub = stub
         # Enter the new context.
         self.class_name_stack.append(node.name)
         self.context_stack.append(node.name)
@@ -2686,7 +3613,7 @@ class StubTraverser (ast.NodeVisitor):
             print('\nclass %s\n' % node.name)
         #
         # Fix issue #2: look ahead to see if there are any functions in this class.
-        empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
+        empty = not any(isinstance(z, def_node_types) for z in node.body)
         tail = ' ...' if empty else ''
         #
         # Format...
@@ -2717,16 +3644,24 @@ class StubTraverser (ast.NodeVisitor):
     # 2: FunctionDef(identifier name, arguments args, stmt* body, expr* decorator_list)
     # 3: FunctionDef(identifier name, arguments args, stmt* body, expr* decorator_list,
     #                expr? returns)
+    # AsyncFunctionDef: the same fields.
 
 
-    def visit_FunctionDef(self, node):
+    def visit_FunctionDef(self, node, keyword='def'):
 
         # Create the stub in the old context.
         old_stub = self.parent_stub
-        self.parent_stub = Stub('def', node.name, old_stub, self.context_stack)
-        self.add_stub(self.stubs_dict, self.parent_stub)
+        stub = self.make_stub('def', node.name)
+        self.add_stub(self.stubs_dict, stub)
+        old_file = self.output_file
+        streaming = not old_stub and old_file
+        if old_stub:
+            self.parent_stub = stub
+        elif streaming:
+            # The stubs of nested classes and defs follow this def.
+            self.output_file = io.StringIO()
         # Enter the new context.
-        self.returns = []
+        old_returns, self.returns = self.returns, []
         self.level += 1
         self.context_stack.append(node.name)
         for z in node.body:
@@ -2737,13 +3672,24 @@ class StubTraverser (ast.NodeVisitor):
         # if self.trace_matches or self.trace_reduce:
             # if not self.class_name_stack:
                 # print('def %s\n' % node.name)
-        self.out('def %s(%s) -> %s' % (
+        if streaming:
+            nested, self.output_file = self.output_file, old_file
+        self.out('%s %s(%s) -> %s' % (
+            keyword,
             node.name,
             self.format_arguments(node.args),
             self.format_returns(node)))
+        if streaming:
+            self.output_file.write(nested.getvalue())
         self.parent_stub = old_stub
+        self.returns = old_returns
+
+    def visit_AsyncFunctionDef(self, node):
 
-    # arguments = (expr* args, identifier? vararg, identifier? kwarg, expr* defaults)
+        self.visit_FunctionDef(node, 'async def')
+
+    # arguments = (arg* posonlyargs, arg* args, arg? vararg, arg* kwonlyargs,
+    #              expr* kw_defaults, arg? kwarg, expr* defaults)
 
     def format_arguments(self, node):
         '''
@@ -2751,7 +3697,8 @@ class StubTraverser (ast.NodeVisitor):
         Similar to AstFormat.do_arguments, but it is not a visitor!
         '''
         assert isinstance(node,ast.arguments), node
-        args = [self.raw_format(z) for z in node.args]
+        posonlyargs = getattr(node, 'posonlyargs', []) # Python 3.8
+        args = [self.raw_format(z) for z in posonlyargs + node.args]
         defaults = [self.raw_format(z) for z in node.defaults]
         # Assign default values to the last args.
         result = []
@@ -2762,17 +3709,22 @@ class StubTraverser (ast.NodeVisitor):
                 result.append(s)
             else:
                 result.append('%s=%s' % (s, defaults[i - n_plain]))
-        # Now add the vararg and kwarg args.
-        name = getattr(node, 'vararg', None)
-        if name:
-            if hasattr(ast, 'arg'): # python 3:
-                name = self.raw_format(name)
-            result.append('*' + name)
-        name = getattr(node, 'kwarg', None)
-        if name:
-            if hasattr(ast, 'arg'): # python 3:
-                name = self.raw_format(name)
-            result.append('**' + name)
+            if i + 1 == len(posonlyargs):
+                result.append('/')
+        # Now add the vararg, or a bare * before keyword only args.
+        if node.vararg:
+            result.append('*' + self.raw_format(node.vararg))
+        elif node.kwonlyargs:
+            result.append('*')
+        # kw_defaults holds None for keyword only args without a default.
+        for arg, default in zip(node.kwonlyargs, node.kw_defaults):
+            s = self.munge_arg(self.raw_format(arg))
+            if default is None:
+                result.append(s)
+            else:
+                result.append('%s=%s' % (s, self.raw_format(default)))
+        if node.kwarg:
+            result.append('**' + self.raw_format(node.kwarg))
         return ', '.join(result)
 
     type_pattern = re.compile(r'.*:.*')
@@ -2781,9 +3733,9 @@ class StubTraverser (ast.NodeVisitor):
         '''Add an annotation for s if possible.'''
         if s == 'self':
             return s
-        for pattern in self.general_patterns:
-            if pattern.match_entire_string(s):
-                return '%s: %s' % (s, pattern.repl_s)
+        pattern = self.arg_index.find(s)
+        if pattern:
+            return '%s: %s' % (s, pattern.repl_s)
         if self.warn and s not in self.warn_list:
             self.warn_list.append(s)
             print('no annotation for %s' % s)
@@ -2808,7 +3760,7 @@ class StubTraverser (ast.NodeVisitor):
         if trace and self.returns:
             g.trace('name: %s r:\n%s' % (name, r))
         if not [z for z in self.returns if z.value is not None]:
-            empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
+            empty = not any(isinstance(z, def_node_types) for z in node.body)
             tail = ': ...' if empty else ':'
             return 'None' + tail
         # Step 2: [Def Name Patterns] override all other patterns.
@@ -2838,7 +3790,7 @@ class StubTraverser (ast.NodeVisitor):
         known = all([is_known_type(e) for e in reduced_returns])
         # g.trace(reduced_returns)
 
-        empty = not any(isinstance(z, ast.FunctionDef) for z in node.body)
+        empty = not any(isinstance(z, def_node_types) for z in node.body)
         tail = ': ...' if empty else ':'
 
         if not known or self.verbose:
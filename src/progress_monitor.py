@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Follow a createstubs.py run on a board, using the progress events it prints with --progress or Stubber(progress=True)
+Reads from a serial port, a pty, a file or stdin ('-'),
+shows the throughput and time left, and records the events to a json lines file
+
+    python src/progress_monitor.py /dev/ttyUSB0 --log esp32.jsonl
+    micropython createstubs.py --progress | python src/progress_monitor.py - --log unix.jsonl
+"""
+# Copyright (c) 2020 Jos Verlinde
+# MIT license
+# pylint: disable= line-too-long
+import sys
+import json
+import time
+import argparse
+import logging
+
+log = logging.getLogger(__name__)
+
+# must match createstubs.PROGRESS
+PROGRESS = '@stubber '
+
+
+class ProgressMonitor():
+    "Track the progress events of a stubber run"
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.events = []
+        self.total = 0
+        self.count = 0
+        self.started = None
+        self.finished = False
+        self.current = None
+        self.modules = []
+        self.skipped = []
+        self.errors = []
+
+    def feed(self, line: str):
+        "process a line of output, returns the event or None for other output"
+        i = line.find(PROGRESS)
+        if i == -1:
+            return None
+        try:
+            event = json.loads(line[i + len(PROGRESS):])
+        except ValueError:
+            log.warning("invalid progress event: {}".format(line.strip()))
+            return None
+        now = self.clock()
+        ev = event.get('ev')
+        if ev == 'run':
+            self.started = now
+            self.total = event.get('total', 0)
+        elif self.started is None:
+            # joined a run that was already going
+            self.started = now
+        if ev == 'start':
+            self.current = event.get('mod')
+        elif ev == 'end':
+            self.count += 1
+            self.current = None
+            if event.get('ok'):
+                self.modules.append(event)
+            else:
+                self.skipped.append(event)
+        elif ev == 'skip':
+            self.count += 1
+            self.skipped.append(event)
+        elif ev == 'error':
+            self.errors.append(event)
+        elif ev == 'done':
+            self.finished = True
+        event['host_t'] = round(now - self.started, 3)
+        self.events.append(event)
+        return event
+
+    @property
+    def elapsed(self) -> float:
+        "seconds since the start of the run"
+        if self.started is None:
+            return 0.0
+        return self.clock() - self.started
+
+    @property
+    def rate(self) -> float:
+        "modules per second"
+        if not self.count or not self.elapsed:
+            return 0.0
+        return self.count / self.elapsed
+
+    @property
+    def eta(self):
+        "estimated seconds left, None when unknown"
+        if not self.total or not self.rate:
+            return None
+        return max(self.total - self.count, 0) / self.rate
+
+    def status(self) -> str:
+        "a one line progress report"
+        eta = self.eta
+        return "[{:>3}/{:<3}] {:>5.1f} mod/s  ETA {:>7}  {}".format(
+            self.count,
+            self.total or '?',
+            self.rate,
+            '?' if eta is None else duration(eta),
+            self.current or ''
+        )
+
+    def summary(self, top: int = 5) -> str:
+        "totals, and the modules that took the most time and memory"
+        lines = ["{} modules in {}: {} stubs, {} skipped, {} errors".format(
+            self.count, duration(self.elapsed), len(self.modules), len(self.skipped), len(self.errors))]
+        if self.modules:
+            lines.append("slowest:")
+            for e in sorted(self.modules, key=lambda e: -e.get('ms', 0))[:top]:
+                lines.append("  {:<30} {:>7} ms".format(e['mod'], e.get('ms', 0)))
+            lines.append("most memory:")
+            for e in sorted(self.modules, key=lambda e: -e.get('used', 0))[:top]:
+                lines.append("  {:<30} {:>7} bytes".format(e['mod'], e.get('used', 0)))
+        for e in self.errors:
+            lines.append("error: {:<23} {}".format(e.get('mod', ''), e.get('err', '')))
+        return "\n".join(lines)
+
+
+def duration(seconds: float) -> str:
+    "format seconds as m:ss"
+    seconds = int(round(seconds))
+    return "{}:{:02}".format(seconds // 60, seconds % 60)
+
+
+def open_stream(port: str, baudrate: int = 115200):
+    "open stdin, a serial port (needs pyserial), or a pty / file"
+    if port == '-':
+        return sys.stdin
+    try:
+        import serial  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        serial = None
+    if serial and not port.endswith(('.log', '.txt', '.jsonl')):
+        try:
+            return serial.Serial(port, baudrate, timeout=1)
+        except (serial.SerialException, ValueError):
+            pass
+    return open(port, 'rb')
+
+
+def read_lines(stream):
+    "yield decoded lines until the end of the stream; a serial timeout is not the end"
+    is_serial = hasattr(stream, 'in_waiting')
+    while True:
+        line = stream.readline()
+        if not line:
+            if is_serial:
+                continue
+            return
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        yield line
+
+
+def monitor(stream, logfile=None, echo: bool = False, out=sys.stderr) -> ProgressMonitor:
+    "follow the stream until the run is done, optionally writing the events to logfile"
+    progress = ProgressMonitor()
+    eventlog = open(logfile, 'w') if logfile else None
+    try:
+        for line in read_lines(stream):
+            event = progress.feed(line)
+            if event is None:
+                if echo:
+                    print(line.rstrip(), file=out)
+                continue
+            if eventlog:
+                eventlog.write(json.dumps(event) + "\n")
+                eventlog.flush()
+            if echo:
+                print(progress.status(), file=out)
+            else:
+                print(progress.status().ljust(79), end='\r', file=out)
+            if progress.finished:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if eventlog:
+            eventlog.close()
+    print("", file=out)
+    print(progress.summary(), file=out)
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow the progress of createstubs.py on a board")
+    parser.add_argument('port', help="serial port, pty or file to read, or - for stdin")
+    parser.add_argument('-b', '--baudrate', type=int, default=115200)
+    parser.add_argument('-l', '--log', help="record the events to this json lines file")
+    parser.add_argument('-e', '--echo', action='store_true', help="also show the other output of the board")
+    args = parser.parse_args()
+    stream = open_stream(args.port, args.baudrate)
+    try:
+        progress = monitor(stream, args.log, args.echo)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return 0 if progress.finished and not progress.errors else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)-8s:%(message)s', level=logging.INFO)
+    sys.exit(main())
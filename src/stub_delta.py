@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Store the stub folders of consecutive firmware versions as a base folder plus a delta
+The delta is made per symbol, the classes, defs and constants of each module, not per line,
+and a rebuild makes the .pyi files again only for the modules whose classes or defs changed
+
+    python src/stub_delta.py diff all-stubs/micropython-linux-1_12 all-stubs/micropython-linux-1_13
+    python src/stub_delta.py store all-stubs/micropython-linux-1_12 all-stubs/micropython-linux-1_13
+    python src/stub_delta.py rebuild all-stubs/micropython-linux-1_12 all-stubs/micropython-linux-1_13.delta.json.gz
+"""
+# Copyright (c) 2020 Jos Verlinde
+# MIT license
+# pylint: disable= line-too-long
+import os
+import re
+import ast
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import logging
+import utils
+from make_stub_files import compile_config_file, make_stub_string
+
+log = logging.getLogger(__name__)
+
+DELTA_FORMAT = 1
+DELTA_SUFFIX = ".delta.json.gz"
+# the key of the comments and blank lines before the first statement of a module
+HEADER = "<header>"
+# the lines of a text with their line ends, the lines that ast counts
+LINE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+\Z")
+DEFS = (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def read_text(path: str) -> str:
+    "the text of a file, as is: line ends are kept and bytes that are not utf-8 survive a write_text"
+    with open(path, encoding="utf-8", errors="surrogateescape", newline="") as f:
+        return f.read()
+
+
+def write_text(path: str, text: str):
+    "write a file, without changing the copies that are linked to the same store object"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    utils.unshare(path)
+    with open(path, "w", encoding="utf-8", errors="surrogateescape", newline="") as f:
+        f.write(text)
+
+
+def first_line(node) -> int:
+    "the index of the first line of a statement, its decorators included"
+    return min([node.lineno] + [z.lineno for z in getattr(node, "decorator_list", [])]) - 1
+
+
+def statement_key(node) -> str:
+    "the name a statement defines, or its kind"
+    if isinstance(node, DEFS):
+        return node.name
+    if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+        return "<doc>"
+    targets = []
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+        targets = [node.target]
+    names = [z.id for z in targets if isinstance(z, ast.Name)]
+    return ",".join(names) or "<{}>".format(node.__class__.__name__)
+
+
+def symbol_table(text: str) -> list:
+    """
+    split the text of a module into its symbols, a list of [key, text, stub, start, end] in the order of the module.
+    the texts of the symbols add up to the text of the module, the comments and blank lines after a statement are part of it;
+    start and end are the indexes of its first line and of the line after it.
+    a class is split into a symbol for its class line and one per statement of its body, with keys class.name.
+    stub is True for the symbols that the .pyi file depends on: classes, defs and any statement with a class or def inside.
+    returns None if the text does not parse
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    lines = LINE.findall(text)
+    symbols = []
+    seen = {}
+
+    def add(key, start, end, stub):
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = "{}#{}".format(key, seen[key])
+        symbols.append([key, "".join(lines[start:end]), stub, start, end])
+        return key
+
+    def starts(nodes, start, end):
+        "the line ranges of a list of statements, between start and end"
+        result = []
+        for node in nodes:
+            start = min(max(start, first_line(node)), end)
+            result.append(start)
+        return list(zip(result, result[1:] + [end]))
+
+    ranges = starts(tree.body, 0, len(lines))
+    add(HEADER, 0, ranges[0][0] if ranges else len(lines), False)
+    for node, (start, end) in zip(tree.body, ranges):
+        if isinstance(node, ast.ClassDef):
+            members = starts(node.body, start, end)
+            key = add(statement_key(node), start, members[0][0], True)
+            for member, (m_start, m_end) in zip(node.body, members):
+                add("{}.{}".format(key, statement_key(member)), m_start, m_end, True)
+        else:
+            stub = any(isinstance(z, DEFS) for z in ast.walk(node))
+            add(statement_key(node), start, end, stub)
+    return symbols
+
+
+def diff_symbols(old: list, new: list) -> dict:
+    "the keys of the symbols that were added, removed or changed from the old to the new symbol table"
+    old_d = {z[0]: z[1] for z in old}
+    new_d = {z[0]: z[1] for z in new}
+    return {
+        "added": [key for key in new_d if key not in old_d],
+        "removed": [key for key in old_d if key not in new_d],
+        "changed": [key for key in new_d if key in old_d and old_d[key] != new_d[key]],
+    }
+
+
+def stub_symbols(symbols: list) -> list:
+    "the keys and texts of the symbols that the .pyi file depends on"
+    return [(z[0], z[1]) for z in symbols if z[2]]
+
+
+def tree_files(folder: str) -> list:
+    """
+    the relative paths, with / separators, of the files of a stub folder that go in a delta.
+    the .pyi files are made again from the .py files; like glob, names that start with '.' are skipped
+    """
+    result = []
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+        for name in sorted(names):
+            if not name.startswith(".") and not name.endswith((".pyi", ".pyc")):
+                result.append(os.path.relpath(os.path.join(root, name), folder).replace(os.sep, "/"))
+    return result
+
+
+def tree_digest(texts) -> str:
+    "the sha256 of the paths and texts of a version"
+    h = hashlib.sha256()
+    for path, text in texts:
+        h.update(path.encode("utf-8") + b"\0")
+        h.update(text.encode("utf-8", "surrogateescape") + b"\0")
+    return h.hexdigest()
+
+
+def diff_trees(base: str, new: str) -> dict:
+    """
+    the symbol level diff of two stub folders.
+    returns a dict with the paths that were added and removed, and for each changed module
+    the keys of its added, removed and changed symbols, and if its .pyi file changes
+    """
+    base_files, new_files = tree_files(base), tree_files(new)
+    report = {"added": sorted(set(new_files) - set(base_files)), "removed": sorted(set(base_files) - set(new_files)), "changed": {}, "same": 0}
+    for path in sorted(set(base_files) & set(new_files)):
+        old_text, new_text = read_text(os.path.join(base, path)), read_text(os.path.join(new, path))
+        if old_text == new_text:
+            report["same"] += 1
+            continue
+        is_py = path.endswith(".py")
+        old, symbols = (symbol_table(old_text), symbol_table(new_text)) if is_py else (None, None)
+        if old is None or symbols is None:
+            report["changed"][path] = {"text": True, "stub": is_py}
+        else:
+            report["changed"][path] = dict(diff_symbols(old, symbols), stub=stub_symbols(old) != stub_symbols(symbols))
+    return report
+
+
+def make_delta(base: str, new: str) -> dict:
+    """
+    the delta from the base folder to the new folder, a json-able dict:
+    - files: the paths of the new version, the files that are not in text or symbols are the same as in the base
+    - text: the full text of the files that were added, and of the changed files that are not python or do not parse
+    - symbols: for the other changed modules, in order: [key, text] for a symbol that changed,
+      and [start, end], a range of lines of the base file, for a run of symbols that did not
+    - restub: the paths of the .py files whose .pyi file must be made again
+    - digest: of the new version, to check a rebuild
+    """
+    delta = {"format": DELTA_FORMAT, "base": os.path.basename(os.path.normpath(base)), "files": tree_files(new), "text": {}, "symbols": {}, "restub": []}
+    texts = []
+    for path in delta["files"]:
+        text = read_text(os.path.join(new, path))
+        texts.append((path, text))
+        base_path = os.path.join(base, path)
+        old_text = read_text(base_path) if os.path.isfile(base_path) else None
+        if text == old_text:
+            continue
+        old = symbol_table(old_text) if old_text is not None and path.endswith(".py") else None
+        symbols = symbol_table(text) if old is not None else None
+        if symbols is None:
+            delta["text"][path] = text
+            if path.endswith(".py"):
+                delta["restub"].append(path)
+            continue
+        old_d = {z[0]: z for z in old}
+        patch = delta["symbols"][path] = []
+        for key, text, *_ in symbols:
+            if key not in old_d or old_d[key][1] != text:
+                patch.append([key, text])
+            elif patch and isinstance(patch[-1][0], int) and patch[-1][1] == old_d[key][3]:
+                patch[-1][1] = old_d[key][4]
+            else:
+                patch.append(old_d[key][3:5])
+        if stub_symbols(old) != stub_symbols(symbols):
+            delta["restub"].append(path)
+    delta["digest"] = tree_digest(texts)
+    return delta
+
+
+def write_delta(delta: dict, path: str):
+    "write a delta as json, gzipped if path ends with .gz"
+    data = json.dumps(delta, separators=(",", ":")).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data) if path.endswith(".gz") else data)
+
+
+def read_delta(path: str) -> dict:
+    with open(path, "rb") as f:
+        data = f.read()
+    delta = json.loads(gzip.decompress(data) if path.endswith(".gz") else data)
+    if delta.get("format") != DELTA_FORMAT:
+        raise ValueError("unknown delta format {} in {}".format(delta.get("format"), path))
+    return delta
+
+
+def rebuild(base: str, delta: dict, dest: str, stubs: bool = True, config_fn: str = None) -> dict:
+    """
+    rebuild the version of a delta from its base folder into dest.
+    with stubs, the .pyi files of the modules in the restub list of the delta are made again,
+    those of the other modules are copied from the base folder.
+    raises ValueError, before anything is written, if the result would not be the version the delta was made from,
+    as when the base folder changed.
+    returns a dict with the number of files, the files copied from the base, and the .pyi files made and copied
+    """
+    result = {"files": len(delta["files"]), "copied": 0, "stubs_made": 0, "stubs_copied": 0}
+    restub = set(delta["restub"])
+    # check the base before writing anything
+    texts = []
+    for path in delta["files"]:
+        src = os.path.join(base, *path.split("/"))
+        if path not in delta["text"] and not os.path.isfile(src):
+            raise ValueError("{} is not the base of this delta, it has no {}".format(base, path))
+        if path in delta["text"]:
+            text = delta["text"][path]
+        elif path in delta["symbols"]:
+            lines = LINE.findall(read_text(src))
+            text = "".join("".join(lines[z[0]:z[1]]) if isinstance(z[0], int) else z[1] for z in delta["symbols"][path])
+        else:
+            text = read_text(src)
+        texts.append((path, text))
+    if tree_digest(texts) != delta["digest"]:
+        raise ValueError("{} is not the base of this delta, a rebuild would differ from the stored version".format(base))
+    config = None
+    for path, text in texts:
+        src, out = os.path.join(base, *path.split("/")), os.path.join(dest, *path.split("/"))
+        if path in delta["text"] or path in delta["symbols"]:
+            write_text(out, text)
+        else:
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            utils.unshare(out)
+            shutil.copyfile(src, out)
+            result["copied"] += 1
+        if not stubs or not path.endswith(".py"):
+            continue
+        if path not in restub and os.path.isfile(src + "i"):
+            utils.unshare(out + "i")
+            shutil.copyfile(src + "i", out + "i")
+            result["stubs_copied"] += 1
+            continue
+        config = config or compile_config_file(config_fn)
+        try:
+            write_text(out + "i", make_stub_string(text, config, fn=out))
+            result["stubs_made"] += 1
+        except SyntaxError as e:
+            log.warning("no stub for {}: {}".format(out, e))
+    log.info("rebuilt {files} files, {copied} the same as the base, {stubs_made} stubs made, {stubs_copied} copied".format(**result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Store a stub folder as a symbol level delta to the stub folder of another version")
+    commands = parser.add_subparsers(dest="command")
+    cmd = commands.add_parser("diff", help="show the symbols that changed between two stub folders")
+    cmd.add_argument("base")
+    cmd.add_argument("new")
+    cmd.add_argument("-o", "--output", help="write the diff to this json file")
+    cmd = commands.add_parser("store", help="write the delta from the base folder to the new folder")
+    cmd.add_argument("base")
+    cmd.add_argument("new")
+    cmd.add_argument("-o", "--output", help="the delta file, default <new>{}".format(DELTA_SUFFIX))
+    cmd = commands.add_parser("rebuild", help="rebuild the stub folder of a delta")
+    cmd.add_argument("base")
+    cmd.add_argument("delta")
+    cmd.add_argument("-o", "--output", help="the folder to rebuild, default the name of the delta file without {}".format(DELTA_SUFFIX))
+    cmd.add_argument("--no-stubs", action="store_true", help="do not make or copy the .pyi files")
+    cmd.add_argument("-c", "--config", help="the make_stub_files configuration file")
+    args = parser.parse_args()
+    if args.command == "diff":
+        report = diff_trees(args.base, args.new)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=4)
+        for path in report["added"]:
+            print("added    {}".format(path))
+        for path in report["removed"]:
+            print("removed  {}".format(path))
+        for path, change in report["changed"].items():
+            symbols = ", ".join("{}{}".format(sign, key) for sign, kind in (("+", "added"), ("-", "removed"), ("~", "changed")) for key in change.get(kind, []))
+            print("changed  {}{}: {}".format(path, " (pyi)" if change["stub"] else "", symbols or "text"))
+        print("{} added, {} removed, {} changed, {} the same".format(len(report["added"]), len(report["removed"]), len(report["changed"]), report["same"]))
+    elif args.command == "store":
+        output = args.output or os.path.normpath(args.new) + DELTA_SUFFIX
+        delta = make_delta(args.base, args.new)
+        write_delta(delta, output)
+        size = sum(os.path.getsize(os.path.join(args.new, z)) for z in delta["files"])
+        print("{} files, {} by symbol, {} whole, {} stubs to make: {} bytes for {} bytes".format(
+            len(delta["files"]), len(delta["symbols"]), len(delta["text"]), len(delta["restub"]), os.path.getsize(output), size))
+    elif args.command == "rebuild":
+        output = args.output or (args.delta[: -len(DELTA_SUFFIX)] if args.delta.endswith(DELTA_SUFFIX) else None)
+        if not output:
+            parser.error("rebuild needs --output")
+        try:
+            result = rebuild(args.base, read_delta(args.delta), output, stubs=not args.no_stubs, config_fn=args.config)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+        print("{files} files, {copied} the same as the base, {stubs_made} stubs made, {stubs_copied} copied".format(**result))
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)-8s:%(message)s', level=logging.INFO)
+    sys.exit(main())
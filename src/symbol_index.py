@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Index the symbols of a stub folder in a SQLite database: symbol -> module -> firmware and version
+The firmwares are the folders with a modules.json manifest or with stub files of their own, an update parses only the stub files that changed
+
+    python src/symbol_index.py update [all-stubs]
+    python src/symbol_index.py query machine.Pin.irq
+    python src/symbol_index.py query RMT --port esp32 --since
+"""
+# Copyright (c) 2020 Jos Verlinde
+# MIT license
+# pylint: disable= line-too-long
+# Only the standard library, and not utils: it imports make_stub_files, too slow to start a query.
+import os
+import re
+import ast
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import logging
+
+log = logging.getLogger(__name__)
+
+STUB_FOLDER = "./all-stubs"
+INDEX_FN = ".symbols.db"
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS firmware (
+    id INTEGER PRIMARY KEY, folder TEXT UNIQUE NOT NULL, manifest_mtime INTEGER,
+    firmware TEXT, family TEXT, port TEXT, version TEXT);
+CREATE TABLE IF NOT EXISTS file (
+    id INTEGER PRIMARY KEY, firmware INTEGER NOT NULL, path TEXT NOT NULL, module TEXT NOT NULL,
+    size INTEGER, mtime INTEGER, UNIQUE (firmware, path));
+CREATE TABLE IF NOT EXISTS name (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, leaf TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS name_leaf ON name (leaf);
+CREATE TABLE IF NOT EXISTS symbol (name INTEGER NOT NULL, file INTEGER NOT NULL, kind TEXT NOT NULL, PRIMARY KEY (name, file)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS symbol_file ON symbol (file);
+"""
+# the kinds of symbols
+KINDS = {"c": "class", "d": "def", "v": "variable"}
+
+
+def index_path(folder: str) -> str:
+    "the default index of a stub folder"
+    return os.path.join(folder, INDEX_FN)
+
+
+def connect(db: str) -> sqlite3.Connection:
+    "open an index, creating its tables if needed"
+    conn = sqlite3.connect(db)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def module_symbols(source: str) -> list:
+    """
+    the names and kinds of the classes, defs and variables of a module, and of the members of its classes, in order.
+    the names of members are class.member; the bodies of if and try statements are included
+    """
+    result = {}
+
+    def walk(body, prefix):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                result.setdefault(prefix + node.name, "c")
+                walk(node.body, prefix + node.name + ".")
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                result.setdefault(prefix + node.name, "d")
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    if isinstance(target, ast.Name):
+                        result.setdefault(prefix + target.id, "v")
+            elif isinstance(node, ast.If):
+                walk(node.body + node.orelse, prefix)
+            elif isinstance(node, ast.Try):
+                walk(node.body + node.orelse + node.finalbody + [z for h in node.handlers for z in h.body], prefix)
+
+    walk(ast.parse(source).body, "")
+    return list(result.items())
+
+
+def module_name(path: str) -> str:
+    "the module of a stub file, from its path in the firmware folder"
+    name = os.path.splitext(path)[0].replace("/", ".")
+    if name.endswith(".__init__"):
+        name = name[: -len(".__init__")]
+    return name
+
+
+def find_firmwares(folder: str) -> dict:
+    """
+    the stub files of each firmware below folder: {firmware folder: {path: (size, mtime)}}, relative with / separators.
+    a firmware folder has a modules.json, or has stub files of its own and is not below a firmware folder.
+    a firmware folder owns all of its sub folders, as packages, except those with a modules.json.
+    so the board folders of micropython-1_15-frozen/<port>/<board> are firmwares of their own.
+    the stub files directly in folder are the firmware '.', which owns no sub folders.
+    when a module has both, the .py file is indexed and not the .pyi file. names that start with '.' are skipped
+    """
+    firmwares = {}
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+        rel = os.path.relpath(root, folder).replace(os.sep, "/")
+        if "modules.json" in names:
+            firmwares[rel] = {}
+        # the nearest firmware folder, or this folder
+        owner = rel
+        while owner not in firmwares and "/" in owner:
+            owner = owner.rsplit("/", 1)[0]
+        if owner not in firmwares:
+            owner = rel
+        for name in sorted(names):
+            base, ext = os.path.splitext(name)
+            if name.startswith(".") or ext not in (".py", ".pyi") or (ext == ".pyi" and base + ".py" in names):
+                continue
+            st = os.stat(os.path.join(root, name))
+            path = name if rel == "." else rel + "/" + name
+            files = firmwares.setdefault(owner, {})
+            files[path[len(owner) + 1:] if owner != "." else path] = (st.st_size, st.st_mtime_ns)
+    return firmwares
+
+
+def read_manifest(path: str) -> dict:
+    "the firmware of a modules.json, or an empty dict"
+    try:
+        with open(path) as f:
+            firmware = json.load(f).get("firmware", {})
+    except (ValueError, OSError, AttributeError) as e:
+        log.warning("ignoring invalid manifest {}: {}".format(path, e))
+        return {}
+    return firmware if isinstance(firmware, dict) else {}
+
+
+def update_index(folder: str = STUB_FOLDER, db: str = None) -> dict:
+    """
+    bring the index of a stub folder up to date: the firmwares and files that were removed are dropped,
+    and only the stub files that were added or changed (size or mtime) are parsed.
+    returns a dict with the number of firmwares, files, files parsed, files removed and symbols
+    """
+    db = db or index_path(folder)
+    conn = connect(db)
+    root = os.path.realpath(folder)
+    stats = {"firmwares": 0, "files": 0, "parsed": 0, "removed": 0, "symbols": 0}
+    with conn:
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if meta.get("root") != root or meta.get("schema") != str(SCHEMA_VERSION):
+            # another folder, or an older index: start again
+            for table in ("symbol", "name", "file", "firmware", "meta"):
+                conn.execute("DELETE FROM {}".format(table))
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [("root", root), ("schema", str(SCHEMA_VERSION))])
+        found = find_firmwares(folder)
+        known = {row[1]: row for row in conn.execute("SELECT id, folder, manifest_mtime FROM firmware")}
+        for name in sorted(set(known) - set(found)):
+            ids = [row[0] for row in conn.execute("SELECT id FROM file WHERE firmware = ?", (known[name][0],))]
+            stats["removed"] += len(ids)
+            conn.executemany("DELETE FROM symbol WHERE file = ?", [(z,) for z in ids])
+            conn.execute("DELETE FROM file WHERE firmware = ?", (known[name][0],))
+            conn.execute("DELETE FROM firmware WHERE id = ?", (known[name][0],))
+        names = dict(conn.execute("SELECT name, id FROM name"))
+        for fw_folder, files in sorted(found.items()):
+            manifest = os.path.join(folder, fw_folder, "modules.json")
+            mtime = os.stat(manifest).st_mtime_ns if os.path.isfile(manifest) else None
+            if fw_folder not in known or known[fw_folder][2] != mtime:
+                firmware = read_manifest(manifest) if mtime else {}
+                row = (
+                    mtime,
+                    firmware.get("firmware") or firmware.get("name") or os.path.basename(os.path.abspath(os.path.join(folder, fw_folder))),
+                    firmware.get("family"),
+                    firmware.get("port"),
+                    firmware.get("version") or firmware.get("ver"),
+                )
+                if fw_folder in known:
+                    conn.execute("UPDATE firmware SET manifest_mtime = ?, firmware = ?, family = ?, port = ?, version = ? WHERE id = ?", row + (known[fw_folder][0],))
+                    fw_id = known[fw_folder][0]
+                else:
+                    fw_id = conn.execute("INSERT INTO firmware (manifest_mtime, firmware, family, port, version, folder) VALUES (?, ?, ?, ?, ?, ?)", row + (fw_folder,)).lastrowid
+            else:
+                fw_id = known[fw_folder][0]
+            old = {row[1]: row for row in conn.execute("SELECT id, path, size, mtime FROM file WHERE firmware = ?", (fw_id,))}
+            for path in sorted(set(old) - set(files)):
+                stats["removed"] += 1
+                conn.execute("DELETE FROM symbol WHERE file = ?", (old[path][0],))
+                conn.execute("DELETE FROM file WHERE id = ?", (old[path][0],))
+            for path, (size, mtime) in sorted(files.items()):
+                if path in old and old[path][2:] == (size, mtime):
+                    continue
+                fn = os.path.join(folder, fw_folder, path)
+                try:
+                    with open(fn, encoding="utf-8", errors="replace") as f:
+                        symbols = module_symbols(f.read())
+                except (SyntaxError, ValueError) as e:
+                    log.warning("no symbols for {}: {}".format(fn, e))
+                    symbols = []
+                stats["parsed"] += 1
+                module = module_name(path)
+                if path in old:
+                    file_id = old[path][0]
+                    conn.execute("DELETE FROM symbol WHERE file = ?", (file_id,))
+                    conn.execute("UPDATE file SET size = ?, mtime = ? WHERE id = ?", (size, mtime, file_id))
+                else:
+                    file_id = conn.execute("INSERT INTO file (firmware, path, module, size, mtime) VALUES (?, ?, ?, ?, ?)", (fw_id, path, module, size, mtime)).lastrowid
+                rows = []
+                for name, kind in symbols:
+                    full = module + "." + name
+                    if full not in names:
+                        names[full] = conn.execute("INSERT INTO name (name, leaf) VALUES (?, ?)", (full, full.rsplit(".", 1)[1])).lastrowid
+                    rows.append((names[full], file_id, kind))
+                conn.executemany("INSERT INTO symbol (name, file, kind) VALUES (?, ?, ?)", rows)
+        if stats["removed"] or stats["parsed"]:
+            conn.execute("DELETE FROM name WHERE id NOT IN (SELECT name FROM symbol)")
+        stats["firmwares"] = len(found)
+        stats["files"] = sum(len(z) for z in found.values())
+        stats["symbols"] = conn.execute("SELECT count(*) FROM symbol").fetchone()[0]
+    conn.close()
+    log.info("indexed {symbols} symbols of {files} files in {firmwares} firmwares, parsed {parsed} files, removed {removed}".format(**stats))
+    return stats
+
+
+def query(db: str, symbol: str, family: str = None, port: str = None, folder: str = None) -> list:
+    """
+    the firmwares that have a symbol: module.name, or the end of it, as in Pin.irq, or a glob pattern as in machine.*.irq.
+    family and port select on the manifest, folder is a glob pattern for the firmware folder.
+    returns a list of dicts with the name, kind, module, folder, firmware, family, port and version, sorted on name and version
+    """
+    if not os.path.isfile(db):
+        raise FileNotFoundError("no symbol index {}, run: symbol_index.py update".format(db))
+    sql = [
+        "SELECT n.name, s.kind, f.module, fw.folder, fw.firmware, fw.family, fw.port, fw.version",
+        "FROM name n JOIN symbol s ON s.name = n.id JOIN file f ON f.id = s.file JOIN firmware fw ON fw.id = f.firmware",
+    ]
+    if any(c in symbol for c in "*?["):
+        where, args = ["n.name GLOB ?"], [symbol]
+    else:
+        where = ["n.leaf = ?", "(n.name = ? OR substr(n.name, -?) = ?)"]
+        args = [symbol.rsplit(".", 1)[-1], symbol, len(symbol) + 1, "." + symbol]
+    for column, value in (("fw.family", family), ("fw.port", port)):
+        if value:
+            where.append("{} = ?".format(column))
+            args.append(value)
+    if folder:
+        where.append("fw.folder GLOB ?")
+        args.append(folder)
+    conn = sqlite3.connect("file:{}?mode=ro".format(db), uri=True)
+    try:
+        rows = conn.execute("\n".join(sql + ["WHERE " + " AND ".join(where)]), args).fetchall()
+    finally:
+        conn.close()
+    keys = ("name", "kind", "module", "folder", "firmware", "family", "port", "version")
+    result = [dict(zip(keys, row), kind=KINDS.get(row[1], row[1])) for row in rows]
+    result.sort(key=lambda z: (z["name"], version_key(z["version"]), z["folder"]))
+    return result
+
+
+def version_key(version: str) -> tuple:
+    "sort key of a version: '1.9.4' < 'v1.13'"
+    return tuple(int(z) for z in re.findall(r"\d+", version or ""))
+
+
+def since(rows: list) -> list:
+    "per symbol, family and port: the first version and the number of versions that have it"
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["name"], row["family"], row["port"]), set()).add(row["version"])
+    return [
+        {"name": name, "family": family, "port": port, "since": min(versions, key=version_key), "versions": len(versions)}
+        for (name, family, port), versions in sorted(groups.items(), key=lambda z: tuple(str(x) for x in z[0]))
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the symbols of a stub folder, and find the firmwares that have a symbol")
+    commands = parser.add_subparsers(dest="command")
+    cmd = commands.add_parser("update", help="index the stub files that were added or changed")
+    cmd.add_argument("folder", nargs="?", default=STUB_FOLDER, help="the stub folder, default {}".format(STUB_FOLDER))
+    cmd.add_argument("--db", help="the index, default <folder>/{}".format(INDEX_FN))
+    cmd = commands.add_parser("query", help="the firmwares that have a symbol")
+    cmd.add_argument("symbol", help="module.name, the end of it as in Pin.irq, or a glob pattern")
+    cmd.add_argument("--db", default=index_path(STUB_FOLDER), help="the index, default %(default)s")
+    cmd.add_argument("--family")
+    cmd.add_argument("--port")
+    cmd.add_argument("--folder", help="a glob pattern for the firmware folder")
+    cmd.add_argument("--since", action="store_true", help="show the first version per symbol and port")
+    cmd.add_argument("--json", action="store_true", help="print the result as json")
+    args = parser.parse_args()
+    if args.command == "update":
+        start = time.perf_counter()
+        stats = update_index(args.folder, args.db)
+        print("{symbols} symbols, {files} files, {firmwares} firmwares: parsed {parsed}, removed {removed}".format(**stats),
+              "in {:.2f}s".format(time.perf_counter() - start))
+    elif args.command == "query":
+        try:
+            rows = query(args.db, args.symbol, family=args.family, port=args.port, folder=args.folder)
+        except FileNotFoundError as e:
+            print(e, file=sys.stderr)
+            return 1
+        if args.since:
+            rows = since(rows)
+        if args.json:
+            print(json.dumps(rows, indent=4))
+            return 0 if rows else 1
+        for row in rows:
+            row = {k: "-" if v is None else v for k, v in row.items()}
+            if args.since:
+                print("{name:<30} {family:<12} {port:<10} since {since:<8} ({versions} versions)".format(**row))
+            else:
+                print("{name:<30} {kind:<8} {version:<8} {folder}".format(**row))
+        return 0 if rows else 1
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)-8s:%(message)s', level=logging.INFO)
+    sys.exit(main())
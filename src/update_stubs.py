@@ -9,8 +9,9 @@ The all_stubs folder should be mapped/symlinked to the micropython_stubs/stubs r
 # MIT license
 # pylint: disable= line-too-long
 import logging
-import utils
 import sys
+import utils
+from make_stub_files import make_stub_tree
 
 log = logging.getLogger(__name__)
 
@@ -23,4 +24,9 @@ if __name__ == "__main__":
     elif len(sys.argv) == 2:
         stub_path = sys.argv[1]
     log.info("Generate type hint files (pyi) in folder: {}".format(stub_path))
-    utils.make_stub_files(stub_path, levels=7)
\ No newline at end of file
+    make_stub_tree(stub_path, jobs=0)
+    # the stubs that make_stub_files could not make, or made wrong
+    report = utils.validate_stubs(stub_path, require_pyi=True)
+    for failure in report["failures"]:
+        log.error("{kind:<9} {file}:{line}: {message}".format(**failure))
+    sys.exit(1 if report["failures"] else 0)
\ No newline at end of file
@@ -1,12 +1,22 @@
 import os
+import ast
 import glob
+import fnmatch
 import json
+import shutil
+import hashlib
 import logging
+import multiprocessing
 from version import VERSION
+from make_stub_files import make_stub_tree, unshare  # pylint: disable=unused-import
 
 log = logging.getLogger(__name__)
 
 STUB_FOLDER = "./all-stubs"
+# the content-addressed store, in the root of the stub folder
+OBJECT_FOLDER = ".objects"
+# the files that are shared through the store
+STORE_PATTERNS = ("*.py", "*.pyi")
 
 
 def clean_version(version: str, build: bool = False):
@@ -31,19 +41,143 @@ def flat_version(version: str):
     return version.replace("v", "").replace(".", "_")
 
 
-def make_stub_files(stub_path, levels: int = 1):
-    "generate typeshed files for all scripts in a folder"
-    level = ""
-    # make_sub_files.py only does one folder level at a time
-    # so lets try 7 levels /** ,  /**/** , etc
-    # and does not work well if loaded as a module
-    for i in range(levels):
-        cmd = "python ./src/make_stub_files.py -c ./src/make_stub_files.cfg -u {}{}/*.py".format(
-            stub_path, level
-        )
-        log.debug("level {} : {}".format(i + 1, cmd))
-        os.system(cmd)
-        level = level + "/**"
+def make_stub_files(stub_path, levels: int = None, jobs: int = 1, compact: bool = False):
+    "generate typeshed files for all scripts in a folder and its sub folders, up to levels deep, using jobs processes"
+    stats = {}
+    count = make_stub_tree(stub_path, levels=levels, jobs=jobs, stats=stats)
+    log.debug("processed {} scripts in {}".format(count, stub_path))
+    if stats:
+        log.info("{regenerated} stubs regenerated, {skipped} skipped (unchanged), {errors} errors in {}".format(stub_path, **stats))
+    if compact:
+        compact_folder(stub_path)
+
+
+def file_digest(path: str) -> str:
+    "the sha256 of the content of a file"
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def object_path(store: str, digest: str) -> str:
+    "the path of an object in the store"
+    return os.path.join(store, digest)
+
+
+def link_file(obj: str, path: str) -> str:
+    """
+    replace path with a hardlink to the object, or a relative symlink if hardlinks are not possible.
+    returns 'hardlink' or 'symlink'
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.link(obj, tmp)
+        kind = "hardlink"
+    except OSError:
+        os.symlink(os.path.relpath(obj, os.path.dirname(path) or "."), tmp)
+        kind = "symlink"
+    os.replace(tmp, path)
+    return kind
+
+
+def store_file(path: str, store: str) -> str:
+    "add the content of a file to the store, and return the path of its object"
+    obj = object_path(store, file_digest(path))
+    if not os.path.exists(obj):
+        os.makedirs(store, exist_ok=True)
+        tmp = "{}.{}.tmp".format(obj, os.getpid())
+        try:
+            # the file becomes the object, no need for a copy
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, obj)
+    return obj
+
+
+def store_write(path: str, data: bytes, store: str = None) -> str:
+    "write data to path through the store. returns 'hardlink' or 'symlink'"
+    if store is None:
+        store = os.path.join(STUB_FOLDER, OBJECT_FOLDER)
+    digest = hashlib.sha256(data).hexdigest()
+    obj = object_path(store, digest)
+    if not os.path.exists(obj):
+        os.makedirs(store, exist_ok=True)
+        tmp = "{}.{}.tmp".format(obj, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, obj)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return link_file(obj, path)
+
+
+def disk_usage(folder: str) -> int:
+    "the bytes used by the files and folders in a folder, counting linked files once"
+    seen = set()
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+
+def collect_objects(store: str, keep: set) -> int:
+    """
+    remove the objects of the store that no file links to, as the old objects of unshared files.
+    an object only linked to by symlinks has no other hardlinks, so these are passed in keep.
+    returns the number of objects removed
+    """
+    removed = 0
+    if not os.path.isdir(store):
+        return removed
+    for entry in os.scandir(store):
+        # skip the temporary files of a concurrent store_file or store_write
+        if entry.name.endswith(".tmp") or not entry.is_file(follow_symlinks=False):
+            continue
+        if entry.stat(follow_symlinks=False).st_nlink == 1 and os.path.realpath(entry.path) not in keep:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+def compact_folder(folder: str = STUB_FOLDER, store: str = None, patterns=STORE_PATTERNS, gc: bool = True) -> dict:
+    """
+    move the stub files in a folder into the store, and replace them with links to their object.
+    with gc, the objects that no file of the folder links to are removed from the store,
+    pass gc=False for a store that is shared with other folders.
+    returns a dict with the number of files, the number of unique files, the objects removed and the bytes saved
+    """
+    if store is None:
+        store = os.path.join(folder, OBJECT_FOLDER)
+    before = disk_usage(folder)
+    files = unique = 0
+    objects, keep = set(), set()
+    for root, dirs, names in os.walk(folder):
+        # do not compact the store itself
+        dirs[:] = [d for d in sorted(dirs) if os.path.join(root, d) != store]
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                keep.add(os.path.realpath(path))
+                continue
+            if not any(fnmatch.fnmatch(name, p) for p in patterns):
+                continue
+            files += 1
+            obj = store_file(path, store)
+            if obj not in objects:
+                objects.add(obj)
+                unique += 1
+            if not os.path.samefile(obj, path):
+                link_file(obj, path)
+    removed = collect_objects(store, keep | {os.path.realpath(z) for z in objects}) if gc else 0
+    saved = before - disk_usage(folder)
+    log.info("compacted {} files, {} unique, removed {} objects, saved {} bytes in {}".format(files, unique, removed, saved, folder))
+    return {"files": files, "unique": unique, "removed": removed, "saved": saved}
 
 
 def manifest(
@@ -115,8 +249,132 @@ def make_manifest(folder: str, family: str, port: str, version: str) -> bool:
         return False
 
 
+def check_stub_file(path: str):
+    "parse a .py or .pyi file, returns None or a failure dict"
+    try:
+        with open(path, "rb") as f:
+            ast.parse(f.read(), filename=path)
+    except SyntaxError as e:
+        return {"kind": "syntax", "file": path, "line": e.lineno, "message": e.msg}
+    except (ValueError, OSError) as e:
+        return {"kind": "syntax", "file": path, "line": None, "message": str(e)}
+    return None
+
+
+def manifest_file(folder: str, module: dict) -> str:
+    "the path of the file of a module in a module manifest"
+    # createstubs.py records the path on the board: <stub folder>/<module path>.py
+    candidates = [module.get("file", "")]
+    if module.get("module"):
+        candidates.append(module["module"].replace(".", "/") + ".py")
+    candidates.append(os.path.basename(candidates[0]))
+    for name in candidates:
+        path = os.path.normpath(os.path.join(folder, name))
+        if name and os.path.isfile(path):
+            return path
+    return None
+
+
+def check_manifest(manifest_path: str, files) -> list:
+    "compare a modules.json with the .py files in its folder, returns a list of failure dicts"
+    folder = os.path.dirname(manifest_path)
+    try:
+        with open(manifest_path) as f:
+            modules = json.load(f)["modules"]
+    except (ValueError, KeyError, TypeError, OSError) as e:
+        return [{"kind": "manifest", "file": manifest_path, "line": None, "message": "invalid manifest: {}".format(e)}]
+    failures = []
+    listed = set()
+    for module in modules:
+        path = manifest_file(folder, module)
+        if path is None:
+            failures.append({"kind": "missing", "file": manifest_path, "line": None, "message": "not found: {}".format(module.get("file"))})
+        else:
+            listed.add(path)
+    for path in sorted(set(files) - listed):
+        failures.append({"kind": "unlisted", "file": path, "line": None, "message": "not in {}".format(manifest_path)})
+    return failures
+
+
+def validate_stubs(folder: str = STUB_FOLDER, jobs: int = 0, require_pyi: bool = False, cache: str = None) -> dict:
+    """
+    parse every .py and .pyi file in a folder and its sub folders, using jobs processes (0: one per cpu),
+    and compare the modules.json files with the .py files in their folder and the sub folders without a modules.json.
+    with require_pyi, a .py file without a .pyi file is a failure too.
+    cache is a json file that records the files that parsed, they are not parsed again until they change.
+    returns a report dict, with a list of failure dicts of kind syntax, manifest, missing, unlisted or no_stub
+    """
+    folder = os.path.normpath(folder)
+    stubs, manifests, owner = [], [], {}
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if d != OBJECT_FOLDER)
+        if "modules.json" in names:
+            manifests.append(os.path.join(root, "modules.json"))
+            owner[root] = []
+        # the nearest folder with a manifest
+        parent = root
+        while parent not in owner and parent != folder and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+        for name in sorted(names):
+            path = os.path.normpath(os.path.join(root, name))
+            if name.endswith((".py", ".pyi")):
+                stubs.append(path)
+            if name.endswith(".py") and parent in owner:
+                owner[parent].append(path)
+    valid = {}
+    if cache and os.path.exists(cache):
+        try:
+            with open(cache) as f:
+                valid = json.load(f)
+        except ValueError:
+            log.warning("ignoring invalid validation cache {}".format(cache))
+    # parse each file once: files that did not change since they parsed are skipped, linked files are the same file
+    state, inodes, broken = {}, {}, []
+    for path in stubs:
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            # a dangling link, as when its object was removed from the store
+            broken.append({"kind": "missing", "file": path, "line": None, "message": e.strerror or str(e)})
+            continue
+        state[path] = [st.st_size, st.st_mtime_ns]
+        if valid.get(path) != state[path]:
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(path)
+    todo = [paths[0] for paths in inodes.values()]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(todo) < 100:
+        results = list(map(check_stub_file, todo))
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(check_stub_file, todo, max(1, len(todo) // (jobs * 8)))
+    failures = broken
+    for paths, failure in zip(inodes.values(), results):
+        for path in paths:
+            if failure:
+                failures.append(dict(failure, file=path))
+                valid.pop(path, None)
+            else:
+                valid[path] = state[path]
+    failures.sort(key=lambda z: z["file"])
+    if cache:
+        with open(cache, "w") as f:
+            json.dump({k: v for k, v in valid.items() if k in state}, f)
+    for path in manifests:
+        failures.extend(check_manifest(path, owner[os.path.dirname(path)]))
+    if require_pyi:
+        pyi = set(stubs)
+        for path in stubs:
+            if path.endswith(".py") and path + "i" not in pyi:
+                failures.append({"kind": "no_stub", "file": path, "line": None, "message": "no .pyi file"})
+    for failure in failures:
+        log.debug("{kind:<9}: {file}:{line}: {message}".format(**failure))
+    if failures:
+        log.warning("{} failures in {} files and {} manifests in {}".format(len(failures), len(stubs), len(manifests), folder))
+    return {"folder": folder, "files": len(stubs), "parsed": len(todo), "manifests": len(manifests), "failures": failures}
+
+
 def generate_all_stubs():
     "just create typeshed stubs"
     # now generate typeshed files for all scripts
     print("Generate type hint files (pyi) in folder: {}".format(STUB_FOLDER))
-    make_stub_files(STUB_FOLDER, levels=7)
+    make_stub_files(STUB_FOLDER)
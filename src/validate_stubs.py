@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Validate a stub folder: parse all .py and .pyi files, and compare the modules.json manifests with the files on disk.
+Writes a json report of the failures, and exits with 1 if there are any.
+"""
+# Copyright (c) 2020 Jos Verlinde
+# MIT license
+import argparse
+import json
+import logging
+import sys
+import utils
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse the stubs in a stub folder and check its module manifests")
+    parser.add_argument('folder', nargs='?', default=utils.STUB_FOLDER, help="the stub folder, default {}".format(utils.STUB_FOLDER))
+    parser.add_argument('-r', '--report', help="write the report to this json file")
+    parser.add_argument('-j', '--jobs', type=int, default=0, help="processes to parse with, default one per cpu")
+    parser.add_argument('-c', '--cache', help="record the files that parsed in this json file, and skip them until they change")
+    parser.add_argument('--require-pyi', action='store_true', help="a .py file without a .pyi file is a failure")
+    args = parser.parse_args()
+    report = utils.validate_stubs(args.folder, jobs=args.jobs, require_pyi=args.require_pyi, cache=args.cache)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+    for failure in report["failures"]:
+        print("{kind:<9} {file}:{line}: {message}".format(**failure))
+    print("{} files, {} manifests, {} failures".format(report["files"], report["manifests"], len(report["failures"])))
+    return 1 if report["failures"] else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)-8s:%(message)s', level=logging.INFO)
+    sys.exit(main())
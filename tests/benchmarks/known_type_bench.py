@@ -0,0 +1,88 @@
+"""
+Micro-benchmark of ReduceTypes.is_known_type over the tests/test_data/stubs corpus
+Compares the Pattern based matcher it replaced with the precompiled one, cold and memoized
+
+    python tests/benchmarks/known_type_bench.py
+"""
+import sys
+import shutil
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.insert(1, "./src")
+# pylint: disable=wrong-import-position
+import make_stub_files as msf
+
+CORPUS = Path('./tests/test_data/stubs')
+
+
+def legacy_is_known_type(s):
+    "is_known_type as it was: a new Pattern per table entry, per call"
+    s = s.strip()
+    for s2 in msf.known_call_types:
+        if s2 == s or msf.Pattern(s2 + '(*)', s).match_entire_string(s):
+            return True
+    if s.startswith('[') and s.endswith(']'):
+        inner = s[1:-1]
+        return legacy_is_known_type(inner) if inner else True
+    elif s.startswith('(') and s.endswith(')'):
+        inner = s[1:-1]
+        return legacy_is_known_type(inner) if inner else True
+    elif s.startswith('{') and s.endswith('}'):
+        return True
+    for s2 in msf.known_subscript_types:
+        if s2 == s or msf.Pattern(s2 + '[*]', s).match_entire_string(s):
+            return True
+    return False
+
+
+def collect_inputs():
+    "the strings is_known_type is called with while stubbing the corpus"
+    inputs = []
+    original = msf.ReduceTypes.is_known_type
+
+    def record(self, s):
+        inputs.append(s)
+        return original(self, s)
+    msf.ReduceTypes.is_known_type = record
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            shutil.copytree(CORPUS, tmp + '/stubs')
+            msf.make_stub_tree(tmp + '/stubs', overwrite=True, cache=False)
+    finally:
+        msf.ReduceTypes.is_known_type = original
+    return inputs
+
+
+def main():
+    inputs = collect_inputs()
+    rt = msf.ReduceTypes()
+    for s in inputs:
+        assert rt.is_known_type(s) == legacy_is_known_type(s), s
+
+    def cold():
+        msf.known_type_cache.cache_clear()
+        for s in inputs:
+            rt.is_known_type(s)
+
+    def warm():
+        for s in inputs:
+            rt.is_known_type(s)
+
+    def legacy():
+        for s in inputs:
+            legacy_is_known_type(s)
+
+    print("{} calls, {} distinct inputs".format(len(inputs), len(set(z.strip() for z in inputs))))
+    results = {}
+    for name, fn in (('legacy', legacy), ('precompiled', cold), ('memoized', warm)):
+        runs = 20
+        seconds = min(timeit.repeat(fn, number=runs, repeat=3)) / runs
+        results[name] = seconds
+        print("{:<12} {:>9.1f} us/pass {:>7.2f} us/call {:>7.1f}x".format(
+            name, seconds * 1e6, seconds * 1e6 / len(inputs), results['legacy'] / seconds))
+
+
+if __name__ == "__main__":
+    main()
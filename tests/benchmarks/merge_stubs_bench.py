@@ -0,0 +1,144 @@
+"""
+Benchmark of StubTraverser.merge_stubs, the --update merge, on a large generated module
+Compares the tree searches it replaced with the indexed merge, and checks that the output is the same
+
+    python tests/benchmarks/merge_stubs_bench.py [classes] [methods]
+"""
+import sys
+import ast
+import time
+import tempfile
+import contextlib
+import io
+from pathlib import Path
+
+sys.path.insert(1, "./src")
+# pylint: disable=wrong-import-position
+import make_stub_files as msf
+
+
+class LegacyTraverser(msf.StubTraverser):
+    "merge_stubs as it was: a tree search per stub, list membership and filtering passes"
+
+    def merge_stubs(self, new_stubs, old_root, new_root, trace=False):
+        aList = self.check_delete(new_stubs, old_root, new_root, False)
+        aList = list(reversed(self.sort_stubs_by_hierarchy(aList)))
+        for stub in aList:
+            parent = self.find_parent_stub(stub, old_root) or old_root
+            parent.children.remove(stub)
+            assert not self.find_stub(stub, old_root), stub
+        aList = [z for z in new_stubs if not self.find_stub(z, old_root)]
+        aList = self.sort_stubs_by_hierarchy(aList)
+        for stub in aList:
+            parent = self.find_parent_stub(stub, old_root) or old_root
+            parent.children.append(stub)
+            assert self.find_stub(stub, old_root), stub
+
+    def check_delete(self, new_stubs, old_root, new_root, trace):
+        old_stubs = self.flatten_stubs(old_root)
+        old_stubs.remove(old_root)
+        aList = [z for z in old_stubs if z not in new_stubs]
+        delete_list = []
+        for z in aList:
+            z1 = z
+            for i in range(20): # pylint: disable=unused-variable
+                z = z.parent
+                if not z:
+                    break
+                elif z == old_root:
+                    delete_list.append(z1)
+                    break
+                elif z not in aList:
+                    break
+        return delete_list
+
+    def find_parent_stub(self, stub, root):
+        return self.find_stub(stub.parent, root) if stub.parent else None
+
+    def find_stub(self, stub, root):
+        if stub == root:
+            return root
+        for child in root.children:
+            stub2 = self.find_stub(stub, child)
+            if stub2:
+                return stub2
+        return None
+
+    def sort_stubs_by_hierarchy(self, stubs1):
+        stubs, result = stubs1[:], []
+        for i in range(50):
+            if stubs:
+                found = [z for z in stubs if z.level() == i]
+                result.extend(found)
+                for z in found:
+                    stubs.remove(z)
+            else:
+                return result
+        return []
+
+
+def letters(n):
+    "n as a name, parse_stub_file only reads names without digits"
+    s = ''
+    while True:
+        n, i = divmod(n, 26)
+        s = chr(ord('a') + i) + s
+        if not n:
+            return s
+
+
+def make_source(classes, methods, version):
+    "a module, version 1 drops every 7th method and adds others"
+    lines = []
+    for c in range(classes):
+        lines.append("class C_{}:".format(letters(c)))
+        for m in range(methods):
+            if version and m % 7 == 0:
+                continue
+            lines.append("    def m_{}(self, n):\n        return n + 1".format(letters(m)))
+        if version:
+            lines.append("    def added(self):\n        return 'x'")
+    for f in range(classes):
+        lines.append("def f_{}(s):\n    return len(s)".format(letters(f)))
+    return "\n".join(lines) + "\n"
+
+
+def controller(update):
+    x = msf.StandAloneMakeStubFile()
+    x.config_fn = 'src/make_stub_files.cfg'
+    x.silent = True
+    x.scan_options()
+    x.update_flag = update
+    x.overwrite = True
+    return x
+
+
+def run(cls, pyi, tree):
+    "update pyi from tree, return (text, seconds)"
+    st = cls(controller=controller(True))
+    st.output_fn = str(pyi)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        s = st.make_stubs(tree)
+        return s, time.perf_counter() - t
+
+
+def main():
+    classes = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    methods = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with tempfile.TemporaryDirectory() as tmp:
+        pyi = Path(tmp) / 'big.pyi'
+        st = msf.StubTraverser(controller=controller(False))
+        st.output_fn = str(pyi)
+        pyi.write_text(st.make_stubs(ast.parse(make_source(classes, methods, 0))))
+        tree = ast.parse(make_source(classes, methods, 1))
+        print("{} stubs in {}".format(pyi.read_text().count('def ') + classes, pyi.name))
+        legacy, t1 = run(LegacyTraverser, pyi, tree)
+        indexed, t2 = run(msf.StubTraverser, pyi, tree)
+        assert legacy == indexed, "the merged output differs"
+        print("legacy  {:>8.3f} s".format(t1))
+        print("indexed {:>8.3f} s {:>7.1f}x".format(t2, t1 / t2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Benchmark suite of the stub generation pipeline, on the tests/test_data/stubs corpus and on a generated large tree
+Each stage runs in a process of its own, and reports ops/sec (best of --repeat runs) and the peak RSS of that process, setup included
+
+    python tests/benchmarks/pipeline_bench.py [-o results.json] [--scale 20] [--repeat 5] [stage ...]
+    python tests/benchmarks/pipeline_bench.py --baseline results.json [--tolerance 0.2]
+
+With --baseline the results are compared with an earlier run, and the exit code is 1 if a stage is slower than the tolerance
+"""
+import sys
+import ast
+import json
+import time
+import timeit
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import io
+import asyncio
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+sys.path.insert(1, "./src")
+sys.path.insert(1, ".")
+# pylint: disable=wrong-import-position
+import make_stub_files as msf
+import utils
+import process
+
+CORPUS = Path('./tests/test_data/stubs')
+CONFIG = './src/make_stub_files.cfg'
+# modern sources: async defs, f-strings, keyword only arguments, constants
+MODERN = Path(asyncio.__file__).parent
+
+
+def copy_corpus(dest):
+    "a copy of the corpus, without its .pyi files"
+    shutil.copytree(str(CORPUS), str(dest), ignore=shutil.ignore_patterns('*.pyi'))
+    return dest
+
+
+def make_large_tree(dest, scale):
+    "scale copies of the corpus, each file made unique with a comment"
+    for i in range(scale):
+        for src in CORPUS.rglob('*.py'):
+            fn = dest / 'v{}'.format(i) / src.relative_to(CORPUS)
+            fn.parent.mkdir(parents=True, exist_ok=True)
+            fn.write_text(src.read_text() + '\n# {}\n'.format(i))
+    return dest
+
+
+def sources():
+    return [p.read_text() for p in sorted(CORPUS.rglob('*.py'))]
+
+
+def modern_sources():
+    return [p.read_text() for p in sorted(MODERN.glob('*.py'))]
+
+
+def record(cls, name, fn):
+    "the arguments of the calls to cls.name while running fn"
+    calls = []
+    original = getattr(cls, name)
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+    setattr(cls, name, wrapper)
+    try:
+        fn()
+    finally:
+        setattr(cls, name, original)
+    return calls
+
+
+def stub_corpus():
+    config = msf.compile_config_file(CONFIG)
+    for s in sources():
+        msf.make_stub_string(s, config)
+
+
+# The stages: each returns (ops, prepare, run), prepare is called before each run and is not timed.
+
+def bench_patterns(args, tmp):
+    "StubFormatter.match_all and munge_arg's PatternIndex.find, on the strings of the corpus"
+    matches = record(msf.StubFormatter, 'match_all', stub_corpus)
+    args_ = record(msf.StubTraverser, 'munge_arg', stub_corpus)
+    formatter = matches[0][0]
+    index = args_[0][0].arg_index
+
+    def run():
+        formatter.match_cache.clear()
+        for _, node, s in matches:
+            formatter.match_all(node, s)
+        for _, s in args_:
+            index.find(s)
+    return len(matches) + len(args_), None, run
+
+
+def bench_reduce_types(args, tmp):
+    "reduce_types of the return values of the corpus, without its cache"
+    calls = [z[0] for z in record(msf, 'reduce_types', stub_corpus)] or [['int', 'str']]
+
+    def run():
+        msf.reduce_types_cache.cache_clear()
+        for aList in calls:
+            msf.reduce_types(aList)
+    return len(calls), None, run
+
+
+def bench_pyi(args, tmp):
+    "make_stub_string for each file of the corpus"
+    config = msf.compile_config_file(CONFIG)
+    texts = sources()
+
+    def run():
+        for s in texts:
+            msf.make_stub_string(s, config)
+    return len(texts), None, run
+
+
+def bench_format(args, tmp):
+    "AstFormatter.format of each module of the asyncio package, and StubFormatter.format of its returns"
+    trees = [ast.parse(s) for s in modern_sources()]
+    returns = [z for tree in trees for z in ast.walk(tree) if isinstance(z, ast.Return)]
+    config = msf.compile_config_file(CONFIG)
+    stub_formatter = msf.StubFormatter(config, msf.StubTraverser(config))
+
+    def run():
+        for tree in trees:
+            msf.AstFormatter().format(tree)
+        for node in returns:
+            stub_formatter.format(node)
+    return len(trees), None, run
+
+
+def bench_pyi_modern(args, tmp):
+    "make_stub_string for each module of the asyncio package"
+    config = msf.compile_config_file(CONFIG)
+    texts = modern_sources()
+
+    def run():
+        for s in texts:
+            msf.make_stub_string(s, config)
+    return len(texts), None, run
+
+
+def tree_stage(make_tree):
+    def bench(args, tmp):
+        tree = make_tree(tmp / 'tree', args.scale)
+        n = len(list(tree.rglob('*.py')))
+
+        def prepare():
+            for p in tree.rglob('*.pyi'):
+                p.unlink()
+
+        def run():
+            msf.make_stub_tree(str(tree), update=False, cache=False, jobs=args.jobs)
+        return n, prepare, run
+    return bench
+
+
+bench_tree = tree_stage(lambda dest, scale: copy_corpus(dest))
+bench_tree.__doc__ = "make_stub_tree of the corpus"
+bench_tree_large = tree_stage(make_large_tree)
+bench_tree_large.__doc__ = "make_stub_tree of --scale copies of the corpus"
+
+
+def bench_minify(args, tmp):
+    "process.minify_script of createstubs.py and its phase modules"
+    if process.token_utils is None:
+        raise ImportError("pyminifier is not installed")
+    scripts = [process.SCRIPT] + process.phase_modules(process.SCRIPT)
+
+    def run():
+        for script in scripts:
+            process.minify_script(script=script)
+    return len(scripts), None, run
+
+
+def bench_manifest(args, tmp):
+    "utils.make_manifest of each folder of the corpus"
+    tree = copy_corpus(tmp / 'tree')
+    folders = sorted({str(p.parent) for p in tree.rglob('*.py')})
+
+    def run():
+        for folder in folders:
+            utils.make_manifest(folder, 'micropython', 'esp32', 'v1.13')
+    return len(folders), None, run
+
+
+STAGES = {
+    'patterns': bench_patterns,
+    'reduce_types': bench_reduce_types,
+    'pyi': bench_pyi,
+    'format': bench_format,
+    'pyi_modern': bench_pyi_modern,
+    'tree': bench_tree,
+    'tree_large': bench_tree_large,
+    'minify': bench_minify,
+    'manifest': bench_manifest,
+}
+
+
+def peak_rss_kb():
+    "the peak RSS of this process in kB, or None"
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def run_stage(name, args):
+    "run a stage in this process, and return its result"
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                ops, prepare, run = STAGES[name](args, Path(tmp))
+        except ImportError as e:
+            return {'skipped': str(e)}
+        with contextlib.redirect_stdout(io.StringIO()):
+            if prepare:
+                times = []
+                for _ in range(args.repeat):
+                    prepare()
+                    start = time.perf_counter()
+                    run()
+                    times.append(time.perf_counter() - start)
+            else:
+                # runs of at least 0.2 seconds
+                timer = timeit.Timer(run)
+                number, _ = timer.autorange()
+                times = [z / number for z in timer.repeat(args.repeat, number)]
+    best = min(times)
+    return {
+        'ops': ops,
+        'seconds': best,
+        'ops_per_sec': ops / best if best else None,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_all(args):
+    "run each stage in a new process"
+    results = {}
+    for name in args.stages:
+        cmd = [sys.executable, __file__, '--stage', name, '--scale', str(args.scale),
+               '--repeat', str(args.repeat), '--jobs', str(args.jobs)]
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results[name] = json.loads(out)
+        print_result(name, results[name])
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'stages': results,
+    }
+
+
+def print_result(name, result):
+    if 'skipped' in result:
+        print("{:<14} skipped: {}".format(name, result['skipped']))
+    else:
+        print("{:<14} {:>8} ops {:>12.1f} ops/sec {:>9} kB".format(
+            name, result['ops'], result['ops_per_sec'], result['peak_rss_kb'] or '-'))
+
+
+def compare(results, baseline, tolerance):
+    "print the ratio of the ops/sec to the baseline; return the names of the stages that are slower than tolerance"
+    slower = []
+    print("{:<14} {:>12} {:>12} {:>7}".format('stage', 'baseline', 'ops/sec', 'ratio'))
+    for name, result in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if not base or not base.get('ops_per_sec') or not result.get('ops_per_sec'):
+            print("{:<14} {:>12} {:>12} {:>7}".format(name, '-', '-', '-'))
+            continue
+        ratio = result['ops_per_sec'] / base['ops_per_sec']
+        flag = ''
+        if ratio < 1 - tolerance:
+            slower.append(name)
+            flag = ' SLOWER'
+        print("{:<14} {:>12.1f} {:>12.1f} {:>6.2f}x{}".format(
+            name, base['ops_per_sec'], result['ops_per_sec'], ratio, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stub generation pipeline")
+    parser.add_argument('stages', nargs='*', default=list(STAGES), metavar='stage',
+                        help="the stages to run: {}".format(', '.join(STAGES)))
+    parser.add_argument('-o', '--output', help="write the results to this json file")
+    parser.add_argument('-b', '--baseline', help="compare with the results in this json file")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help="allowed slow down, default 0.2")
+    parser.add_argument('--scale', type=int, default=20, help="copies of the corpus in the large tree, default 20")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=1, help="processes for make_stub_tree")
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = [z for z in args.stages if z not in STAGES]
+    if unknown:
+        parser.error("unknown stage: {}".format(', '.join(unknown)))
+    if args.stage:
+        print(json.dumps(run_stage(args.stage, args)))
+        return 0
+    results = run_all(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,6 +17,8 @@ import pytest
 )
 
 # only run createsubs in the unix version of micropython
+# slow: tests/stubber/createstubs_host_test.py runs the same logic on CPython
+@pytest.mark.slow
 @pytest.mark.skipif(sys.platform == 'win32', reason="requires linux")
 def test_createstubs(firmware, tmp_path, script_folder):
     # Use temp_path to generate stubs 
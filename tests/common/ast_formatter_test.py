@@ -0,0 +1,102 @@
+import ast
+import sys
+import pytest
+from make_stub_files import AstFormatter, AstArgFormatter, StubFormatter, compile_config_file, make_stub_string
+
+# pylint: disable=redefined-outer-name
+
+
+@pytest.fixture(scope="module")
+def config():
+    return compile_config_file('./src/make_stub_files.cfg')
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("x = 1", "x=1"),
+        ("x = 'a'", "x='a'"),
+        ("x = b'a'", "x=b'a'"),
+        ("x = True", "x=True"),
+        ("x = ...", "x=..."),
+        ("x: int = 1", "x: int=1"),
+        ("f'{a!r:>{n}} {{b}}'", "f'{a!r:>{n}} {{b}}'"),
+        ("(y := f(x))", "(y := f(x))"),
+        ("f(*a, k=1, **kw)", "f(*a,k=1,**kw)"),
+        ("{1, 2}", "{1,2}"),
+        ("def f(a, /, b=1, *, c, d=2, **kw): pass", "def f(a,/,b=1,*,c,d=2,**kw):\n    pass"),
+        ("async def f(): await g()", "async def f():\n    await g()"),
+        ("async def f():\n    async for x in y: pass\n    async with a as b: pass",
+            "async def f():\n    async for x in y:\n        pass\n    async with a as b:\n        pass"),
+        ("raise E from e", "raise E from e"),
+        ("from .. import a", "from .. import a"),
+        pytest.param(
+            "try:\n    pass\nexcept* E as e:\n    pass",
+            "try:\n    pass\nexcept* E as e:\n    pass",
+            marks=pytest.mark.skipif(sys.version_info < (3, 11), reason="python 3.11"),
+        ),
+        pytest.param(
+            "match p:\n    case [1, *rest] | {'k': _, **kw} if rest:\n        pass\n    case P(x, y=None) as q:\n        pass",
+            "match p:\n    case [1, *rest] | {'k': _, **kw} if rest:\n        pass\n    case P(x, y=None) as q:\n        pass",
+            marks=pytest.mark.skipif(sys.version_info < (3, 10), reason="python 3.10"),
+        ),
+    ],
+)
+def test_format(source, expected):
+    assert AstFormatter().format(ast.parse(source)) == expected
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("1", "number"),
+        ("1.5", "number"),
+        ("'a'", "str"),
+        ("b'a'", "bytes"),
+        ("True", "bool"),
+        ("None", "None"),
+        ("f'{a}'", "str"),
+    ],
+)
+def test_arg_format(source, expected):
+    assert AstArgFormatter().format(ast.parse(source)) == expected
+
+
+def test_dispatch():
+    # one table per class, holding the methods of that class
+    assert AstFormatter.dispatch[ast.Constant] is AstFormatter.do_Constant
+    assert StubFormatter.dispatch[ast.Constant] is AstArgFormatter.do_Constant
+    assert StubFormatter.dispatch[ast.Return] is StubFormatter.do_Return
+    assert AstArgFormatter.dispatch[ast.Name] is AstArgFormatter.do_Name
+    assert AstFormatter.dispatch[ast.Name] is AstFormatter.do_Name
+
+
+SOURCE = '''
+class A:
+    def f(self, a, b=1, *, c='x', d=None, **kw):
+        return "abc"
+    async def g(self, p, /, q=True):
+        def inner():
+            return 3
+        if (n := len(p)) > 3:
+            return f"{p}"
+        return None
+    def t(self):
+        return (1, 'a', None)
+'''
+
+
+def test_modern_stubs(config):
+    s = make_stub_string(SOURCE, config)
+    ast.parse(s)
+    assert "    def f(self, a: str, b: Any=1, *, c: Any='x', d: Any=None, **kw) -> str: ..." in s
+    # the returns of nested defs are their own
+    assert "    async def g(self, p: Any, /, q: Any=True) -> Optional[str]:\n        def inner() -> number: ..." in s
+    assert "    def t(self) -> Tuple[number, str, None]: ..." in s
+
+
+def test_update_async(config):
+    pyi = 'class A:\n    async def g(self) -> int: ...\n'
+    s = make_stub_string(SOURCE, config, pyi=pyi)
+    assert 'async def g(self) -> int: ...' in s
+    assert 'def f(self' in s
@@ -0,0 +1,91 @@
+import ast
+import glob
+import pytest
+from make_stub_files import compile_config_file, make_board_stub_string, make_stub_string, StubTraverser
+
+# pylint: disable=redefined-outer-name
+
+SOURCE = '''"""
+Module: 'machine' on micropython-esp32-1.13
+"""
+# MCU: {'ver': '1.13', 'port': 'esp32'}
+# Stubber: 1.3.7
+
+class Pin:
+    ''
+    IN = 1
+    def __init__(self):
+        ''
+        pass
+
+    def value():
+        pass
+
+class Signal:
+    ''
+DEEPSLEEP = 4
+name = 'esp32'
+freq_max = 2.4e+08
+mem8 = None
+def reset():
+    pass
+
+'''
+
+
+@pytest.fixture(scope="module")
+def config():
+    return compile_config_file('./src/make_stub_files.cfg')
+
+
+def slow_stub_string(source, config):
+    "make_stub_string, without the shortcut"
+    return StubTraverser(controller=config).make_stub_text(ast.parse(source), None)
+
+
+def test_board_stub_string(config):
+    s = make_board_stub_string(SOURCE, config)
+    assert s == slow_stub_string(SOURCE, config)
+    assert 'class Pin:\n    def __init__(self) -> None: ...\n    def value() -> None: ...\nclass Signal: ...\n' in s
+
+
+def test_make_stub_string_does_not_parse(config, mocker):
+    parse = mocker.patch('ast.parse')
+    assert make_stub_string(SOURCE, config) == make_board_stub_string(SOURCE, config)
+    assert parse.call_count == 0
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "def f(x):\n    pass\n",            # arguments
+        "def f():\n    return 1\n",         # a return
+        "class A(B):\n    ''\n",            # bases
+        "class _A:\n    ''\n",              # not stubbed, but its children are
+        "class A:\n    ''\n    class B:\n        ''\n",
+        "def f():\n    pass\ndef f():\n    pass\n",     # duplicates
+        "def f():\n",                       # syntax errors
+        "    x = 1\n",
+        "x = 01\n",
+        "x = 'a\\x'\n",
+        '"""\nModule: \\u\n"""\n',
+        "def f():\r    pass\n",
+        "import os\n",
+    ],
+)
+def test_not_a_board_stub(source, config):
+    assert make_board_stub_string(source, config) is None
+
+
+def test_trace(config, mocker):
+    mocker.patch.object(config, 'trace_visitors', True)
+    assert make_board_stub_string(SOURCE, config) is None
+
+
+@pytest.mark.parametrize("fn", sorted(glob.glob('./tests/test_data/stubs/micropython-linux-*/*.py')))
+def test_board_stubs(fn, config):
+    with open(fn) as f:
+        source = f.read()
+    s = make_board_stub_string(source, config)
+    if s is not None:
+        assert s == slow_stub_string(source, config)
@@ -0,0 +1,68 @@
+import pickle
+import pytest
+from make_stub_files import StandAloneMakeStubFile, Pattern
+
+# pylint: disable=redefined-outer-name
+
+CONFIG = './src/make_stub_files.cfg'
+
+
+def scan(config_fn=CONFIG, cache_fn=None):
+    x = StandAloneMakeStubFile()
+    x.config_fn = config_fn
+    x.config_cache_fn = cache_fn
+    x.files = ['./src/make_stub_files.py']
+    x.scan_options()
+    return x
+
+
+def tables(x):
+    return [repr(getattr(x, ivar)) for ivar in ('prefix_lines', 'def_patterns', 'general_patterns', 'names_dict', 'regex_patterns')] + [
+        sorted((k, repr(v)) for k, v in x.patterns_dict.items())]
+
+
+def test_config_cache(tmp_path, mocker):
+    cache_fn = str(tmp_path / 'config.cache')
+    first = scan(cache_fn=cache_fn)
+    assert (tmp_path / 'config.cache').exists()
+    scan_config = mocker.spy(StandAloneMakeStubFile, 'scan_config')
+    second = scan(cache_fn=cache_fn)
+    assert scan_config.call_count == 0
+    assert tables(second) == tables(first) == tables(scan())
+    assert set(second.matchers) == set(first.matchers)
+    assert second.output_directory == first.output_directory
+
+
+def test_config_cache_changed_config(tmp_path, mocker):
+    cache_fn = str(tmp_path / 'config.cache')
+    config = tmp_path / 'my.cfg'
+    config.write_text("[Global]\n\n[General Patterns]\n\npin: machine.Pin\n")
+    scan(str(config), cache_fn)
+    config.write_text("[Global]\n\n[General Patterns]\n\npin: int\n")
+    scan_config = mocker.spy(StandAloneMakeStubFile, 'scan_config')
+    x = scan(str(config), cache_fn)
+    assert scan_config.call_count == 1
+    assert x.arg_index.find('pin').repl_s == 'int'
+
+
+def test_config_cache_invalid(tmp_path, capsys):
+    cache_fn = tmp_path / 'config.cache'
+    cache_fn.write_bytes(b'not a pickle')
+    x = scan(cache_fn=str(cache_fn))
+    assert 'ignoring invalid config cache' in capsys.readouterr().out
+    assert tables(x) == tables(scan())
+    # and it was replaced
+    with open(str(cache_fn), 'rb') as f:
+        assert pickle.load(f).startswith('make_stub_files ')
+
+
+@pytest.mark.parametrize("find_s", ['s', 'len(*)', '.*_size$'])
+def test_pattern_pickle(find_s):
+    pattern = Pattern(find_s, 'int')
+    pattern2 = pickle.loads(pickle.dumps(pattern))
+    # compiled again on first use
+    assert 'regex' not in pattern2.__dict__
+    assert pattern2 == pattern
+    for s in ('s', 'len(x)', 'buf_size', 'foo'):
+        assert pattern2.match(s) == pattern.match(s)
+    assert (pattern2.regex is None) == (pattern.regex is None)
@@ -0,0 +1,45 @@
+import pytest
+from make_stub_files import is_known_type, known_type_cache
+
+# results of the Pattern based matcher that the precompiled one replaced
+@pytest.mark.parametrize("s, known", [
+    ('', True),
+    ('None', True),
+    ('int', True),
+    (' int ', True),
+    ('int(x)', True),
+    ('int(x)(y)', False),
+    ('int(x', False),
+    ('float(a, (b))', True),
+    ('(int)', True),
+    ('(a)(b)', False),
+    ('[int]', True),
+    ('[]', True),
+    ('[foo]', False),
+    ('{a}', True),
+    ('List[int]', True),
+    ('List[int][0]', False),
+    ('Dict[str, Any]', True),
+    ('TupleMeta[x]', True),
+    ('Listy[int]', False),
+    ('Sequence', True),
+    ('foo', False),
+    ('str()', True),
+    ('Tuple[int, str', False),
+    ('Any', True),
+    ('self.x', False),
+    ('Optional[List[int]]', True),
+    ('()', True),
+    ('List', True),
+    ('number', True),
+    ('([int])', True),
+    ('[(x)]', True),
+    ('intx(1)', False),
+    ('Dict[a][b]', False),
+    ('bytes(b)[0]', False),
+])
+def test_is_known_type(s, known):
+    known_type_cache.cache_clear()
+    assert is_known_type(s) == known
+    # and again from the cache
+    assert is_known_type(s) == known
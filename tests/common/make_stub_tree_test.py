@@ -0,0 +1,195 @@
+import json
+import sys
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+import make_stub_files
+from make_stub_files import make_stub_tree, find_source_files, StandAloneMakeStubFile, StubTraverser
+
+# pylint: disable=redefined-outer-name
+
+TEST_STUBS = Path('./tests/test_data/stubs')
+
+
+@pytest.fixture
+def stubs(tmp_path):
+    "a copy of the test stubs"
+    folder = tmp_path / 'stubs'
+    shutil.copytree(TEST_STUBS / 'micropython-1_15-frozen', folder / 'micropython-1_15-frozen')
+    return folder
+
+
+def test_find_source_files(stubs):
+    (stubs / '.hidden').mkdir()
+    (stubs / '.hidden' / 'skip.py').write_text('')
+    (stubs / 'not_python.json').write_text('')
+    files = find_source_files(str(stubs))
+    assert len(files) == 16
+    assert all(f.endswith('.py') and '.hidden' not in f for f in files)
+    # ordered depth first, by name
+    assert files == sorted(files)
+
+
+@pytest.mark.parametrize("levels, count", [(1, 0), (3, 0), (4, 16), (None, 16)])
+def test_find_source_files_levels(stubs, levels, count):
+    # micropython-1_15-frozen/esp32/GENERIC/*.py is 4 levels deep
+    assert len(find_source_files(str(stubs), levels)) == count
+
+
+def test_make_stub_tree(stubs):
+    assert make_stub_tree(str(stubs)) == 16
+    for py in stubs.rglob('*.py'):
+        assert py.with_suffix('.pyi').exists(), "missing stub for {}".format(py)
+
+
+def test_make_stub_tree_stream(stubs, mocker):
+    "without a stub file to update, the stubs are written to the file during the traversal"
+    make_stub_string = mocker.spy(make_stub_files, 'make_stub_string')
+    write_stubs = mocker.spy(StubTraverser, 'write_stubs')
+    assert make_stub_tree(str(stubs), cache=False, dedup=False) == 16
+    assert make_stub_string.call_count == 0
+    assert write_stubs.call_count == 16
+    # a failure keeps the stub file
+    pyi = stubs / 'micropython-1_15-frozen' / 'esp32' / 'GENERIC' / 'apa106.pyi'
+    old = pyi.read_text()
+    mocker.patch.object(StubTraverser, 'write_stubs', side_effect=RuntimeError('boom'))
+    controller = StandAloneMakeStubFile()
+    controller.config_fn = 'src/make_stub_files.cfg'
+    controller.overwrite, controller.update_flag = True, False
+    controller.scan_options()
+    controller.make_stub_file(str(pyi)[:-1])
+    assert controller.errors == [(str(pyi)[:-1], 'RuntimeError: boom')]
+    assert pyi.read_text() == old
+    assert not list(stubs.rglob('*.tmp'))
+
+
+def test_make_stub_tree_same_as_cli(stubs, tmp_path):
+    "in-process output matches running the script per folder"
+    cli = tmp_path / 'cli'
+    shutil.copytree(stubs, cli)
+    make_stub_tree(str(stubs))
+    for folder in sorted({p.parent for p in cli.rglob('*.py')}):
+        cmd = [sys.executable, 'src/make_stub_files.py', '-c', 'src/make_stub_files.cfg', '-u', '-s']
+        cmd += [str(p) for p in folder.glob('*.py')]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    for pyi in cli.rglob('*.pyi'):
+        assert pyi.read_text() == (stubs / pyi.relative_to(cli)).read_text()
+
+
+def test_make_stub_tree_jobs(stubs, tmp_path):
+    "a process pool writes the same stubs"
+    pool = tmp_path / 'pool'
+    shutil.copytree(stubs, pool)
+    make_stub_tree(str(stubs))
+    make_stub_tree(str(pool), jobs=2)
+    for pyi in stubs.rglob('*.pyi'):
+        assert pyi.read_text() == (pool / pyi.relative_to(stubs)).read_text()
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_make_stub_tree_errors(stubs, capsys, jobs):
+    bad = stubs / 'micropython-1_15-frozen' / 'bad.py'
+    bad.write_text("def broken(:\n")
+    assert make_stub_tree(str(stubs), jobs=jobs) == 17
+    assert not bad.with_suffix('.pyi').exists()
+    out = capsys.readouterr().out
+    assert '1 of 17 files could not be stubbed:' in out
+    assert '{}: SyntaxError'.format(bad) in out
+    # silent, but the summary ends with the stats
+    assert '16 regenerated, 0 skipped (unchanged), 1 errors' in out
+
+
+def test_make_stub_tree_cache(stubs, capsys):
+    assert make_stub_tree(str(stubs), overwrite=True, silent=False) == 16
+    assert '16 regenerated, 0 skipped (unchanged), 0 errors' in capsys.readouterr().out
+    assert (stubs / '.make_stub_files.json').exists()
+    # nothing changed
+    make_stub_tree(str(stubs), overwrite=True, silent=False)
+    assert '0 regenerated, 16 skipped (unchanged), 0 errors' in capsys.readouterr().out
+    # a changed source, a deleted stub and an edited stub are regenerated
+    folder = stubs / 'micropython-1_15-frozen' / 'esp32' / 'GENERIC'
+    with open(folder / 'apa106.py', 'a') as f:
+        f.write("\ndef new_function(a):\n    return 1\n")
+    (folder / 'neopixel.pyi').unlink()
+    (folder / 'flashbdev.pyi').write_text('')
+    make_stub_tree(str(stubs), overwrite=True, silent=False)
+    assert '3 regenerated, 13 skipped (unchanged), 0 errors' in capsys.readouterr().out
+    assert 'def new_function(' in (folder / 'apa106.pyi').read_text()
+
+
+def test_make_stub_tree_cache_stale(stubs):
+    "the cache forgets the sources that are gone"
+    stats = {}
+    make_stub_tree(str(stubs), stats=stats)
+    assert stats == {'regenerated': 16, 'skipped': 0, 'errors': 0}
+    folder = stubs / 'micropython-1_15-frozen' / 'esp32' / 'GENERIC'
+    (folder / 'apa106.py').unlink()
+    make_stub_tree(str(stubs), stats=stats)
+    assert stats == {'regenerated': 0, 'skipped': 15, 'errors': 0}
+    files = json.loads((stubs / '.make_stub_files.json').read_text())['files']
+    assert len(files) == 15
+    assert not any(key.endswith('/apa106.py') for key in files)
+
+
+def test_make_stub_tree_silent(stubs, boards, capsys):
+    "only the files that could not be stubbed are reported"
+    assert make_stub_tree(str(stubs)) == 26
+    make_stub_tree(str(stubs), overwrite=True)
+    assert capsys.readouterr().out == ''
+
+
+def test_make_stub_tree_cache_config(stubs, tmp_path, capsys):
+    "a different config regenerates everything"
+    make_stub_tree(str(stubs), overwrite=True)
+    config = tmp_path / 'other.cfg'
+    config.write_text(Path('src/make_stub_files.cfg').read_text() + "\n# changed\n")
+    capsys.readouterr()
+    make_stub_tree(str(stubs), config_fn=str(config), overwrite=True, silent=False)
+    assert '16 regenerated, 0 skipped (unchanged), 0 errors' in capsys.readouterr().out
+
+
+@pytest.fixture
+def boards(stubs):
+    "the esp32 GENERIC frozen modules, copied to two more boards"
+    esp32 = stubs / 'micropython-1_15-frozen' / 'esp32'
+    for board in ('LOLIN', 'TTGO'):
+        shutil.copytree(esp32 / 'GENERIC', esp32 / board)
+    return esp32
+
+
+def test_make_stub_tree_dedup(stubs, boards, tmp_path, mocker, capsys):
+    plain = tmp_path / 'plain'
+    shutil.copytree(stubs, plain)
+    make_stub_tree(str(plain), dedup=False)
+    capsys.readouterr()
+    make_stub_text = mocker.spy(StandAloneMakeStubFile, 'make_stub_text')
+    assert make_stub_tree(str(stubs), silent=False) == 26
+    assert make_stub_text.call_count == 16
+    assert '16 unique of 26 files' in capsys.readouterr().out
+    # the same stubs as without dedup
+    for pyi in plain.rglob('*.pyi'):
+        assert pyi.read_text() == (stubs / pyi.relative_to(plain)).read_text()
+    assert (boards / 'TTGO' / 'apa106.pyi').exists()
+
+
+def test_make_stub_tree_dedup_update(stubs, boards, capsys):
+    "when updating, the existing stub file is part of the content"
+    make_stub_tree(str(stubs))
+    edited = boards / 'LOLIN' / 'neopixel.pyi'
+    edited.write_text(edited.read_text().replace('def fill(self, color: Any)', 'def fill(self, color: int)'))
+    capsys.readouterr()
+    make_stub_tree(str(stubs), overwrite=True, cache=False, silent=False)
+    assert '17 unique of 26 files' in capsys.readouterr().out
+    assert 'def fill(self, color: int)' in edited.read_text()
+    assert 'def fill(self, color: Any)' in (boards / 'TTGO' / 'neopixel.pyi').read_text()
+
+
+def test_make_stub_tree_dedup_errors(stubs, boards, capsys):
+    for board in ('GENERIC', 'LOLIN'):
+        (boards / board / 'bad.py').write_text("def broken(:\n")
+    make_stub_tree(str(stubs))
+    out = capsys.readouterr().out
+    assert '2 of 28 files could not be stubbed:' in out
+    for board in ('GENERIC', 'LOLIN'):
+        assert '{}: SyntaxError'.format(boards / board / 'bad.py') in out
@@ -0,0 +1,74 @@
+import pytest
+from make_stub_files import Stub, StubIndex, StubTraverser, StandAloneMakeStubFile
+
+# pylint: disable=redefined-outer-name
+
+OLD = '''\
+class A:
+    def f(self) -> int: ...
+    def g(self) -> int: ...
+class B:
+    def f(self) -> str: ...
+def f() -> None: ...
+def f() -> int: ...
+'''
+
+
+@pytest.fixture
+def traverser():
+    return StubTraverser(controller=StandAloneMakeStubFile())
+
+
+def new_stub(kind, name, parent=None):
+    stack = parent.full_name.split('.') if parent and parent.kind != 'root' else None
+    return Stub(kind, name, parent if stack else None, stack)
+
+
+def find_stub(stub, root):
+    "the tree search that merge_stubs did before StubIndex"
+    if stub == root:
+        return root
+    for child in root.children:
+        stub2 = find_stub(stub, child)
+        if stub2:
+            return stub2
+    return None
+
+
+def test_find_is_find_stub(traverser):
+    _, root = traverser.parse_stub_file(OLD, root_name='<old-stubs>')
+    index = StubIndex(root)
+    for stub in traverser.flatten_stubs(root):
+        assert index.find(stub) is find_stub(stub, root)
+    # the duplicate f: the first one, like find_stub
+    f = root.children[-1]
+    assert index.find(f) is root.children[2]
+    assert index.find(new_stub('def', 'h')) is None
+
+
+def test_attach_detach(traverser):
+    _, root = traverser.parse_stub_file(OLD, root_name='<old-stubs>')
+    index = StubIndex(root)
+    a = root.children[0]
+    g = a.children[1]
+    index.detach(a, g)
+    assert index.find(g) is None
+    index.detach(root, a)
+    # the children of a detached stub are gone too
+    assert index.find(a.children[0]) is None
+    assert index.find(root.children[0].children[0]) is find_stub(root.children[0].children[0], root)
+    c = new_stub('class', 'C')
+    h = new_stub('def', 'h', c)
+    index.attach(root, c)
+    assert index.find(c) is c
+    assert index.find(h) is h
+    assert index.find_parent(h) is c
+
+
+def test_sort_stubs_by_hierarchy(traverser):
+    _, root = traverser.parse_stub_file(OLD, root_name='<old-stubs>')
+    stubs = list(reversed(traverser.flatten_stubs(root)[1:]))
+    result = traverser.sort_stubs_by_hierarchy(stubs)
+    assert [z.level() for z in result] == sorted(z.level() for z in stubs)
+    # stable within a level
+    assert [z for z in result if z.level() == 1] == [z for z in stubs if z.level() == 1]
@@ -0,0 +1,95 @@
+import ast
+import pytest
+from make_stub_files import Pattern, PatternIndex, StubFormatter, StubTraverser, compile_config_file
+
+PATTERNS = [
+    Pattern('s', 'str'),
+    Pattern('len(*)', 'int'),
+    Pattern('pin', 'machine.Pin'),
+    Pattern('.*_size$', 'int'),
+    Pattern('r[*]', 'str'),
+    Pattern('s', 'bytes'),            # duplicate, the first one wins
+    Pattern('pin_.*$', 'int'),
+    Pattern('pin_a', 'str'),          # after the regex that also matches
+    Pattern('*_list', 'List'),        # starts with a wildcard
+    Pattern('x*', 'float'),           # trailing * matches the rest
+    Pattern('milis()', 'int'),        # plain, not balanced
+    Pattern('a|ab$', 'int'),          # the regex match must cover the string
+    Pattern('os.path.join(*)', 'str'),
+    Pattern('(*)', 'Tuple'),          # starts with a bracket
+]
+
+
+STRINGS = [
+    's', 'pin', 'pin_a', 'pin_b', 'buf_size', 'len(x)', 'len(x', 'len(x)y',
+    'r[0]', 'r[', 'a_list', '_list', 'x', 'xyz', 'milis()', 'milis', 'a', 'ab',
+    'foo', '', '*args', '**kwargs', 'os.path.join(a, b)', 'os.path.join(a)[0]',
+    'os.sep', '(a, b)', '(a)(b)', 'lenx(a)', 'x(a)',
+]
+
+
+def linear_find(patterns, s):
+    "the search that munge_arg used to do"
+    for pattern in patterns:
+        if pattern.match_entire_string(s):
+            return pattern
+    return None
+
+
+def linear_match(patterns, s):
+    "the search that StubFormatter.match_all used to do"
+    for pattern in patterns:
+        found, _ = pattern.match(s)
+        if found:
+            return pattern
+    return None
+
+
+@pytest.mark.parametrize("s", STRINGS)
+def test_find_is_linear_find(s):
+    index = PatternIndex(PATTERNS)
+    assert index.find(s) is linear_find(PATTERNS, s)
+
+
+@pytest.mark.parametrize("s", STRINGS)
+def test_find_start_is_linear_match(s):
+    index = PatternIndex(PATTERNS, entire=False)
+    assert index.find(s) is linear_match(PATTERNS, s)
+
+
+def test_find_start():
+    index = PatternIndex(PATTERNS, entire=False)
+    # like Pattern.match, a balanced pattern need only match the start
+    assert index.find('len(x)y') is PATTERNS[1]
+    assert PatternIndex(PATTERNS).find('len(x)y') is None
+
+
+def test_find_first_wins():
+    index = PatternIndex(PATTERNS)
+    assert index.find('s').repl_s == 'str'
+    # the regex comes before the plain pattern
+    assert index.find('pin_a') is PATTERNS[6]
+
+
+def test_backreferences():
+    patterns = [Pattern(r'(a)\1$', 'int'), Pattern(r'(b)\1$', 'str')]
+    index = PatternIndex(patterns)
+    assert index.regex is None
+    assert index.find('bb') is patterns[1]
+
+
+def test_empty():
+    index = PatternIndex([])
+    assert index.find('s') is None
+
+
+def test_match_cache_size(mocker):
+    config = compile_config_file()
+    formatter = StubFormatter(config, StubTraverser(config))
+    mocker.patch.object(StubFormatter, "match_cache_size", 3)
+    node = ast.Name(id="x")
+    for s in ("a", "b", "c", "d", "a"):
+        formatter.match_all(node, s)
+        assert len(config.match_cache) <= 3
+    # the formatters share the cache of the controller
+    assert formatter.match_cache is config.match_cache
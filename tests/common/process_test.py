@@ -0,0 +1,146 @@
+"""
+The mpy-cross helpers of process.py, with the subprocess mocked
+"""
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+sys.path.insert(1, ".")
+import process  # pylint: disable=wrong-import-position
+
+# pylint: disable=redefined-outer-name
+
+# sys.implementation.mpy of an esp32: arch xtensawin, mpy v5
+ESP32_MPY = 10 << 10 | 5
+
+
+@pytest.mark.parametrize(
+    "sys_mpy, arch",
+    [
+        (5, None),
+        (1 << 10 | 5, 'x86'),
+        (2 << 10 | 5, 'x64'),
+        (6 << 10 | 5, 'armv7em'),
+        (9 << 10 | 5, 'xtensa'),
+        (ESP32_MPY, 'xtensawin'),
+        (str(ESP32_MPY), 'xtensawin'),
+        (11 << 10 | 5, None),
+    ],
+)
+def test_mpy_arch(sys_mpy, arch):
+    assert process.mpy_arch(sys_mpy) == arch
+
+
+@pytest.mark.parametrize(
+    "script, compiled",
+    [
+        ('board/createstubs.py', 'board/createstubs_mpy.mpy'),
+        ('minified/createstubs_info.py', 'minified/createstubs_info_mpy.mpy'),
+    ],
+)
+def test_mpy_path(script, compiled):
+    "a .py would be imported before a .mpy of the same name"
+    assert process.mpy_path(script) == Path(compiled)
+
+
+def test_resolve_arch(capsys):
+    assert process.resolve_arch('x64') == 'x64'
+    assert process.resolve_arch(None, ESP32_MPY) == 'xtensawin'
+    assert process.resolve_arch('xtensawin', ESP32_MPY) == 'xtensawin'
+    capsys.readouterr()
+    with pytest.raises(SystemExit) as e:
+        process.resolve_arch('x64', ESP32_MPY)
+    assert e.value.code == 1
+    assert '--arch x64 conflicts with --mpy {}'.format(ESP32_MPY) in capsys.readouterr().out
+
+
+@pytest.fixture
+def mpy_cross(mocker):
+    "a mpy-cross on the PATH that emits mpy v5, the calls are in .call_args_list"
+    mocker.patch.object(process.shutil, 'which', side_effect=lambda name: '/usr/bin/' + name)
+
+    def run(cmd, **kwargs):  # pylint: disable=unused-argument
+        out = 'MicroPython v1.13 on 2020-09-02; mpy-cross emitting mpy v5\n' if '--version' in cmd else ''
+        return subprocess.CompletedProcess(cmd, 0, stdout=out, stderr='')
+
+    return mocker.patch.object(process.subprocess, 'run', side_effect=run)
+
+
+def test_compile_mpy(mpy_cross, tmp_path):
+    script = tmp_path / 'createstubs.py'
+    assert process.compile_mpy(script, arch='x64', mpy_cross='mpy-cross') == tmp_path / 'createstubs_mpy.mpy'
+    cmd = mpy_cross.call_args[0][0]
+    # -s keeps the file name in tracebacks, without the folder
+    assert cmd == ['mpy-cross', '-s', 'createstubs.py', '-o', str(tmp_path / 'createstubs_mpy.mpy'), '-march=x64', str(script)]
+    assert mpy_cross.call_args[1]['check']
+    process.compile_mpy(script, tmp_path / 'other.mpy', mpy_cross='mpy-cross')
+    assert not any(z.startswith('-march') for z in mpy_cross.call_args[0][0])
+
+
+@pytest.fixture
+def variant(tmp_path):
+    "a createstubs.py with one of its phase modules"
+    for name in ('createstubs.py', 'createstubs_info.py'):
+        (tmp_path / name).write_text('x = 1\n')
+    return tmp_path / 'createstubs.py'
+
+
+def test_cli_compile(mpy_cross, variant, capsys):
+    process.cli_compile(mpy=ESP32_MPY, arch=None, mpy_cross=None, variants=[variant, variant.parent / 'none.py'])
+    compiled = [z[0][0] for z in mpy_cross.call_args_list if '--version' not in z[0][0]]
+    assert [Path(cmd[4]).name for cmd in compiled] == ['createstubs_mpy.mpy', 'createstubs_info_mpy.mpy']
+    assert all(cmd[0] == '/usr/bin/mpy-cross' and '-march=xtensawin' in cmd for cmd in compiled)
+    out = capsys.readouterr().out
+    assert 'Skipping {}, not found'.format(variant.parent / 'none.py') in out
+    assert 'Warning' not in out
+
+
+def test_cli_compile_other_mpy_version(mpy_cross, variant, capsys):
+    process.cli_compile(mpy=6 << 10 | 6, arch=None, mpy_cross=None, variants=[variant])
+    assert 'emits mpy v5, the board expects mpy v6' in capsys.readouterr().out
+    assert '-march=armv7em' in mpy_cross.call_args[0][0]
+
+
+def test_cli_compile_conflict(mpy_cross, variant):
+    with pytest.raises(SystemExit):
+        process.cli_compile(mpy=ESP32_MPY, arch='x64', mpy_cross=None, variants=[variant])
+    assert not mpy_cross.called
+
+
+def test_cli_compile_no_mpy_cross(mocker, variant, capsys):
+    mocker.patch.object(process.shutil, 'which', return_value=None)
+    run = mocker.patch.object(process.subprocess, 'run')
+    with pytest.raises(SystemExit):
+        process.cli_compile(mpy=None, arch=None, mpy_cross='none', variants=[variant])
+    assert 'mpy-cross is required' in capsys.readouterr().out
+    assert not run.called
+
+
+def test_cli_measure(mocker, variant, capsys):
+    process.mpy_path(variant).write_bytes(b'M\x05')
+    heap = {variant: 60000, process.mpy_path(variant): 20000}
+    heap_used = mocker.patch.object(process, 'heap_used', side_effect=lambda f, micropython: heap[f])
+    process.cli_measure(micropython='micropython', variants=[variant])
+    assert heap_used.call_count == 2
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[2].split()[-2:] == ['6', '60000']
+    assert lines[3].split()[-2:] == ['2', '20000']
+    assert lines[4].split()[-2:] == ['40000', '(66%)']
+
+
+def test_cli_measure_failed(mocker, variant, capsys):
+    "no saving is reported when the .mpy does not load"
+    process.mpy_path(variant).write_bytes(b'M\x06')
+    mocker.patch.object(process, 'heap_used', side_effect=[60000, None])
+    process.cli_measure(micropython='micropython', variants=[variant])
+    out = capsys.readouterr().out
+    assert out.splitlines()[3].split()[-1] == '?'
+    assert 'compile RAM saved' not in out
+
+
+def test_edit_lines_keep():
+    "the progress events survive the minify edits, the other prints do not"
+    content = "def emit(v):\n    print(PROGRESS + v)\n    print('debug')\n"
+    edits = [("keep", "print(PROGRESS"), ("comment", "print")]
+    assert process.edit_lines(content, edits) == "def emit(v):\n    print(PROGRESS + v)\n    # print('debug')\n"
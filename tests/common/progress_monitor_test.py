@@ -0,0 +1,93 @@
+import io
+import json
+import pytest
+from progress_monitor import ProgressMonitor, monitor, duration, PROGRESS
+
+# pylint: disable=redefined-outer-name
+
+RUN = [
+    'MicroPython v1.13 on 2020-09-02; linux version',
+    PROGRESS + '{"ev": "run", "total": 4, "fwid": "micropython-linux-1.13", "t": 100, "mem": 9000}',
+    PROGRESS + '{"ev": "skip", "n": 1, "mod": "_internal", "why": "internal", "t": 101, "mem": 9000}',
+    PROGRESS + '{"ev": "start", "n": 2, "mod": "utime", "t": 102, "mem": 9000}',
+    'INFO  :stubber :Stub module: utime',
+    PROGRESS + '{"ev": "end", "n": 2, "mod": "utime", "ok": true, "ms": 40, "used": 300, "t": 142, "mem": 8700}',
+    PROGRESS + '{"ev": "start", "n": 3, "mod": "ujson", "t": 143, "mem": 8700}',
+    PROGRESS + '{"ev": "error", "n": 3, "mod": "ujson", "err": "[Errno 28] ENOSPC", "t": 150, "mem": 8700}',
+    PROGRESS + '{"ev": "end", "n": 3, "mod": "ujson", "ok": false, "ms": 7, "used": 20, "t": 150, "mem": 8680}',
+    PROGRESS + '{"ev": "start", "n": 4, "mod": "uos", "t": 151, "mem": 8680}',
+    PROGRESS + '{"ev": "end", "n": 4, "mod": "uos", "ok": true, "ms": 80, "used": 500, "t": 231, "mem": 8180}',
+    PROGRESS + '{"ev": "done", "stubs": 2, "ms": 131, "t": 231, "mem": 8180}',
+]
+
+
+class Clock():
+    "a clock the test sets"
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_feed(clock):
+    progress = ProgressMonitor(clock)
+    assert progress.feed(RUN[0]) is None
+    assert progress.feed(RUN[1])['ev'] == 'run'
+    assert progress.total == 4
+    # output on the REPL can precede the event on the same line
+    event = progress.feed('>>> ' + RUN[2])
+    assert event['mod'] == '_internal'
+    assert progress.count == 1
+
+
+def test_eta(clock):
+    progress = ProgressMonitor(clock)
+    assert progress.eta is None
+    progress.feed(RUN[1])
+    clock.now = 2.0
+    progress.feed(RUN[2])
+    progress.feed(RUN[3])
+    assert progress.current == 'utime'
+    # 1 module in 2 seconds, 3 to go
+    assert progress.rate == 0.5
+    assert progress.eta == 6.0
+    assert progress.status().startswith('[  1/4  ]   0.5 mod/s  ETA    0:06  utime')
+
+
+def test_summary(clock):
+    progress = ProgressMonitor(clock)
+    for line in RUN:
+        clock.now += 1
+        progress.feed(line)
+    assert progress.finished
+    assert progress.count == 4
+    assert [e['mod'] for e in progress.modules] == ['utime', 'uos']
+    assert len(progress.skipped) == 2
+    assert len(progress.errors) == 1
+    summary = progress.summary().splitlines()
+    assert summary[0] == '4 modules in 0:10: 2 stubs, 2 skipped, 1 errors'
+    assert summary[1:3] == ['slowest:', '  uos                                 80 ms']
+    assert summary[-1].startswith('error: ujson')
+
+
+def test_monitor(tmp_path):
+    logfile = tmp_path / 'run.jsonl'
+    out = io.StringIO()
+    stream = io.BytesIO("\n".join(RUN + ['after the run']).encode())
+    progress = monitor(stream, str(logfile), out=out)
+    assert progress.finished
+    events = [json.loads(l) for l in logfile.read_text().splitlines()]
+    assert len(events) == len(RUN) - 2
+    assert all('host_t' in e for e in events)
+    assert 'slowest:' in out.getvalue()
+
+
+@pytest.mark.parametrize("seconds, text", [(0, '0:00'), (59.6, '1:00'), (754, '12:34')])
+def test_duration(seconds, text):
+    assert duration(seconds) == text
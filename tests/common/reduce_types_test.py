@@ -0,0 +1,36 @@
+import pytest
+from make_stub_files import ReduceTypes, reduce_types, reduce_types_cache, reduce_types_cache_info
+
+
+@pytest.mark.parametrize("types", [
+    ['int'],
+    ['None', 'str'],
+    ['', 'None'],
+    [None, 'int', 'float'],
+    ['int', 'number', 'long'],
+    ['List[int]', 'List[foo]', 'List[int]'],
+    ['Dict[str, foo]', 'Tuple[int, bar]', 'self.x'],
+    ['str', 'bytes', 'unknown(a)'],
+])
+def test_reduce_types(types):
+    expected = ReduceTypes(list(types)).reduce_types()
+    reduce_types_cache.cache_clear()
+    assert reduce_types(types) == expected
+    assert reduce_types(types) == expected
+    info = reduce_types_cache.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+
+def test_reduce_types_trace(capsys):
+    "a cache hit traces the same as a miss"
+    reduce_types_cache.cache_clear()
+    reduce_types(['None', 'int', 'str'], name='Foo.bar', trace=True)
+    miss = capsys.readouterr().out
+    reduce_types(['None', 'int', 'str'], name='Foo.bar', trace=True)
+    assert capsys.readouterr().out == miss
+    assert 'Optional[Union[int, str]]' in miss
+
+
+def test_reduce_types_cache_info():
+    assert reduce_types_cache_info(3, 1) == 'reduce_types cache: 4 calls, 3 hits, 75.0% hit rate'
+    assert reduce_types_cache_info(0, 0) == 'reduce_types cache: 0 calls, 0 hits,  0.0% hit rate'
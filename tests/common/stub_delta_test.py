@@ -0,0 +1,112 @@
+import os
+import glob
+import shutil
+import pytest
+import stub_delta
+from make_stub_files import compile_config_file, make_stub_string
+
+# pylint: disable=redefined-outer-name
+
+STUBS = "./tests/test_data/stubs"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "x = 1",
+        "# only a comment\n",
+        "x = 1; y = 2\r\nclass A: pass\r\n",
+        '"""doc"""\n# MCU\n\n@deco\ndef f():\n    pass\n\nclass A(B):\n    X = 1\n    def g(self):\n        return 1\n\n\n# the end',
+        "def f(\n    a,\n):\n    pass\rx = 2\r",
+    ],
+)
+def test_symbol_table(text):
+    symbols = stub_delta.symbol_table(text)
+    assert "".join(z[1] for z in symbols) == text
+
+
+def test_symbol_table_keys():
+    text = '"""doc"""\n@deco\ndef f():\n    pass\nclass A(B):\n    X = 1\n    def g(self):\n        return 1\nX = 1\nX = 2\nimport os\n'
+    symbols = stub_delta.symbol_table(text)
+    assert [(z[0], z[2]) for z in symbols] == [
+        ("<header>", False),
+        ("<doc>", False),
+        ("f", True),
+        ("A", True),
+        ("A.X", True),
+        ("A.g", True),
+        ("X", False),
+        ("X#2", False),
+        ("<Import>", False),
+    ]
+    assert symbols[2][1] == "@deco\ndef f():\n    pass\n"
+    assert stub_delta.symbol_table("def (:") is None
+
+
+def test_symbol_table_corpus():
+    for fn in glob.glob(STUBS + "/**/*.py", recursive=True):
+        text = stub_delta.read_text(fn)
+        symbols = stub_delta.symbol_table(text)
+        if symbols is not None:
+            assert "".join(z[1] for z in symbols) == text, fn
+
+
+@pytest.fixture
+def versions(tmp_path):
+    "copies of two versions, with their stubs"
+    config = compile_config_file()
+    for name in ("micropython-linux-1_12", "micropython-linux-1_13"):
+        shutil.copytree(os.path.join(STUBS, name), str(tmp_path / name), ignore=shutil.ignore_patterns("__pycache__"))
+        for fn in glob.glob(str(tmp_path / name / "*.py")):
+            with open(fn) as f, open(fn + "i", "w") as pyi:
+                pyi.write(make_stub_string(f.read(), config))
+    return tmp_path / "micropython-linux-1_12", tmp_path / "micropython-linux-1_13"
+
+
+def test_diff_trees(versions):
+    base, new = versions
+    report = stub_delta.diff_trees(str(base), str(new))
+    assert report["removed"] == ["logging.py"]
+    assert report["changed"]["uos.py"]["added"] == ["putenv", "rename", "rmdir", "unsetenv"]
+    assert report["changed"]["uos.py"]["stub"]
+    # only the docstring changed
+    assert report["changed"]["ujson.py"] == {"added": [], "removed": [], "changed": ["<doc>"], "stub": False}
+    assert report["changed"]["modules.json"] == {"text": True, "stub": False}
+
+
+def test_store_and_rebuild(versions, tmp_path, mocker):
+    base, new = versions
+    delta_fn = str(tmp_path / "1_13.delta.json.gz")
+    stub_delta.write_delta(stub_delta.make_delta(str(base), str(new)), delta_fn)
+    delta = stub_delta.read_delta(delta_fn)
+    assert "uos.py" in delta["restub"] and "ujson.py" not in delta["restub"]
+    assert os.path.getsize(delta_fn) < sum(os.path.getsize(str(new / z)) for z in delta["files"]) / 4
+    make = mocker.spy(stub_delta, "make_stub_string")
+    dest = tmp_path / "rebuilt"
+    result = stub_delta.rebuild(str(base), delta, str(dest))
+    assert make.call_count == result["stubs_made"] == len(delta["restub"])
+    assert result["stubs_copied"] == len(glob.glob(str(new / "*.py"))) - len(delta["restub"])
+    for fn in sorted(os.listdir(str(new))):
+        with open(str(new / fn), "rb") as f1, open(str(dest / fn), "rb") as f2:
+            assert f1.read() == f2.read(), fn
+
+
+def test_rebuild_other_base(versions, tmp_path):
+    base, new = versions
+    delta = stub_delta.make_delta(str(base), str(new))
+    # a symbol that the delta takes from the base
+    fn = base / "ujson.py"
+    fn.write_text(fn.read_text().replace("def dumps():", "def dumps(obj):"))
+    with pytest.raises(ValueError):
+        stub_delta.rebuild(str(base), delta, str(tmp_path / "rebuilt"))
+    assert not (tmp_path / "rebuilt").exists()
+
+
+def test_rebuild_missing_base_file(versions, tmp_path):
+    base, new = versions
+    delta = stub_delta.make_delta(str(base), str(new))
+    (base / "machine.py").unlink()
+    with pytest.raises(ValueError):
+        stub_delta.rebuild(str(base), delta, str(tmp_path / "rebuilt"))
+    assert not (tmp_path / "rebuilt").exists()
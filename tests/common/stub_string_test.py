@@ -0,0 +1,113 @@
+import io
+import ast
+import pickle
+import sys
+import subprocess
+import pytest
+from make_stub_files import compile_config, compile_config_file, make_stub_string, StubTraverser
+
+# pylint: disable=redefined-outer-name
+
+SOURCE = '''
+class Sensor:
+    def read(self, pin):
+        return len(self.buf)
+
+def scale(n):
+    return n * 2
+'''
+
+CONFIG = '''
+[Global]
+prefix_lines: from typing import Any
+
+[General Patterns]
+pin: machine.Pin
+len(*): int
+'''
+
+
+@pytest.fixture
+def no_files(mocker):
+    "fail on any file access"
+    mocker.patch('builtins.open', side_effect=AssertionError('open'))
+    mocker.patch('os.path.exists', side_effect=AssertionError('exists'))
+
+
+def test_make_stub_string(no_files):
+    config = compile_config(CONFIG)
+    s = make_stub_string(SOURCE, config)
+    assert s.startswith('from typing import Any\n')
+    assert 'def read(self, pin: machine.Pin) -> int: ...' in s
+    assert 'def scale(n: Any) -> Any: ...' in s
+
+
+def test_make_stub_string_no_config(no_files):
+    s = make_stub_string(SOURCE)
+    assert 'def read(self, pin: Any) -> Any: ...' in s
+
+
+def test_make_stub_string_update(no_files):
+    config = compile_config(CONFIG)
+    pyi = 'class Sensor:\n    def read(self, pin: str) -> bytes: ...\ndef gone() -> None: ...\n'
+    s = make_stub_string(SOURCE, config, pyi=pyi)
+    # existing stubs are kept, stubs that are gone are removed, new ones are added
+    assert 'def read(self, pin: str) -> bytes: ...' in s
+    assert 'gone' not in s
+    assert 'def scale(n: Any) -> Any: ...' in s
+
+
+NESTED = '''
+class A:
+    def f(self, a):
+        def inner(b):
+            return b
+        return a
+    class B:
+        def g(self):
+            pass
+    def f(self, a):
+        pass
+
+def h(*args, **kw):
+    return 1
+'''
+
+
+def test_stream_same_as_tree():
+    config = compile_config_file()
+    node = ast.parse(NESTED)
+    t = StubTraverser(controller=config)
+    tree = t.format_stubs(t.make_root(node))
+    t = StubTraverser(controller=config)
+    f = io.StringIO()
+    t.write_stubs(node, f)
+    assert f.getvalue() == tree
+    # no stub tree is built
+    assert t.parent_stub is None and t.output_file is None
+    assert make_stub_string(NESTED, config) == tree
+
+
+def test_config_not_changed():
+    config = compile_config(CONFIG)
+    # the contents too: the patterns compare by identity
+    before = {k: pickle.dumps(v) for k, v in config.__dict__.items()}
+    make_stub_string(SOURCE, config, pyi='def old(): ...\n')
+    assert config.__dict__.keys() == before.keys()
+    assert [k for k, v in config.__dict__.items() if pickle.dumps(v) != before[k]] == ['match_cache']
+    # shared by the next calls
+    assert config.match_cache
+
+
+def test_syntax_error():
+    with pytest.raises(SyntaxError) as e:
+        make_stub_string('def (:\n', fn='broken.py')
+    assert e.value.filename == 'broken.py'
+
+
+def test_same_as_cli(tmp_path):
+    src = tmp_path / 'sensor.py'
+    src.write_text(SOURCE)
+    cmd = [sys.executable, 'src/make_stub_files.py', '-c', 'src/make_stub_files.cfg', '-s', str(src)]
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    assert (tmp_path / 'sensor.pyi').read_text() == make_stub_string(SOURCE, compile_config_file())
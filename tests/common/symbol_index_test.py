@@ -0,0 +1,137 @@
+import os
+import json
+import shutil
+import pytest
+import symbol_index
+
+# pylint: disable=redefined-outer-name
+
+STUBS = "./tests/test_data/stubs"
+
+
+def test_module_symbols():
+    text = 'X = 1\nY: int = 2\nclass A(B):\n    C = 3\n    def f(self):\n        z = 1\n    class D:\n        async def g(self): pass\ntry:\n    def h(): pass\nexcept ImportError:\n    def h(): pass\nif X:\n    W = 1\nimport os\nX = 4\n'
+    assert symbol_index.module_symbols(text) == [
+        ("X", "v"),
+        ("Y", "v"),
+        ("A", "c"),
+        ("A.C", "v"),
+        ("A.f", "d"),
+        ("A.D", "c"),
+        ("A.D.g", "d"),
+        ("h", "d"),
+        ("W", "v"),
+    ]
+
+
+@pytest.mark.parametrize("path, module", [("machine.py", "machine"), ("umqtt/simple.py", "umqtt.simple"), ("umqtt/__init__.pyi", "umqtt")])
+def test_module_name(path, module):
+    assert symbol_index.module_name(path) == module
+
+
+@pytest.fixture
+def stubs(tmp_path):
+    "a copy of the test stubs, and their index"
+    folder = tmp_path / "all-stubs"
+    shutil.copytree(STUBS, str(folder), ignore=shutil.ignore_patterns("__pycache__"))
+    return folder, str(tmp_path / "symbols.db")
+
+
+def test_find_firmwares(stubs):
+    folder, _ = stubs
+    package = folder / "micropython-1_15-frozen/esp32/GENERIC/umqtt"
+    package.mkdir()
+    (package / "simple.py").write_text("class MQTTClient: pass\n")
+    firmwares = symbol_index.find_firmwares(str(folder))
+    assert sorted(firmwares) == [
+        "micropython-1_15-frozen/esp32/GENERIC",
+        "micropython-1_15-frozen/esp32/TINYPICO",
+        "micropython-1_15-frozen/esp8266/GENERIC",
+        "micropython-1_15-frozen/rp2/GENERIC",
+        "micropython-linux-1_12",
+        "micropython-linux-1_13",
+    ]
+    assert "umqtt/simple.py" in firmwares["micropython-1_15-frozen/esp32/GENERIC"]
+
+
+def test_find_firmwares_layouts(tmp_path):
+    for path in (
+        "frozen/esp32/GENERIC/neopixel.py",
+        "frozen/esp32/GENERIC/umqtt/simple.py",
+        "frozen/esp32/GENERIC/umqtt/robust/__init__.py",
+        "frozen/esp8266/GENERIC/apa102.py",
+        "cpython_core/os/path.py",
+        "cpython_core/os/__init__.py",
+        "fw/machine.py",
+        "fw/lib/sensor.py",
+        "fw/board/modules.json",
+        "fw/board/board.py",
+        "loose.py",
+    ):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("x = 1\n")
+    firmwares = symbol_index.find_firmwares(str(tmp_path))
+    assert {k: sorted(v) for k, v in firmwares.items()} == {
+        # no manifest and no files of their own: each board is a firmware, with its packages
+        "frozen/esp32/GENERIC": ["neopixel.py", "umqtt/robust/__init__.py", "umqtt/simple.py"],
+        "frozen/esp8266/GENERIC": ["apa102.py"],
+        "cpython_core/os": ["__init__.py", "path.py"],
+        # files of its own: all sub folders, except those with a manifest
+        "fw": ["lib/sensor.py", "machine.py"],
+        "fw/board": ["board.py"],
+        # the files in the top folder
+        ".": ["loose.py"],
+    }
+
+
+def test_update_and_query(stubs):
+    folder, db = stubs
+    stats = symbol_index.update_index(str(folder), db)
+    assert stats["parsed"] == stats["files"] > 0 and stats["firmwares"] == 6
+    rows = symbol_index.query(db, "neopixel.NeoPixel")
+    assert [z["folder"] for z in rows] == ["micropython-1_15-frozen/esp8266/GENERIC", "micropython-1_15-frozen/esp32/GENERIC"]
+    assert rows[1]["kind"] == "class" and rows[1]["version"] == "1.15"
+    # the end of a name, and a pattern
+    assert symbol_index.query(db, "NeoPixel") == rows
+    assert symbol_index.query(db, "neopixel.*Pixel") == rows
+    assert symbol_index.query(db, "Pixel") == []
+    assert [z["folder"] for z in symbol_index.query(db, "NeoPixel", port="esp8266")] == []
+    linux = symbol_index.query(db, "utime.sleep_ms", port="linux")
+    assert [(z["family"], z["version"]) for z in linux] == [("micropython", "1.12.0")]
+    assert symbol_index.since(symbol_index.query(db, "sleep_ms", folder="micropython-linux-*"))[1] == {
+        "name": "time.sleep_ms",
+        "family": "micropython",
+        "port": "linux",
+        "since": "1.12.0",
+        "versions": 1,
+    }
+    # nothing changed
+    assert symbol_index.update_index(str(folder), db)["parsed"] == 0
+
+
+def test_update_incremental(stubs):
+    folder, db = stubs
+    symbol_index.update_index(str(folder), db)
+    fw = folder / "micropython-linux-1_12"
+    (fw / "machine.py").write_text("class Pin:\n    def irq(self):\n        pass\n")
+    (fw / "added.py").write_text("def new(): pass\n")
+    (fw / "ujson.py").unlink()
+    shutil.rmtree(str(folder / "micropython-linux-1_13"))
+    stats = symbol_index.update_index(str(folder), db)
+    assert stats["parsed"] == 2 and stats["firmwares"] == 5
+    assert [z["folder"] for z in symbol_index.query(db, "Pin.irq")] == ["micropython-linux-1_12"]
+    assert symbol_index.query(db, "machine.PinBase") == []
+    assert symbol_index.query(db, "ujson.dumps") == []
+    assert len(symbol_index.query(db, "added.new")) == 1
+    # a new version in the manifest
+    manifest = json.loads((fw / "modules.json").read_text())
+    manifest["firmware"]["version"] = "1.12.1"
+    (fw / "modules.json").write_text(json.dumps(manifest))
+    os.utime(str(fw / "modules.json"), ns=(1, 1))
+    assert symbol_index.update_index(str(folder), db)["parsed"] == 0
+    assert symbol_index.query(db, "Pin.irq")[0]["version"] == "1.12.1"
+
+
+def test_query_no_index(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        symbol_index.query(str(tmp_path / "none.db"), "machine.Pin")
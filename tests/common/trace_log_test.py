@@ -0,0 +1,57 @@
+import sys
+import json
+import subprocess
+import make_stub_files
+from make_stub_files import Pattern, TraceLog
+
+# pylint: disable=redefined-outer-name
+
+SOURCE = '''
+def count(items):
+    return len(items)
+
+def name(s):
+    return s.upper()
+'''
+
+
+def test_no_trace_no_callers(mocker):
+    "the stack is only inspected when tracing"
+    callers = mocker.patch.object(make_stub_files.g, 'callers', return_value='a,b,c')
+    assert Pattern('len(*)', 'int').match('len(x)') == (True, 'int')
+    assert Pattern('.*_size$', 'int').match('buf_size') == (True, 'int')
+    assert callers.call_count == 0
+    assert Pattern('len(*)', 'int').match('len(x)', trace=True) == (True, 'int')
+    assert callers.call_count == 1
+
+
+def test_trace_log(tmp_path):
+    log = TraceLog(str(tmp_path / 'trace.jsonl'))
+    log.event('match', pattern='len(*)', input='len(x)', result='int')
+    log.close()
+    log.event('visitor', op='call')
+    log.close()
+    lines = (tmp_path / 'trace.jsonl').read_text().splitlines()
+    assert [json.loads(l)['ev'] for l in lines] == ['match', 'visitor']
+    log.clear()
+    assert (tmp_path / 'trace.jsonl').read_text() == ''
+
+
+def test_trace_file(tmp_path):
+    "--trace-file writes the events instead of printing them"
+    src = tmp_path / 'sample.py'
+    src.write_text(SOURCE)
+    trace = tmp_path / 'trace.jsonl'
+    cmd = [sys.executable, 'src/make_stub_files.py', '-c', 'src/make_stub_files.cfg', '-s',
+           '--trace-matches', '--trace-visitors', '--trace-file', str(trace), str(src)]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert 'match_all' not in out
+    events = [json.loads(l) for l in trace.read_text().splitlines()]
+    matches = [e for e in events if e['ev'] == 'match' and e['pattern']]
+    assert matches[0]['pattern'] == 'len(*)'
+    assert matches[0]['input'] == 'len(items)'
+    assert matches[0]['result'] == 'int'
+    assert matches[0]['caller'] == 'do_Call'
+    assert 'us' in matches[0]
+    assert any(e['ev'] == 'visitor' for e in events)
+    assert 'def count(items: Any) -> int: ...' in (tmp_path / 'sample.pyi').read_text()
@@ -1,4 +1,7 @@
 #SOT
+import os
+import sys
+import json
 import pytest
 import utils
 
@@ -26,3 +29,184 @@ def test_clean_version(commit, build, clean):
 
 
 # make manifest 
+
+
+# content-addressed store
+@pytest.fixture
+def stub_tree(tmp_path):
+    "two versions with the same stubs, and one changed file"
+    for version in ('1_12', '1_13'):
+        folder = tmp_path / 'micropython-{}-frozen'.format(version) / 'esp32' / 'GENERIC'
+        folder.mkdir(parents=True)
+        (folder / 'neopixel.py').write_text('class NeoPixel:\n    pass\n' * 20)
+        (folder / 'neopixel.pyi').write_text('class NeoPixel: ...\n' * 20)
+        (folder / 'ntptime.py').write_text('def settime():\n    pass  # {}\n'.format(version))
+        (folder / 'modules.json').write_text('{"version": "%s"}' % version)
+    return tmp_path
+
+
+def test_compact_folder(stub_tree):
+    texts = {p: p.read_text() for p in stub_tree.rglob('*.*')}
+    result = utils.compact_folder(str(stub_tree))
+    assert result['files'] == 6
+    assert result['unique'] == 4
+    duplicated = len(texts[next(stub_tree.rglob('neopixel.py'))]) + len(texts[next(stub_tree.rglob('neopixel.pyi'))])
+    # less the folder of the store
+    assert result['saved'] == duplicated - (stub_tree / utils.OBJECT_FOLDER).lstat().st_size
+    # same content, now shared
+    for p, text in texts.items():
+        assert p.read_text() == text
+    a, b = sorted(stub_tree.rglob('neopixel.pyi'))
+    assert a.samefile(b)
+    assert (stub_tree / utils.OBJECT_FOLDER).is_dir()
+    # modules.json is not shared
+    assert (stub_tree / 'micropython-1_12-frozen/esp32/GENERIC/modules.json').stat().st_nlink == 1
+    # again: nothing to do
+    assert utils.compact_folder(str(stub_tree))['saved'] == 0
+
+
+def test_compact_folder_symlinks(stub_tree, mocker):
+    mocker.patch('os.link', side_effect=OSError('cross-device link'))
+    texts = {p: p.read_text() for p in stub_tree.rglob('*.py*')}
+    result = utils.compact_folder(str(stub_tree))
+    assert result['unique'] == 4
+    for p, text in texts.items():
+        assert p.is_symlink()
+        assert p.read_text() == text
+    # the objects only have symlinks
+    assert utils.compact_folder(str(stub_tree))['removed'] == 0
+    for p, text in texts.items():
+        assert p.read_text() == text
+
+
+def test_unshare(stub_tree):
+    utils.compact_folder(str(stub_tree))
+    a, b = sorted(stub_tree.rglob('neopixel.pyi'))
+    utils.unshare(str(a))
+    a.write_text('changed')
+    assert b.read_text().startswith('class NeoPixel')
+
+
+def test_compact_folder_gc(stub_tree):
+    utils.compact_folder(str(stub_tree))
+    objects = sorted((stub_tree / utils.OBJECT_FOLDER).iterdir())
+    for p in stub_tree.rglob('neopixel.pyi'):
+        utils.unshare(str(p))
+        p.write_text('class NeoPixel: ...\n')
+    result = utils.compact_folder(str(stub_tree), gc=False)
+    assert result['removed'] == 0 and result['unique'] == 4
+    assert len(list((stub_tree / utils.OBJECT_FOLDER).iterdir())) == 5
+    # the old object of neopixel.pyi
+    result = utils.compact_folder(str(stub_tree))
+    assert result['removed'] == 1 and result['saved'] > 0
+    assert sorted((stub_tree / utils.OBJECT_FOLDER).iterdir()) != objects
+    assert len(list((stub_tree / utils.OBJECT_FOLDER).iterdir())) == 4
+
+
+def test_write_stub_file_breaks_link(stub_tree):
+    from make_stub_files import StandAloneMakeStubFile
+    utils.compact_folder(str(stub_tree))
+    a, b = sorted(stub_tree.rglob('neopixel.py'))
+    x = StandAloneMakeStubFile()
+    x.silent = True
+    x.write_stub_file(str(a), 'changed\n', None, 0)
+    assert (a.parent / 'neopixel.pyi').read_text() == 'changed\n'
+    assert (b.parent / 'neopixel.pyi').read_text().startswith('class NeoPixel')
+
+
+def test_store_write(tmp_path):
+    store = str(tmp_path / 'objects')
+    for folder in 'ab':
+        assert utils.store_write(str(tmp_path / folder / 'x.pyi'), b'def f(): ...\n', store) == 'hardlink'
+    assert (tmp_path / 'a' / 'x.pyi').samefile(tmp_path / 'b' / 'x.pyi')
+    assert (tmp_path / 'a' / 'x.pyi').stat().st_nlink == 3
+
+
+# validate_stubs
+@pytest.fixture
+def board_stubs(tmp_path):
+    "a folder written by createstubs, with its manifest"
+    folder = tmp_path / 'micropython-esp32-1_13'
+    (folder / 'umqtt').mkdir(parents=True)
+    modules = []
+    for module in ('machine', 'umqtt.simple'):
+        fn = module.replace('.', '/') + '.py'
+        (folder / fn).write_text('def reset():\n    pass\n')
+        (folder / (fn + 'i')).write_text('def reset() -> None: ...\n')
+        # the path on the board
+        modules.append({"module": module, "file": "/flash/stubs/micropython-esp32-1_13/" + fn})
+    (folder / 'modules.json').write_text(json.dumps({"firmware": {}, "modules": modules}))
+    return folder
+
+
+def kinds(report):
+    return sorted((z['kind'], os.path.basename(z['file'])) for z in report['failures'])
+
+
+def test_validate_stubs(board_stubs):
+    report = utils.validate_stubs(str(board_stubs.parent), require_pyi=True)
+    assert report['files'] == 4
+    assert report['manifests'] == 1
+    assert report['failures'] == []
+
+
+def test_validate_stubs_trailing_slash(board_stubs):
+    # a folder without a manifest
+    (board_stubs.parent / 'frozen').mkdir()
+    (board_stubs.parent / 'frozen' / 'x.py').write_text('x = 1\n')
+    report = utils.validate_stubs(str(board_stubs.parent) + os.sep, jobs=1)
+    assert report['files'] == 5
+    assert report['failures'] == []
+
+
+def test_validate_stubs_failures(board_stubs):
+    (board_stubs / 'machine.pyi').write_text('def reset(pin: Any=) -> None: ...\n')
+    (board_stubs / 'umqtt' / 'simple.py').unlink()
+    (board_stubs / 'esp32.py').write_text('x = 1\n')
+    report = utils.validate_stubs(str(board_stubs.parent), require_pyi=True)
+    assert kinds(report) == [('missing', 'modules.json'), ('no_stub', 'esp32.py'), ('syntax', 'machine.pyi'), ('unlisted', 'esp32.py')]
+    syntax = [z for z in report['failures'] if z['kind'] == 'syntax'][0]
+    assert syntax['line'] == 1
+    json.dumps(report)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="symlinks need privileges")
+def test_validate_stubs_dangling_link(board_stubs, tmp_path):
+    (board_stubs / 'dangling.py').symlink_to(tmp_path / 'nonexistent.py')
+    report = utils.validate_stubs(str(board_stubs.parent), require_pyi=True)
+    assert ('missing', 'dangling.py') in kinds(report)
+    assert report['files'] == 5
+
+
+def test_validate_stubs_invalid_manifest(board_stubs):
+    (board_stubs / 'modules.json').write_text('{"modules": [')
+    report = utils.validate_stubs(str(board_stubs.parent))
+    assert kinds(report) == [('manifest', 'modules.json')]
+
+
+def test_validate_stubs_cache(board_stubs, tmp_path):
+    cache = str(tmp_path / 'validated.json')
+    assert utils.validate_stubs(str(board_stubs), cache=cache)['parsed'] == 4
+    assert utils.validate_stubs(str(board_stubs), cache=cache)['parsed'] == 0
+    (board_stubs / 'machine.pyi').write_text('def reset(:\n')
+    report = utils.validate_stubs(str(board_stubs), cache=cache)
+    assert report['parsed'] == 1
+    assert kinds(report) == [('syntax', 'machine.pyi')]
+    # failures are not cached
+    assert utils.validate_stubs(str(board_stubs), cache=cache)['parsed'] == 1
+
+
+def test_validate_stubs_linked(board_stubs):
+    (board_stubs / 'machine.pyi').write_text('def reset(:\n')
+    os.link(str(board_stubs / 'machine.pyi'), str(board_stubs / 'umqtt' / 'simple.pyi.tmp'))
+    os.replace(str(board_stubs / 'umqtt' / 'simple.pyi.tmp'), str(board_stubs / 'umqtt' / 'simple.pyi'))
+    report = utils.validate_stubs(str(board_stubs))
+    assert report['parsed'] == 3
+    assert kinds(report) == [('syntax', 'machine.pyi'), ('syntax', 'simple.pyi')]
+
+
+def test_validate_stubs_jobs(tmp_path):
+    for i in range(120):
+        (tmp_path / 'm{}.pyi'.format(i)).write_text('def f() -> None: ...\n' if i != 7 else 'def f(\n')
+    report = utils.validate_stubs(str(tmp_path), jobs=2)
+    assert kinds(report) == [('syntax', 'm7.pyi')]
@@ -0,0 +1,232 @@
+"""
+Host mode for createstubs: run the Stubber under CPython
+against the cpython_core mocks and an in-memory filesystem
+"""
+# pylint: disable=import-error,wrong-import-position
+import sys
+import io
+import errno
+import builtins
+import pytest
+
+if sys.path[0] != './board':
+    sys.path[0:0] = ['./board']
+
+# allow loading of the cpython mock-alikes
+core_mocks = './tests/mocks/micropython-cpython_core'
+if sys.path[1] != core_mocks:
+    sys.path[1:1] = [core_mocks]
+
+import uos  # type: ignore
+
+S_IFDIR = 0x4000
+S_IFREG = 0x8000
+
+
+class MemFile(io.StringIO):
+    "text file that is stored in the MemFS when closed"
+
+    def __init__(self, fs, path: str, content: str = ""):
+        super().__init__(content)
+        self._fs = fs
+        self._path = path
+
+    def close(self):
+        if not self.closed:
+            self._fs.files[self._path] = self.getvalue()
+        super().close()
+
+
+class MemFS():
+    """
+    In-memory filesystem mounted on a folder, such as /flash on a board.
+    Follows the uos semantics: errors are OSError with the errno as args[0].
+    Paths outside of the mount are passed to the real filesystem.
+    """
+
+    def __init__(self, mount: str = '/flash'):
+        self.mount = mount.rstrip('/')
+        self.folders = {self.mount}
+        self.files = {}
+        self.cwd = self.mount
+        self._open = builtins.open
+        self._os = {}
+
+    def owns(self, path) -> bool:
+        "is this path on the mount"
+        path = str(path)
+        return path == self.mount or path.startswith(self.mount + '/')
+
+    def _norm(self, path) -> str:
+        path = str(path)
+        if not path.startswith('/'):
+            path = self.cwd + '/' + path
+        parts = []
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if parts:
+                    parts.pop()
+            else:
+                parts.append(part)
+        return '/' + '/'.join(parts)
+
+    def _parent(self, path: str) -> str:
+        return path.rsplit('/', 1)[0] or '/'
+
+    def _children(self, path: str):
+        prefix = path + '/'
+        names = set()
+        for item in self.folders | set(self.files):
+            if item.startswith(prefix):
+                names.add(item[len(prefix):].split('/')[0])
+        return sorted(names)
+
+    def _real(self, name: str, path, *args):
+        return self._os[name](path, *args)
+
+    # uos
+    def stat(self, path):
+        if not self.owns(path):
+            return self._real('stat', path)
+        path = self._norm(path)
+        if path in self.folders:
+            return (S_IFDIR, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        if path in self.files:
+            return (S_IFREG, 0, 0, 0, 0, 0, len(self.files[path]), 0, 0, 0)
+        raise OSError(errno.ENOENT)
+
+    def mkdir(self, path):
+        if not self.owns(path):
+            return self._real('mkdir', path)
+        path = self._norm(path)
+        if path in self.folders or path in self.files:
+            raise OSError(errno.EEXIST)
+        if self._parent(path) not in self.folders:
+            raise OSError(errno.ENOENT)
+        self.folders.add(path)
+        return None
+
+    def listdir(self, path=None):
+        if path is None:
+            path = self.cwd
+        if not self.owns(path):
+            return self._real('listdir', path)
+        path = self._norm(path)
+        if path not in self.folders:
+            raise OSError(errno.ENOENT)
+        return self._children(path)
+
+    def ilistdir(self, path=None):
+        "(name, type, inode, size) as on MicroPython"
+        if path is None:
+            path = self.cwd
+        path = self._norm(path)
+        for name in self.listdir(path):
+            item = path + '/' + name
+            if item in self.folders:
+                yield (name, S_IFDIR, 0, 0)
+            else:
+                yield (name, S_IFREG, 0, len(self.files[item]))
+
+    def remove(self, path):
+        if not self.owns(path):
+            return self._real('remove', path)
+        path = self._norm(path)
+        if path in self.folders:
+            raise OSError(errno.EISDIR)
+        if path not in self.files:
+            raise OSError(errno.ENOENT)
+        del self.files[path]
+        return None
+
+    def rmdir(self, path):
+        if not self.owns(path):
+            return self._real('rmdir', path)
+        path = self._norm(path)
+        if path not in self.folders:
+            raise OSError(errno.ENOENT)
+        if self._children(path):
+            raise OSError(errno.EACCES)
+        self.folders.remove(path)
+        return None
+
+    def rename(self, old, new):
+        if not self.owns(old):
+            return self._real('rename', old, new)
+        old, new = self._norm(old), self._norm(new)
+        if old not in self.folders and old not in self.files:
+            raise OSError(errno.ENOENT)
+        if new in self.folders or new in self.files or self._parent(new) not in self.folders:
+            raise OSError(errno.EEXIST)
+        prefix = old + '/'
+        self.folders = {new + f[len(old):] if f == old or f.startswith(prefix) else f for f in self.folders}
+        self.files = {new + f[len(old):] if f == old or f.startswith(prefix) else f: c for f, c in self.files.items()}
+        return None
+
+    def getcwd(self):
+        return self.cwd
+
+    # builtins
+    def open(self, name, mode='r', *args, **kwargs):
+        if not self.owns(name):
+            return self._open(name, mode, *args, **kwargs)
+        path = self._norm(name)
+        if path in self.folders:
+            raise OSError(errno.EISDIR)
+        if 'w' in mode:
+            if self._parent(path) not in self.folders:
+                raise OSError(errno.ENOENT)
+            return MemFile(self, path)
+        if path not in self.files:
+            raise OSError(errno.ENOENT)
+        if 'a' in mode:
+            f = MemFile(self, path, self.files[path])
+            f.seek(0, io.SEEK_END)
+            return f
+        return MemFile(self, path, self.files[path])
+
+    # test helpers
+    def write(self, path: str, content: str = ""):
+        "create a file, and the folders leading up to it"
+        path = self._norm(path)
+        folder = self._parent(path)
+        while folder not in self.folders:
+            self.folders.add(folder)
+            folder = self._parent(folder)
+        self.files[path] = content
+
+    def read(self, path: str) -> str:
+        return self.files[self._norm(path)]
+
+    def glob(self, suffix: str = ''):
+        "all file paths ending in suffix"
+        return sorted(f for f in self.files if f.endswith(suffix))
+
+
+@pytest.fixture
+def memfs(mocker):
+    "an in-memory /flash, patched into uos and open()"
+    fs = MemFS('/flash')
+    for name in ('stat', 'mkdir', 'listdir', 'ilistdir', 'remove', 'rmdir', 'rename', 'getcwd'):
+        fs._os[name] = getattr(uos, name, None)
+        mocker.patch.object(uos, name, getattr(fs, name), create=True)
+    mocker.patch('builtins.open', fs.open)
+    # stubbing imports and unloads modules, restore them afterwards
+    mocker.patch.dict(sys.modules)
+    return fs
+
+
+@pytest.fixture
+def host_stubber(memfs):
+    "factory for a Stubber that writes to the in-memory /flash and stubs the given modules"
+    from createstubs import Stubber  # type: ignore
+
+    def make(modules=None, **kwargs):
+        stubber = Stubber(**kwargs)
+        if modules is not None:
+            memfs.write('/flash/modulelist.txt', "\n".join(modules) + "\n")
+            stubber.modulelist = '/flash/modulelist.txt'
+        return stubber
+    return make
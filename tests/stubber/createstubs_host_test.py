@@ -0,0 +1,179 @@
+"""
+Run the Stubber on CPython, against the cpython_core mocks and an in-memory /flash
+The unix firmware matrix in tests/board covers the same ground on real MicroPython
+"""
+import json
+# pylint: disable=import-error,redefined-outer-name,protected-access
+# pyright: reportMissingImports=false
+
+# not micropython: importing its mock rebinds builtins.open
+MODULES = ['uio', 'ujson', 'utime']
+
+
+def test_stub_path(host_stubber):
+    stubber = host_stubber()
+    assert stubber.path == '/flash/stubs/' + stubber.flat_fwid
+
+
+def test_create_all_stubs(host_stubber, memfs):
+    stubber = host_stubber(modules=MODULES)
+    stubber.create_all_stubs()
+    stubs = memfs.glob('.py')
+    assert stubs == sorted('{}/{}.py'.format(stubber.path, m) for m in MODULES)
+    content = memfs.read(stubber.path + '/utime.py')
+    assert content.startswith('"""\nModule: \'utime\' on ' + stubber._fwid)
+    assert 'def sleep_us():' in content
+    assert 'MICROPY_PY_UTIME_TICKS_PERIOD = 1073741824' in content
+
+
+def test_skipped_modules(host_stubber, memfs):
+    stubber = host_stubber(modules=['_internal', 'upysh', 'webrepl', 'not_a_module', 'umqtt/simple'])
+    stubber.create_all_stubs()
+    assert memfs.glob('.py') == []
+    assert stubber._report == []
+
+
+def test_list_modules(host_stubber, memfs):
+    memfs.write('/flash/modulelist.txt', "# comment\n\nutime\nujson\n")
+    stubber = host_stubber()
+    stubber.modulelist = '/flash/modulelist.txt'
+    stubber.add_modules(['ujson', 'gps', 'lib/sensor'])
+    # the file order is kept, added modules follow with nested modules first
+    assert list(stubber.list_modules()) == ['utime', 'ujson', 'lib/sensor', 'gps']
+
+
+def test_missing_modulelist(host_stubber):
+    stubber = host_stubber()
+    stubber.modulelist = '/flash/no_such_file.txt'
+    stubber.add_modules(['gps'])
+    assert list(stubber.list_modules()) == ['gps']
+
+
+def test_report(host_stubber, memfs):
+    stubber = host_stubber(modules=MODULES)
+    stubber.create_all_stubs()
+    stubber.report()
+    manifest = json.loads(memfs.read(stubber.path + '/modules.json'))
+    assert manifest['firmware'] == stubber.info
+    assert len(manifest['modules']) == len(memfs.glob('.py'))
+    assert [m['module'] for m in manifest['modules']] == MODULES
+
+
+def test_clean(host_stubber, memfs):
+    stubber = host_stubber()
+    memfs.write(stubber.path + '/old.py')
+    memfs.write(stubber.path + '/umqtt/simple.py')
+    memfs.write('/flash/main.py', 'import createstubs')
+    stubber.clean()
+    assert memfs.glob('.py') == ['/flash/main.py']
+    assert memfs.listdir(stubber.path) == []
+
+
+def test_clean_nested(host_stubber, memfs, mocker):
+    stubber = host_stubber()
+    for n in range(50):
+        memfs.write('{}/f{}.py'.format(stubber.path, n))
+    memfs.write(stubber.path + '/a/b/c/d/deep.py')
+    memfs.write(stubber.path + '/a/b/other.py')
+    remove = mocker.spy(memfs, 'remove')
+    mocker.patch('uos.remove', remove)
+    stubber.clean()
+    assert memfs.glob() == []
+    assert memfs.listdir(stubber.path) == []
+    # folders are never passed to remove()
+    assert remove.call_count == 52
+
+
+def test_clean_continues(host_stubber, memfs, mocker):
+    "a file that cannot be removed does not stop the clean"
+    stubber = host_stubber()
+    locked = stubber.path + '/a/locked.py'
+    for fn in ('/a/locked.py', '/a/other.py', '/b/x.py', '/y.py'):
+        memfs.write(stubber.path + fn)
+    remove = memfs.remove
+
+    def remove_unlocked(path):
+        if path == locked:
+            raise OSError(13)
+        remove(path)
+    mocker.patch('uos.remove', remove_unlocked)
+    stubber.clean()
+    assert memfs.glob() == [locked]
+    assert memfs.listdir(stubber.path) == ['a']
+
+
+def test_clean_without_ilistdir(host_stubber, memfs, mocker):
+    stubber = host_stubber()
+    memfs.write(stubber.path + '/umqtt/simple.py')
+    memfs.write(stubber.path + '/utime.py')
+    mocker.patch('uos.ilistdir', side_effect=AttributeError)
+    stubber.clean()
+    assert memfs.glob() == []
+
+
+def test_clean_missing_folder(host_stubber, memfs):
+    stubber = host_stubber()
+    stubber.clean('/flash/no_such_folder')
+    assert memfs.glob() == []
+
+
+def test_clean_rename(host_stubber, memfs):
+    stubber = host_stubber(modules=MODULES)
+    memfs.write(stubber.path + '/old.py')
+    memfs.write(stubber.path + '_old/older.py')
+    stubber.clean(rename=True)
+    # stubbing starts in an empty folder
+    assert memfs.listdir(stubber.path) == []
+    assert memfs.glob() == ['/flash/modulelist.txt', stubber.path + '_old/older.py', stubber.path + '_old1/old.py']
+    stubber.create_all_stubs()
+    stubber.purge()
+    # only the folder set aside by this run is removed
+    assert stubber.path + '_old1' not in memfs.folders
+    assert memfs.glob('older.py') == [stubber.path + '_old/older.py']
+    assert len(memfs.glob('.py')) == len(MODULES) + 1
+
+
+def test_progress_events(host_stubber, capsys):
+    stubber = host_stubber(modules=['_internal'] + MODULES + ['not_a_module'], progress=True)
+    stubber.create_all_stubs()
+    lines = [l for l in capsys.readouterr().out.splitlines() if l.startswith('@stubber ')]
+    events = [json.loads(l[len('@stubber '):]) for l in lines]
+    assert [e['ev'] for e in events] == ['run', 'skip'] + ['start', 'end'] * 4 + ['done']
+    assert events[0]['total'] == 5
+    assert all('t' in e and 'mem' in e for e in events)
+    ends = [e for e in events if e['ev'] == 'end']
+    assert [e['ok'] for e in ends] == [True, True, True, False]
+    assert events[-1]['stubs'] == len(MODULES)
+
+
+def test_no_progress_events(host_stubber, capsys):
+    stubber = host_stubber(modules=MODULES)
+    stubber.create_all_stubs()
+    assert '@stubber' not in capsys.readouterr().out
+
+
+def test_load_compiled_phase(host_stubber, mocker):
+    "a precompiled phase module has a name of its own, and is imported first"
+    import sys
+    import types
+    import createstubs  # type: ignore
+    import createstubs_info  # type: ignore
+    compiled = types.ModuleType('createstubs_info_mpy')
+    compiled.info = lambda: dict(createstubs_info.info(), name='compiled')
+    mocker.patch.dict(sys.modules, {'createstubs_info_mpy': compiled})
+    stubber = host_stubber()
+    assert stubber.info['name'] == 'compiled'
+    assert 'createstubs_info_mpy' not in sys.modules
+    assert createstubs.load('createstubs_clean').__name__ == 'createstubs_clean'
+
+
+def test_progress_is_opt_in(mocker):
+    import sys
+    import createstubs  # type: ignore
+    mocker.patch.object(sys, 'argv', ['createstubs.py', '--path', '/tmp'])
+    stubber = mocker.patch.object(createstubs, 'Stubber')
+    createstubs.main()
+    assert stubber.call_args == mocker.call(path='/tmp', progress=False)
+    mocker.patch.object(sys, 'argv', ['createstubs.py', '--progress', '--path', '/tmp'])
+    createstubs.main()
+    assert stubber.call_args == mocker.call(path='/tmp', progress=True)